@@ -34,6 +34,9 @@ def test_test(ctx, test):
     passed = 0
     total = 0
 
+    # Check all the fields at once, and then report the ones that failed.
+    test.evaluate_all()
+
     for result in ctx.scheduler.map(
             functools.partial(test_field, ctx, test),
             (f for n, f in test.fields())):
@@ -26,6 +26,7 @@ class MissingProgram(fbuild.ConfigFailed):
 
 # ------------------------------------------------------------------------------
 
+@fbuild.db.configures
 @fbuild.db.caches
 def find_program(ctx, names, paths=None, *, quieter=0):
     """L{find_program} is a test that searches the paths for one of the
@@ -198,7 +199,7 @@ class AbstractLibLinker(AbstractCompiler):
     @fbuild.db.cachemethod
     @platform.auto_platform_options()
     def link_lib(self, dst, srcs:fbuild.db.SRCS, *args,
-            libs:fbuild.db.SRCS=(),
+            libs:fbuild.db.INTERFACE_SRCS=(),
             **kwargs) -> fbuild.db.DST:
         """Link compiled files into a library and caches the results."""
         return self.uncached_link_lib(dst, srcs, *args, libs=libs, **kwargs)
@@ -270,7 +271,7 @@ class AbstractExeLinker(AbstractCompiler, AbstractRunner):
     @fbuild.db.cachemethod
     @platform.auto_platform_options()
     def link_exe(self, dst, srcs:fbuild.db.SRCS, *args,
-            libs:fbuild.db.SRCS=(),
+            libs:fbuild.db.INTERFACE_SRCS=(),
             **kwargs) -> fbuild.db.DST:
         """Link compiled files into an executable."""
         return self.uncached_link_exe(dst, srcs, *args, libs=libs, **kwargs)
@@ -7,6 +7,7 @@ import fbuild.db
 import fbuild.temp
 import fbuild.builders
 import fbuild.builders.platform
+import fbuild.builders.c.unity
 import fbuild.functools
 import fbuild.record
 from fbuild.path import Path
@@ -25,6 +26,7 @@ class MissingHeader(fbuild.ConfigFailed):
 
 # ------------------------------------------------------------------------------
 
+@fbuild.db.configures
 class Builder(fbuild.builders.AbstractCompilerBuilder):
     @fbuild.builders.platform.auto_platform_options()
     def __init__(self, *args, flags=(), cross_compiler=False, **kwargs):
@@ -122,6 +124,84 @@ class Builder(fbuild.builders.AbstractCompilerBuilder):
 
     # --------------------------------------------------------------------------
 
+    @fbuild.builders.platform.auto_platform_options()
+    def build_objects(self, srcs, *args, unity=None, **kwargs):
+        """Compile all of the passed in L{srcs} in parallel. If I{unity} is
+        given, up to that many sources are compiled at once by a source that
+        includes them, except for the sources that are being edited or that
+        clash with the sources they are compiled with."""
+        if not unity or unity < 2:
+            return super().build_objects(srcs, *args, **kwargs)
+
+        # Every call gets a directory of its own, named after its sources,
+        # for its groups and history.
+        buildroot = Path(kwargs.get('buildroot') or self.ctx.buildroot)
+        unitydir = buildroot / 'unity' / \
+            fbuild.builders.c.unity.digest_srcs(srcs)
+        history = fbuild.builders.c.unity.History(unitydir / 'history')
+
+        together, alone = history.update(srcs)
+
+        # The sources that clashed with their group in this build.
+        clashes = []
+
+        while True:
+            groups = {}
+            singles = alone + [src for src in together if src in clashes]
+            grouped = [src for src in together if src not in clashes]
+            for i in range(0, len(grouped), unity):
+                group = grouped[i:i + unity]
+                if len(group) == 1:
+                    singles.extend(group)
+                    continue
+
+                src = fbuild.builders.c.unity.write_source(
+                    unitydir / fbuild.builders.c.unity.digest_srcs(group) +
+                        Path(group[0]).ext,
+                    group)
+                groups[src] = group
+
+            # The included sources still need to find the headers next to
+            # them.
+            group_kwargs = kwargs
+            if groups and kwargs.get('include_source_dirs', True):
+                includes = list(kwargs.get('includes', ()))
+                for src in grouped:
+                    parent = Path(src).parent
+                    if parent and parent not in includes:
+                        includes.append(parent)
+                group_kwargs = dict(kwargs, includes=includes)
+
+            try:
+                objs = super().build_objects(list(groups) + singles, *args,
+                    **group_kwargs)
+            except fbuild.ExecutionError as e:
+                # Compile the sources of the group that failed on their own.
+                # If they also fail on their own, the error is reported from
+                # them.
+                for src, group in groups.items():
+                    if src in e.cmd:
+                        break
+                else:
+                    raise
+
+                group_clashes = fbuild.builders.c.unity.find_clashes(group,
+                    e.stderr)
+                clashes.extend(group_clashes)
+
+                self.ctx.logger.check(' * unity',
+                    'compiling %s on their own' % ' '.join(group_clashes),
+                    color='yellow')
+                continue
+
+            # Only remember the clashes now that they compiled on their own,
+            # so that a source with a real error goes back into its group once
+            # it's fixed.
+            if clashes:
+                history.add_clashes(clashes)
+
+            return objs
+
     @fbuild.builders.platform.auto_platform_options()
     def build_lib(self, dst, srcs, *args, **kwargs):
         """Compile all of the passed in L{srcs} in parallel, then link them
@@ -262,6 +342,7 @@ class Library(Path):
             libpaths=(),
             libs=(),
             external_libs=(),
+            interface=None,
             **kwargs):
         self = super().__new__(cls, *args, **kwargs)
 
@@ -269,15 +350,21 @@ class Library(Path):
         self.libs = tuple(libs)
         self.external_libs = tuple(external_libs)
 
+        # Shared libraries carry a file that describes their interface, which
+        # is what the things that link against them depend on.
+        self.interface = interface
+
         return self
 
     def __repr__(self):
-        return 'Library({}{}{}{})'.format(
+        return 'Library({}{}{}{}{})'.format(
             super().__repr__(),
             ', libpaths={}'.format(self.libpaths) if self.libpaths else '',
             ', libs={}'.format(self.libs) if self.libs else '',
             ', external_libs={}'.format(self.external_libs)
-                if self.external_libs else '')
+                if self.external_libs else '',
+            ', interface={!r}'.format(self.interface)
+                if self.interface else '')
 
     def __eq__(self, other):
         if self is other:
@@ -289,14 +376,17 @@ class Library(Path):
             super().__eq__(other) and \
             self.libpaths == other.libpaths and \
             self.libs == other.libs and \
-            self.external_libs == other.external_libs
+            self.external_libs == other.external_libs and \
+            getattr(self, 'interface', None) == \
+                getattr(other, 'interface', None)
 
     def __hash__(self):
         return hash((
             super().__hash__(),
             self.libpaths,
             self.libs,
-            self.external_libs))
+            self.external_libs,
+            getattr(self, 'interface', None)))
 
 # ------------------------------------------------------------------------------
 
@@ -333,6 +423,61 @@ class Executable(Path):
 
 # ------------------------------------------------------------------------------
 
+class Object(Path):
+    """Wrapper around an object path that carries the digest of the
+    preprocessed source it was compiled from. It compares equal to the plain
+    path, as it's only used to tell if the object needs to be compiled
+    again."""
+
+    def __new__(cls, *args, preprocessed=None, **kwargs):
+        self = super().__new__(cls, *args, **kwargs)
+
+        self.preprocessed = preprocessed
+
+        return self
+
+    def __repr__(self):
+        return 'Object({0}{1})'.format(
+            super().__repr__(),
+            ', preprocessed={0!r}'.format(self.preprocessed)
+                if self.preprocessed else '')
+
+# ------------------------------------------------------------------------------
+
+class PrecompiledHeader(Path):
+    """Wrapper around a precompiled header path that carries the header it
+    was compiled from."""
+
+    def __new__(cls, *args, header=None, **kwargs):
+        self = super().__new__(cls, *args, **kwargs)
+
+        self.header = header
+
+        return self
+
+    def __repr__(self):
+        return 'PrecompiledHeader({0}{1})'.format(
+            super().__repr__(),
+            ', header={0!r}'.format(self.header) if self.header else '')
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+
+        # Check the types as well because Path doesn't require that for
+        # equality.
+        return isinstance(other, self.__class__) and \
+            super().__eq__(other) and \
+            self.header == other.header
+
+    def __hash__(self):
+        return hash((
+            super().__hash__(),
+            self.header))
+
+# ------------------------------------------------------------------------------
+
+@fbuild.db.configures
 @fbuild.db.caches
 def identify_compiler(ctx, exe):
     res = None
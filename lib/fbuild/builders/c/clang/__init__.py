@@ -22,6 +22,13 @@ class Clang(fbuild.builders.c.gcc.Gcc):
 
         return None
 
+    pch_suffix = '.pch'
+
+    def pch_flags(self, pch):
+        """Return the flags that include the precompiled header into a
+        source."""
+        return ['-include-pch', pch]
+
 # ------------------------------------------------------------------------------
 
 def make_cc(ctx, exe=None, default_exes=['clang'], **kwargs):
@@ -1,18 +1,22 @@
 import io
+import os
 import re
 from itertools import chain
 
 import fbuild
 import fbuild.builders
 import fbuild.builders.c
+import fbuild.builders.nm
 import fbuild.builders.platform
 import fbuild.db
+import fbuild.db.backend
 import fbuild.record
 from fbuild.path import Path
 from fbuild.temp import tempfile
 
 # ------------------------------------------------------------------------------
 
+@fbuild.db.configures
 class Ar(fbuild.db.PersistentObject):
     def __init__(self, ctx, exe='ar', *,
             platform=None,
@@ -101,7 +105,12 @@ class Ar(fbuild.db.PersistentObject):
 
 # ------------------------------------------------------------------------------
 
+@fbuild.db.configures
 class Gcc(fbuild.db.PersistentObject):
+    # Where gcc looks for headers and libraries, which the configuration
+    # cache includes in its key.
+    search_dirs_flags = ('-print-sysroot', '-print-search-dirs')
+
     def __init__(self, ctx, exe, *,
             src_suffix,
             pre_flags=(),
@@ -164,7 +173,11 @@ class Gcc(fbuild.db.PersistentObject):
             requires_at_least_version=requires_at_least_version,
             requires_at_most_version=requires_at_most_version)
 
-    def __call__(self, srcs, dst=None, *,
+    def __call__(self, srcs, dst=None, **kwargs):
+        cmd, msg2, kwargs = self.command(srcs, dst, **kwargs)
+        return self.ctx.execute(cmd, msg2=msg2, **kwargs)
+
+    def command(self, srcs, dst=None, *,
             pre_flags=(),
             flags=(),
             includes=(),
@@ -181,6 +194,9 @@ class Gcc(fbuild.db.PersistentObject):
             machine_flags=(),
             include_source_dirs=True,
             **kwargs):
+        """Return the command line that builds the srcs, the message that
+        describes it, and the remaining arguments for ctx.execute."""
+
         srcs = [Path(src) for src in srcs]
 
         # Make sure we don't repeat includes
@@ -307,7 +323,7 @@ class Gcc(fbuild.db.PersistentObject):
             # Add ldlibs.
             cmd.extend(self.ldlibs+tuple(ldlibs))
 
-        return self.ctx.execute(cmd, msg2=msg2, **kwargs)
+        return cmd, msg2, kwargs
 
     def version(self):
         """Return the version of the gcc executable."""
@@ -334,6 +350,15 @@ class Gcc(fbuild.db.PersistentObject):
         self.ctx.logger.passed()
         return True
 
+    # gcc looks for a precompiled header next to the header it was named
+    # after, and uses that header if it can't use the precompiled one.
+    pch_suffix = '.gch'
+
+    def pch_flags(self, pch):
+        """Return the flags that include the precompiled header into a
+        source."""
+        return ['-include', pch[:-len(self.pch_suffix)]]
+
     def __str__(self):
         return str(self.exe.name)
 
@@ -344,6 +369,34 @@ def make_cc(ctx, exe=None, default_exes=['gcc', 'cc'], **kwargs):
 
 # ------------------------------------------------------------------------------
 
+# The suffixes that tell gcc a source has already been preprocessed.
+_PREPROCESSED_SUFFIXES = {
+    '.c': '.i',
+    '.m': '.mi',
+    '.mm': '.mii',
+}
+
+# The languages gcc precompiles a header as, by the suffix of the sources.
+_HEADER_LANGUAGES = {
+    '.c': 'c-header',
+    '.m': 'objective-c-header',
+    '.mm': 'objective-c++-header',
+}
+
+def _without_dependency_flags(flags):
+    """Remove the flags that write out the dependencies of a source."""
+
+    new_flags = []
+    it = iter(flags)
+    for flag in it:
+        if flag in ('-MF', '-MT', '-MQ'):
+            next(it, None)
+        elif flag not in ('-MD', '-MMD', '-MP'):
+            new_flags.append(flag)
+
+    return new_flags
+
+@fbuild.db.configures
 class Compiler(fbuild.db.PersistentObject):
     def __init__(self, ctx, cc, flags, *, suffix):
         super().__init__(ctx)
@@ -359,6 +412,9 @@ class Compiler(fbuild.db.PersistentObject):
     def __call__(self, src, dst=None, *,
             suffix=None,
             buildroot=None,
+            cache=None,
+            distributor=None,
+            pch=None,
             **kwargs):
         buildroot = buildroot or self.ctx.buildroot
         src = Path(src)
@@ -367,19 +423,145 @@ class Compiler(fbuild.db.PersistentObject):
         dst = Path(dst or src).addroot(buildroot).replaceext(suffix)
         dst.parent.makedirs()
 
-        stdout, stderr = self.cc([src], dst,
-            pre_flags=list(chain(('-c',), self.flags)),
-            msg1=str(self),
-            color='compile',
-            **kwargs)
+        # The preprocessor can't use a precompiled header, so it includes the
+        # header itself.
+        preprocess_kwargs = compile_kwargs = kwargs
+        if pch is not None:
+            flags = list(kwargs.get('flags', ()))
+            preprocess_kwargs = dict(kwargs,
+                flags=flags + ['-include', pch.header])
+            compile_kwargs = dict(kwargs, flags=flags + self.cc.pch_flags(pch))
+
+        if cache is None and distributor is None:
+            stdout, stderr = self.cc([src], dst,
+                pre_flags=list(chain(('-c',), self.flags)),
+                msg1=str(self),
+                color='compile',
+                **compile_kwargs)
+
+            return dst, stdout, stderr
+
+        # Both the object cache and the workers work from the preprocessed
+        # source.
+        with tempfile(suffix=_PREPROCESSED_SUFFIXES.get(src.ext, '.ii')) as i:
+            self.cc([src], i,
+                pre_flags=list(chain(('-c', '-E'), self.flags)),
+                **preprocess_kwargs)
+
+            # Look for the object in the object cache before compiling it.
+            if cache is not None:
+                key = self._cache_key(src, i, kwargs)
+                if cache.restore(key, dst):
+                    self.ctx.logger.check(' * ' + str(self),
+                        '%s -> %s (cached)' % (src, dst),
+                        color='compile',
+                        verbose=kwargs.get('quieter', 0))
+                    return dst, b'', b''
+
+            result = None
+            if distributor is not None and '-x' not in kwargs.get('flags', ()):
+                result = self._distribute(distributor, i, dst, kwargs)
+
+        if result is not None:
+            address, stdout, stderr = result
+            self.ctx.logger.check(' * ' + str(self),
+                '%s -> %s (on %s)' % (src, dst, address),
+                color='compile',
+                verbose=kwargs.get('quieter', 0))
+        else:
+            stdout, stderr = self.cc([src], dst,
+                pre_flags=list(chain(('-c',), self.flags)),
+                msg1=str(self),
+                color='compile',
+                **compile_kwargs)
+
+        if cache is not None:
+            cache.store(key, dst)
 
         return dst, stdout, stderr
 
+    def preprocess(self, src, dst, *, buildroot=None, pch=None, **kwargs):
+        """Preprocess the source into I{dst} without line markers, so that
+        the output only changes when the code does. Debug info records the
+        lines of the code, so the markers are kept when it's on."""
+
+        if pch is not None:
+            kwargs = dict(kwargs,
+                flags=list(chain(kwargs.get('flags', ()),
+                    ('-include', pch.header))))
+
+        if self._debug_info(kwargs.get('flags', ()), kwargs):
+            pre_flags = ('-E',)
+        else:
+            pre_flags = ('-E', '-P')
+
+        self.cc([src], dst,
+            pre_flags=list(chain(pre_flags, self.flags)),
+            **kwargs)
+
+        return dst
+
+    def _distribute(self, distributor, src, dst, kwargs):
+        """Compile the preprocessed source on a worker. The dependencies
+        were already written out by the preprocessor."""
+
+        cmd, msg2, execute_kwargs = self.cc.command([src], dst,
+            pre_flags=list(chain(('-c',), self.flags)),
+            **dict(kwargs, flags=_without_dependency_flags(
+                kwargs.get('flags', ()))))
+
+        # Commands that need more than the compiler, like ones that set the
+        # environment, are run here.
+        if execute_kwargs.get('env') or execute_kwargs.get('cwd'):
+            return None
+
+        # Let the other tasks run while we wait on the worker.
+        with self.ctx.scheduler.interruptible():
+            return distributor.compile(cmd, src, dst)
+
+    def _debug_info(self, flags, kwargs):
+        """Return whether the compile, with the extra I{flags}, produces
+        debug info."""
+
+        debug = kwargs.get('debug')
+        return bool((debug is None and self.cc.debug) or debug or any(
+            flag.startswith('-g')
+            for flag in chain(self.cc.flags, self.flags, flags)))
+
+    def _cache_key(self, src, preprocessed, kwargs):
+        """Compute the key of the object in the object cache. Rather than
+        tracking which headers the source includes, the key uses the
+        preprocessed source, along with everything else that goes into the
+        compiler's command line."""
+
+        # Only the object matters, so leave out where the dependencies are
+        # written.
+        flags = _without_dependency_flags(kwargs.get('flags', ()))
+
+        # Debug info records the directory the object was compiled in.
+        if self._debug_info(flags, kwargs):
+            cwd = kwargs.get('cwd') or os.getcwd()
+        else:
+            cwd = None
+
+        exe = self.cc.exe.stat()
+
+        return fbuild.db.backend.digest_bound(self.ctx, {
+            'exe': (self.cc.exe, exe.st_size, exe.st_mtime),
+            'cc': self.cc,
+            'flags': self.flags,
+            'src': src,
+            'kwargs': dict(kwargs, flags=flags),
+            'preprocessed': preprocessed.digest(),
+            'cwd': cwd,
+        })
+
     def __str__(self):
         return str(self.cc)
 
 # ------------------------------------------------------------------------------
 
+@fbuild.db.configures
 class Linker(fbuild.db.PersistentObject):
     def __init__(self, ctx, cc, flags=(), *, prefix, suffix):
         super().__init__(ctx)
@@ -439,17 +621,103 @@ class Builder(fbuild.builders.c.Builder):
     @fbuild.db.cachemethod
     def compile(self, src:fbuild.db.SRC, dst=None, *,
             flags=[],
+            pch:fbuild.db.OPTIONAL_SRC=None,
             **kwargs) -> fbuild.db.DST:
         """Compile a c file and cache the results."""
         # Generate the dependencies while we compile the file.
         with tempfile() as dep:
-            obj = self.uncached_compile(src, dst,
-                flags=list(chain(('-MMD', '-MF', dep), flags)),
+            flags = list(chain(('-MMD', '-MF', dep), flags))
+
+            if self.ctx.early_cutoff is None:
+                obj = self.uncached_compile(src, dst,
+                    flags=flags,
+                    cache=self.ctx.object_cache,
+                    distributor=self.ctx.distributor,
+                    pch=pch,
+                    **kwargs)
+            else:
+                obj = self._compile_if_changed(src, dst,
+                    flags=flags,
+                    pch=pch,
+                    **kwargs)
+
+            self._add_dependencies(dep)
+
+        return obj
+
+    def _compile_if_changed(self, src, dst=None, **kwargs):
+        """Compile a c file, unless its preprocessed source is the same as the
+        one the object was compiled from the last time."""
+        src = Path(src)
+
+        with tempfile(suffix=_PREPROCESSED_SUFFIXES.get(src.ext, '.ii')) as i:
+            self.compiler.preprocess(src, i, **kwargs)
+            digest = i.digest()
+
+        obj = self.ctx.db.find_old_result()
+        if isinstance(obj, fbuild.builders.c.Object) and \
+                obj.preprocessed == digest and obj.exists():
+            self.ctx.early_cutoff.record(self, True)
+            self.ctx.logger.check(' * ' + str(self),
+                '%s -> %s (unchanged)' % (src, obj),
+                color='compile',
+                verbose=kwargs.get('quieter', 0))
+            return obj
+
+        obj = self.uncached_compile(src, dst,
+            cache=self.ctx.object_cache,
+            distributor=self.ctx.distributor,
+            **kwargs)
+        self.ctx.early_cutoff.record(self, False)
+
+        return fbuild.builders.c.Object(obj, preprocessed=digest)
+
+    @fbuild.db.cachemethod
+    def compile_pch(self, src:fbuild.db.SRC, dst=None, *,
+            flags=[],
+            **kwargs) -> fbuild.db.DST:
+        """Precompile a c header and cache the results."""
+        src = Path(src)
+        suffix = self.compiler.cc.pch_suffix
+        dst = Path(dst or src) + suffix
+        language = _HEADER_LANGUAGES.get(self.src_suffix, 'c++-header')
+
+        # Generate the dependencies while we compile the header, so that it's
+        # rebuilt when any of the headers it includes change.
+        with tempfile() as dep:
+            pch, stdout, stderr = self.compiler(src, dst,
+                flags=list(chain(('-x', language, '-MMD', '-MF', dep), flags)),
+                suffix=suffix,
                 **kwargs)
 
-            with open(dep, 'rb') as f:
-                # Parse the output and return the module dependencies.
-                stdout = f.read().replace(b'\\\n', b'')
+            self._add_dependencies(dep)
+
+        # gcc looks for the precompiled header next to the header it includes,
+        # so put a header there that includes the real one. If gcc can't use
+        # the precompiled header, such as when it was compiled with other
+        # flags, it falls back to the real header.
+        header = Path(pch[:-len(suffix)])
+        with open(header, 'w') as f:
+            print('#include "%s"' % src.abspath().replace('\\', '/'),
+                file=f)
+        self.ctx.db.add_external_dependencies_to_call(dsts=[header])
+
+        return fbuild.builders.c.PrecompiledHeader(pch, header=src)
+
+    @fbuild.builders.platform.auto_platform_options()
+    def build_objects(self, srcs, *args, pch=None, **kwargs):
+        """Compile all of the passed in L{srcs} in parallel. If I{pch} is a
+        header, it's precompiled first and included into every source."""
+        if pch is not None:
+            pch = self.compile_pch(pch, **kwargs)
+
+        return super().build_objects(srcs, *args, pch=pch, **kwargs)
+
+    def _add_dependencies(self, dep):
+        """Add the headers gcc wrote to the I{dep} file as dependencies of the
+        current call."""
+        with open(dep, 'rb') as f:
+            stdout = f.read().replace(b'\\\n', b'')
 
         # Parse the output and return the module dependencies.
         m = re.match(b'\s*\S+:(?: (.*))?$', stdout)
@@ -461,8 +729,6 @@ class Builder(fbuild.builders.c.Builder):
             deps = s.decode().split()
             self.ctx.db.add_external_dependencies_to_call(srcs=deps)
 
-        return obj
-
     def uncached_compile(self, *args, **kwargs):
         """Compile a c file without caching the results.  This is needed when
         compiling temporary files."""
@@ -476,7 +742,26 @@ class Builder(fbuild.builders.c.Builder):
         return fbuild.builders.c.Library(lib,
             libpaths=kwargs.get('libpaths', []),
             libs=kwargs.get('libs', []),
-            external_libs=kwargs.get('external_libs', []))
+            external_libs=kwargs.get('external_libs', []),
+            interface=self._write_interface(lib))
+
+    def _write_interface(self, lib):
+        """Write the interface of a shared library next to it, so that the
+        programs that link against it aren't linked again when only its
+        implementation changes. Returns None for static libraries, or if we
+        can't read the library's symbols."""
+        if not isinstance(self.lib_linker, Linker):
+            return None
+
+        interface = Path(lib + '.abi')
+        try:
+            fbuild.builders.nm.Nm(self.ctx).interface(lib, interface)
+        except (fbuild.ConfigFailed, fbuild.ExecutionError):
+            return None
+
+        self.ctx.db.add_external_dependencies_to_call(dsts=[interface])
+
+        return interface
 
     def uncached_link_exe(self, *args, **kwargs):
         """Link compiled c files into am executable without caching the
@@ -11,6 +11,7 @@ from fbuild.temp import tempdir, tempfile
 
 # ------------------------------------------------------------------------------
 
+@fbuild.db.configures
 class Cl(fbuild.db.PersistentObject):
     def __init__(self, ctx, exe='cl', *,
             pre_flags=[],
@@ -126,6 +127,7 @@ class Cl(fbuild.db.PersistentObject):
 
 # ------------------------------------------------------------------------------
 
+@fbuild.db.configures
 class Compiler(fbuild.db.PersistentObject):
     def __init__(self, ctx, cl, flags, *, suffix):
         super().__init__(ctx)
@@ -162,6 +164,7 @@ class Compiler(fbuild.db.PersistentObject):
 
 # ------------------------------------------------------------------------------
 
+@fbuild.db.configures
 class Lib(fbuild.db.PersistentObject):
     def __init__(self, ctx, exe='lib', *,
             platform=None,
@@ -229,6 +232,7 @@ class Lib(fbuild.db.PersistentObject):
 
 # ------------------------------------------------------------------------------
 
+@fbuild.db.configures
 class Link(fbuild.db.PersistentObject):
     def __init__(self, ctx, exe='link', *,
             prefix=None,
@@ -0,0 +1,149 @@
+"""Support for unity builds, which compile several c sources at once with a
+source that includes all of them."""
+
+import hashlib
+import os
+import pickle
+import threading
+
+from fbuild.path import Path
+
+# ------------------------------------------------------------------------------
+
+# How many times a source has to change before it's compiled on its own.
+EDITS = 2
+
+# How many builds a source has to stay the same before it's compiled with the
+# other sources again.
+STABLE = 10
+
+_lock = threading.Lock()
+
+class History:
+    """Remembers which sources of a unity build are being edited and which
+    ones clash with the sources they are compiled with, so they can be
+    compiled on their own. A source goes back into the groups once it has
+    stayed the same for L{STABLE} builds."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def _load(self):
+        history = {'stamps': {}, 'digests': {}, 'edits': {}, 'stable': {},
+            'clashes': set()}
+        try:
+            with open(self.path, 'rb') as f:
+                history.update(pickle.load(f))
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            pass
+        return history
+
+    def _save(self, history):
+        self.path.parent.makedirs()
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump(history, f)
+        os.replace(tmp, self.path)
+
+    def update(self, srcs):
+        """Record the changes to the srcs, and return the srcs that should be
+        compiled together and the ones that should be compiled on their
+        own."""
+
+        together = []
+        alone = []
+
+        with _lock:
+            history = self._load()
+
+            for src in srcs:
+                key = Path(src).abspath()
+
+                # Only hash the sources whose stat changed.
+                st = os.stat(src)
+                stamp = (st.st_mtime, st.st_size)
+                if history['stamps'].get(key) == stamp:
+                    changed = False
+                else:
+                    digest = Path(src).digest()
+                    old_digest = history['digests'].get(key)
+                    history['stamps'][key] = stamp
+                    history['digests'][key] = digest
+                    changed = old_digest is not None and old_digest != digest
+
+                if changed:
+                    history['edits'][key] = history['edits'].get(key, 0) + 1
+                    history['stable'][key] = 0
+                else:
+                    stable = history['stable'].get(key, 0) + 1
+                    if stable >= STABLE:
+                        history['edits'].pop(key, None)
+                        history['clashes'].discard(key)
+                        stable = 0
+                    history['stable'][key] = stable
+
+                if key in history['clashes'] or \
+                        history['edits'].get(key, 0) >= EDITS:
+                    alone.append(src)
+                else:
+                    together.append(src)
+
+            self._save(history)
+
+        return together, alone
+
+    def add_clashes(self, srcs):
+        """Compile the srcs on their own until they've stayed the same for
+        L{STABLE} builds."""
+
+        with _lock:
+            history = self._load()
+            for src in srcs:
+                key = Path(src).abspath()
+                history['clashes'].add(key)
+                history['stable'][key] = 0
+            self._save(history)
+
+# ------------------------------------------------------------------------------
+
+def digest_srcs(srcs):
+    """Return a name for the srcs that only depends on which sources they
+    are, so that different groups and builds don't share files."""
+
+    m = hashlib.md5()
+    for src in sorted(Path(src).abspath() for src in srcs):
+        m.update(src.encode('utf-8', 'surrogateescape') + b'\0')
+    return m.hexdigest()
+
+def write_source(dst, srcs):
+    """Write a source to I{dst} that includes the srcs. The file is only
+    written if it changed so that it isn't compiled again."""
+
+    dst = Path(dst)
+    code = ''.join('#include "%s"\n' % Path(src).abspath().replace('\\', '/')
+        for src in srcs)
+
+    try:
+        with open(dst) as f:
+            if f.read() == code:
+                return dst
+    except OSError:
+        pass
+
+    dst.parent.makedirs()
+    with open(dst, 'w') as f:
+        f.write(code)
+
+    return dst
+
+def find_clashes(srcs, stderr):
+    """Return the srcs that the compiler complained about when they were
+    compiled together, or all of them if it didn't name any."""
+
+    if isinstance(stderr, bytes):
+        stderr = stderr.decode('utf-8', 'replace')
+
+    clashes = [src for src in srcs
+        if Path(src).abspath().replace('\\', '/') in stderr]
+
+    return clashes or list(srcs)
@@ -73,5 +73,57 @@ class Nm(fbuild.db.PersistentObject):
 
         return defined_symbols, undefined_symbols
 
+    def interface(self, lib, dst):
+        """Write the interface of the shared library I{lib} to I{dst}, which
+        is its SONAME and the symbols it exports. Programs that link against
+        the library only need to be linked again if these change."""
+
+        lib = fbuild.path.Path(lib)
+        dst = fbuild.path.Path(dst)
+
+        stdout, stderr = self.ctx.execute(
+            [self.exe, '-D', '--defined-only', '-P', lib],
+            quieter=1)
+
+        # The addresses and the sizes of functions change with the
+        # implementation, but programs copy the data they use out of the
+        # library, so the sizes of data matter.
+        lines = set()
+        regex = re.compile(br'^(\S+) (\S)(?: \S+(?: (\S+))?)?')
+        for line in io.BytesIO(stdout):
+            m = regex.match(line)
+            if m:
+                symbol, kind, size = m.groups()
+                if kind in b'TtWwi':
+                    size = None
+                lines.add(b' '.join(s for s in (symbol, kind, size) if s))
+
+        soname = self._soname(lib)
+        if soname is not None:
+            lines.add(b'SONAME ' + soname)
+
+        with open(dst, 'wb') as f:
+            for line in sorted(lines):
+                f.write(line + b'\n')
+
+        return dst
+
+    def _soname(self, lib):
+        """Return the SONAME of the shared library, or None if it doesn't
+        have one or we can't read it."""
+
+        try:
+            readelf = fbuild.builders.find_program(self.ctx, ['readelf'],
+                quieter=1)
+            stdout, stderr = self.ctx.execute([readelf, '-d', lib], quieter=1)
+        except (fbuild.ConfigFailed, fbuild.ExecutionError):
+            return None
+
+        m = re.search(br'\(SONAME\)\s+Library soname: \[(.*)\]', stdout)
+        if m:
+            return m.group(1)
+
+        return None
+
     def __str__(self):
         return str(self.exe.name)
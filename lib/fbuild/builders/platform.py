@@ -50,6 +50,7 @@ archmap = {
 
 # ------------------------------------------------------------------------------
 
+@fbuild.db.configures
 @fbuild.db.caches
 def guess_platform(ctx, arch=None):
     """L{guess_platform} returns a platform set that describes the various
@@ -68,6 +68,20 @@ class Test(metaclass=TestMeta):
         for field_name in cls.__field_names__:
             yield field_name, getattr(cls, field_name)
 
+    def evaluate_all(self, names=None):
+        """Evaluate the fields named I{names}, or all the fields if None,
+        concurrently with the scheduler. Each field is cached in the database
+        just as if it was accessed by itself. Returns a list of the names and
+        values of the fields."""
+
+        if names is None:
+            names = [name for name, field in self.fields()]
+        else:
+            names = list(names)
+
+        return list(zip(names,
+            self.ctx.scheduler.map(lambda name: getattr(self, name), names)))
+
     def get(self, key, default=None):
         """Look in the test for an attribute named "key". If "key" contains
         any periods, recursively walk down the attributes to find the final
@@ -1,4 +1,8 @@
+import functools
+import os
 import textwrap
+import threading
+import weakref
 
 import fbuild.builders.platform
 import fbuild.config
@@ -25,7 +29,7 @@ class Function:
         return \
             type(self) is type(other) and \
             self.return_type == other.return_type and \
-            self.args == other.size
+            self.args == other.args
 
     def __hash__(self):
         return hash((self.__class__, self.return_type, self.args))
@@ -137,6 +141,7 @@ class cacheproperty(fbuild.db.cacheproperty):
 
 # ------------------------------------------------------------------------------
 
+@fbuild.db.configures
 class AbstractFieldDescriptor:
     """L{AbstractFieldDescriptor} represents a descriptor for the L{Test} class
     that when accessed, evaluates a cache and returns the appropriate field if
@@ -172,7 +177,6 @@ class AbstractFieldDescriptor:
                 return None
         else:
             header = None
-        formatted_test = self.test if self.test else self.format_test(header)
 
         if isinstance(self, header_test):
             msg = 'checking header %r' % self.filename
@@ -184,24 +188,59 @@ class AbstractFieldDescriptor:
 
         instance.ctx.logger.check(msg)
 
-        # run the test
+        # Run the test along with the rest of the instance's probes, unless
+        # it needs a program of its own.
+        if self.batchable() and instance.ctx.options.config_batching:
+            stdout = _find_batch(instance, header).stdout(self)
+        else:
+            stdout = self.run(instance, header)
+
+        if stdout is None:
+            instance.ctx.logger.failed()
+        else:
+            return self.process_stdout(instance, stdout)
+
+    def run(self, instance, header):
+        """Run the test in a program of its own, and return the stdout, or
+        None if it failed."""
+
+        formatted_test = self.test if self.test else self.format_test(header)
+
         try:
             stdout, stderr = instance.builder.tempfile_run(formatted_test,
                 input=self.stdin,
                 timeout=self.timeout,
-                lkwargs={
-                    'flags': instance.flags,
-                    'libpaths': instance.libpaths,
-                    'libs': instance.libs,
-                    'external_libs': instance.external_libs})
+                lkwargs=instance.lkwargs())
         except fbuild.ExecutionError:
-            instance.ctx.logger.failed()
+            return None
         else:
-            return self.process_stdout(instance, stdout)
+            return stdout
+
+    def batchable(self):
+        """Return whether the test can be merged into a program with other
+        tests. Tests with their own code, input or output need to run by
+        themselves."""
+
+        return \
+            self.test is None and \
+            self.stdin is None and \
+            self.stdout is None and \
+            self.timeout is None and \
+            self.format_probe() is not None
 
     def format_test(self, instance):
         raise NotImplementedError
 
+    # The number of values the probe writes to fbuild_out.
+    probe_outputs = 0
+
+    def format_probe(self):
+        """Return the body of a function that returns 0 if the test passes,
+        and stores the values the test prints in the fbuild_out array. The
+        header has already been included. Returns None if the test can't be
+        run this way."""
+        return None
+
     def process_stdout(self, instance, stdout):
         raise NotImplementedError
 
@@ -296,11 +335,8 @@ class function_test(AbstractFieldDescriptor):
             ', '.join(str(a) for a in args),
         )
 
-    def format_test(self, header=None):
-        if header is None:
-            header = ''
-        else:
-            header = '#include <%s>' % header
+    def format_statements(self):
+        """Return the definitions of the arguments and the call."""
 
         args = []
         defs = []
@@ -325,6 +361,16 @@ class function_test(AbstractFieldDescriptor):
         if self.return_type != 'void':
             call = '%s res = %s' % (self.return_type, call)
 
+        return defs, call
+
+    def format_test(self, header=None):
+        if header is None:
+            header = ''
+        else:
+            header = '#include <%s>' % header
+
+        defs, call = self.format_statements()
+
         return textwrap.dedent('''
             %s
             int main() {
@@ -334,6 +380,13 @@ class function_test(AbstractFieldDescriptor):
             }
         ''') % (header, '\n    '.join(defs), call)
 
+    def format_probe(self):
+        defs, call = self.format_statements()
+
+        # The arguments aren't initialized, so zero them rather than pass
+        # along whatever the previous probe left on the stack.
+        return '\n'.join(['static ' + d for d in defs] + [call + ';'])
+
     def process_stdout(self, instance, stdout):
         if self.stdout is None or self.stdout == stdout:
             instance.ctx.logger.passed()
@@ -379,6 +432,13 @@ class macro_test(AbstractFieldDescriptor):
             }
         ''') % (header, self.name, self.name)
 
+    def format_probe(self):
+        return textwrap.dedent('''
+            #ifndef %s
+            return 1;
+            #endif
+        ''') % self.name
+
     def process_stdout(self, instance, stdout):
         if self.stdout is None or self.stdout == stdout:
             instance.ctx.logger.passed()
@@ -408,6 +468,18 @@ class type_test(AbstractFieldDescriptor):
             }
         ''') % ('' if header is None else '#include <%s>' % header, self.name)
 
+    probe_outputs = 2
+
+    def format_probe(self):
+        # We can't include stddef.h for offsetof, as the header may be tested
+        # for the macros it defines.
+        return textwrap.dedent('''
+            typedef %s type;
+            struct TEST { char c; type mem; } test;
+            fbuild_out[0] = (long)((char*)&test.mem - (char*)&test);
+            fbuild_out[1] = (long)sizeof(type);
+        ''') % self.name
+
     def process_stdout(self, instance, stdout):
         stdout = stdout.split()
         alignment = int(stdout[0])
@@ -438,6 +510,17 @@ class int_type_test(AbstractFieldDescriptor):
             }
         ''') % ('' if header is None else '#include <%s>' % header, self.name)
 
+    probe_outputs = 3
+
+    def format_probe(self):
+        return textwrap.dedent('''
+            typedef %s type;
+            struct TEST { char c; type mem; } test;
+            fbuild_out[0] = (long)((char*)&test.mem - (char*)&test);
+            fbuild_out[1] = (long)sizeof(type);
+            fbuild_out[2] = (type)~3 < (type)0;
+        ''') % self.name
+
     def process_stdout(self, instance, stdout):
         stdout = stdout.split()
         alignment = int(stdout[0])
@@ -472,18 +555,20 @@ class struct_test(AbstractFieldDescriptor):
         else:
             header = '#include <%s>' % header
 
-        defs = []
-        for i, (type, member) in enumerate(self.members):
-            defs.append('%s arg_%d = arg.%s;' % (type, i, member))
-
         return textwrap.dedent('''
             %s
             int main() {
-                %s arg;
                 %s
                 return 0;
             }
-        ''') % (header, self.name, '\n    '.join(defs))
+        ''') % (header, self.format_probe().replace('\n', '\n    '))
+
+    def format_probe(self):
+        defs = ['%s arg;' % self.name]
+        for i, (type, member) in enumerate(self.members):
+            defs.append('%s arg_%d = arg.%s;' % (type, i, member))
+
+        return '\n'.join(defs)
 
     def process_stdout(self, instance, stdout):
         if self.stdout is None or self.stdout == stdout:
@@ -524,6 +609,9 @@ class variable_test(AbstractFieldDescriptor):
             }
         ''') % (header, self.name)
 
+    def format_probe(self):
+        return '%s;' % self.name
+
     def process_stdout(self, instance, stdout):
         if self.stdout is None or self.stdout == stdout:
             instance.ctx.logger.passed()
@@ -533,6 +621,187 @@ class variable_test(AbstractFieldDescriptor):
 
 # ------------------------------------------------------------------------------
 
+class _Batch:
+    """L{_Batch} runs all the probes of a L{Test} instance in one program,
+    instead of building and running a program for every probe. If the
+    program fails to build, the probes are split in half until the probes
+    that fail are found. If it crashes, the probes that didn't finish are
+    run again. A probe that is left on its own runs its normal test."""
+
+    def __init__(self, instance, header):
+        # Only refer to the instance weakly, so that the batch is forgotten
+        # along with it.
+        self._instance = weakref.ref(instance,
+            functools.partial(_forget_batch, id(instance)))
+        self.header = header
+        self.lock = threading.Lock()
+        self.results = None
+
+    @property
+    def instance(self):
+        return self._instance()
+
+    def stdout(self, field):
+        """Return what the field's test would have printed, or None if it
+        failed."""
+
+        # Let the scheduler run other tasks while another thread is running
+        # the batch, as that thread needs the scheduler to run its commands.
+        with self.instance.ctx.scheduler.interruptible():
+            self.lock.acquire()
+
+        try:
+            if self.results is None:
+                self.results = {}
+                self._run([f for f in self._fields() if f.batchable()])
+        finally:
+            self.lock.release()
+
+        try:
+            return self.results[field]
+        except KeyError:
+            # The field was added to the class after we ran the batch.
+            return field.run(self.instance, self.header)
+
+    def _fields(self):
+        for name, field in self.instance.fields():
+            if isinstance(field, cacheproperty) and \
+                    isinstance(field.method, AbstractFieldDescriptor):
+                yield field.method
+
+    def _run(self, fields):
+        if not fields:
+            return
+
+        if len(fields) == 1:
+            self.results[fields[0]] = fields[0].run(self.instance, self.header)
+            return
+
+        builder = self.instance.builder
+
+        try:
+            with builder.tempfile_link_exe(self._format(fields),
+                    quieter=1,
+                    **self.instance.lkwargs()) as exe:
+                # The probes call functions with zeroed arguments, so make
+                # sure reading from file descriptor 0 doesn't block.
+                try:
+                    with open(os.devnull, 'rb') as devnull:
+                        stdout, stderr = builder.run([exe],
+                            quieter=1,
+                            stdin=devnull)
+                except fbuild.ExecutionError as e:
+                    stdout = e.stdout or b''
+        except fbuild.ExecutionError:
+            # Some of the probes don't build, so split them up to find out
+            # which.
+            self._bisect(fields)
+            return
+
+        # Each probe prints a line when it starts, and another with its
+        # values when it passes. The program prints a last line if every
+        # probe returned, since a probe may exit without crashing.
+        started = -1
+        finished = False
+        for line in stdout.splitlines():
+            parts = line.split()
+            if len(parts) < 2 or parts[0] != b'@@fbuild':
+                continue
+
+            if parts[1] == b'done':
+                finished = True
+                continue
+
+            i = int(parts[1])
+            if len(parts) == 2:
+                started = i
+            elif parts[2] == b'ok':
+                self.results[fields[i]] = b''.join(
+                    part + b'\n' for part in parts[3:])
+
+        if finished:
+            for field in fields:
+                self.results.setdefault(field, None)
+            return
+
+        if started < 0:
+            self._bisect(fields)
+            return
+
+        # The program stopped early, so run the probe it stopped in by itself,
+        # and the probes after it in a new batch.
+        for field in fields[:started]:
+            self.results.setdefault(field, None)
+
+        if fields[started] not in self.results:
+            self._run(fields[started:started + 1])
+        self._run(fields[started + 1:])
+
+    def _bisect(self, fields):
+        half = len(fields) // 2
+        self._run(fields[:half])
+        self._run(fields[half:])
+
+    def _format(self, fields):
+        code = []
+        if self.header is not None:
+            code.append('#include <%s>' % self.header)
+
+        for i, field in enumerate(fields):
+            code.append('static int fbuild_probe_%d(long *fbuild_out) {' % i)
+            code.extend('    ' + line
+                for line in field.format_probe().strip().split('\n'))
+            code.append('    return 0;')
+            code.append('}')
+
+        # Include stdio.h after the probes so that they only see what the
+        # header declares.
+        code.append('#include <stdio.h>')
+        code.append('int main() {')
+        code.append('    long fbuild_out[3];')
+        for i, field in enumerate(fields):
+            formats = ' %ld' * field.probe_outputs
+            values = ''.join(', fbuild_out[%d]' % j
+                for j in range(field.probe_outputs))
+
+            code.append('    printf("@@fbuild %d\\n"); fflush(stdout);' % i)
+            code.append('    if (fbuild_probe_%d(fbuild_out) == 0) {' % i)
+            code.append('        printf("@@fbuild %d ok%s\\n"%s);' %
+                (i, formats, values))
+            code.append('        fflush(stdout);')
+            code.append('    }')
+        code.append('    printf("@@fbuild done\\n");')
+        code.append('    return 0;')
+        code.append('}')
+
+        return '\n'.join(code)
+
+
+# The batches of the L{Test} instances, by the id of the instance.
+_batches = {}
+_batches_lock = threading.Lock()
+
+def _find_batch(instance, header):
+    """Return the batch of probes for the instance."""
+
+    with _batches_lock:
+        batch = _batches.get(id(instance))
+        if batch is not None and batch.instance is instance and \
+                batch.header == header:
+            return batch
+
+        batch = _Batch(instance, header)
+        _batches[id(instance)] = batch
+        return batch
+
+def _forget_batch(key, ref):
+    """Forget the batch of an instance that was collected. The collection
+    can happen while L{_batches_lock} is held, so don't take it."""
+
+    _batches.pop(key, None)
+
+# ------------------------------------------------------------------------------
+
 class TestMeta(fbuild.config.TestMeta):
     def __call__(cls, builder, *args, **kwargs):
         result, srcs, objs = builder.ctx.db.call(cls.__call_super__, builder,
@@ -541,6 +810,7 @@ class TestMeta(fbuild.config.TestMeta):
         return result
 
 
+@fbuild.db.configures
 class Test(fbuild.config.Test, metaclass=TestMeta):
     def __init__(self, builder, *,
             platform=None,
@@ -560,7 +830,32 @@ class Test(fbuild.config.Test, metaclass=TestMeta):
         self.libs = list(libs)
         self.external_libs = list(external_libs)
 
+    def lkwargs(self):
+        """Return the arguments for linking the test programs."""
+
+        return {
+            'flags': self.flags,
+            'libpaths': self.libpaths,
+            'libs': self.libs,
+            'external_libs': self.external_libs}
+
+    def evaluate_all(self, names=None):
+        # The other fields need the header, so check it before running them
+        # concurrently.
+        getattr(self, 'header', None)
+
+        return super().evaluate_all(names)
+
+    def _evaluate_tests(self, descriptors):
+        """Evaluate the fields that are checked by the descriptors
+        concurrently."""
+
+        self.evaluate_all(name for name, field in self.fields()
+            if isinstance(field, cacheproperty) and
+                isinstance(field.method, descriptors))
+
     def functions(self):
+        self._evaluate_tests(function_test)
         for name, field in self.fields():
             if isinstance(field, cacheproperty):
                 if isinstance(field.method, function_test):
@@ -572,6 +867,7 @@ class Test(fbuild.config.Test, metaclass=TestMeta):
                     yield field.method.name, f
 
     def macros(self):
+        self._evaluate_tests(macro_test)
         for name, field in self.fields():
             if isinstance(field, cacheproperty):
                 if isinstance(field.method, macro_test):
@@ -583,6 +879,7 @@ class Test(fbuild.config.Test, metaclass=TestMeta):
                     yield field.method.name, f
 
     def types(self):
+        self._evaluate_tests((type_test, int_type_test))
         for name, field in self.fields():
             if isinstance(field, cacheproperty):
                 if isinstance(field.method, (type_test, int_type_test)):
@@ -594,6 +891,7 @@ class Test(fbuild.config.Test, metaclass=TestMeta):
                     yield field.method.name, f
 
     def int_types(self):
+        self._evaluate_tests(int_type_test)
         for name, field in self.fields():
             if isinstance(field, cacheproperty):
                 if isinstance(field.method, int_type_test):
@@ -605,6 +903,7 @@ class Test(fbuild.config.Test, metaclass=TestMeta):
                     yield field.method.name, f
 
     def structs(self):
+        self._evaluate_tests(struct_test)
         for name, field in self.fields():
             if isinstance(field, cacheproperty):
                 if isinstance(field.method, struct_test):
@@ -616,6 +915,7 @@ class Test(fbuild.config.Test, metaclass=TestMeta):
                     yield field.method.name, f
 
     def variables(self):
+        self._evaluate_tests(variable_test)
         for name, field in self.fields():
             if isinstance(field, cacheproperty):
                 if isinstance(field.method, variable_test):
@@ -8,10 +8,18 @@ import collections
 import fbuild
 import fbuild.builders.platform
 import fbuild.console
+import fbuild.cutoff
+import fbuild.db.config_cache
 import fbuild.db.database
+import fbuild.db.remote_cache
+import fbuild.digest
+import fbuild.jobserver
+import fbuild.objcache
 import fbuild.sched
 import fbuild.subprocess.killableprocess
 import fbuild.temp
+import fbuild.trace
+import fbuild.worker
 
 from fbuild.path import Path
 
@@ -39,17 +47,77 @@ class Context:
         options.state_file = options.buildroot / options.state_file
         options.log_file = options.buildroot / options.log_file
 
+        self.tracer = fbuild.trace.Tracer(options.trace)
+
+        # Run enough jobs at once to keep all the workers busy.
+        if options.workers:
+            self.distributor = fbuild.worker.Distributor(
+                options.workers.split(','))
+            options.threadcount = max(options.threadcount,
+                self.distributor.slots())
+        else:
+            self.distributor = None
+
         self.logger = fbuild.console.Log(
             verbose=options.verbose,
             nocolor=options.nocolor or options.no_color,
             threadcount=options.threadcount,
             show_threads=options.show_threads)
 
+        if self.distributor is not None:
+            self.distributor.logger = self.logger
+
+        # The digest algorithm has to be set before the database is loaded.
+        fbuild.digest.set_default_algorithm(options.digest)
+
+        if options.remote_cache:
+            self.remote_cache = fbuild.db.remote_cache.make_remote_cache(
+                options.remote_cache,
+                logger=self.logger)
+        else:
+            self.remote_cache = None
+
+        if options.config_cache:
+            self.config_cache = fbuild.db.config_cache.ConfigCache(
+                options.config_cache,
+                logger=self.logger)
+        else:
+            self.config_cache = None
+
         self.db = fbuild.db.database.Database(self,
             engine=options.database_engine,
-            explain=options.explain_database)
+            explain=options.explain_database,
+            concurrent=options.concurrent_database,
+            fast=options.fast_database,
+            remote_cache=self.remote_cache,
+            config_cache=self.config_cache)
+        if options.jobserver:
+            if os.name != 'posix':
+                raise fbuild.Error('the jobserver is only supported on posix')
+            self.jobserver = fbuild.jobserver.JobServer(options.threadcount)
+        else:
+            self.jobserver = None
+
+        if options.object_cache:
+            self.object_cache = fbuild.objcache.ObjectCache(
+                options.object_cache,
+                options.object_cache_size << 20,
+                logger=self.logger)
+        else:
+            self.object_cache = None
+
+        if options.early_cutoff:
+            self.early_cutoff = fbuild.cutoff.EarlyCutoff(logger=self.logger)
+        else:
+            self.early_cutoff = None
+
         self.scheduler = fbuild.sched.Scheduler(options.threadcount,
-            logger=self.logger)
+            logger=self.logger,
+            locked=options.scheduler_locked,
+            history=self.db,
+            jobserver=self.jobserver,
+            tracer=self.tracer,
+            context=self.db.call_context)
 
         self.options = options
 
@@ -116,8 +184,10 @@ class Context:
             env=None,
             runtime_libpaths=None,
             ignore_error=False,
+            jobserver=False,
             **kwargs):
-        """Execute the command and return the output."""
+        """Execute the command and return the output. If I{jobserver} is
+        true, a make run by the command shares our job slots."""
 
         if isinstance(cmd, str):
             cmd_string = cmd
@@ -143,6 +213,12 @@ class Context:
         else:
             env = dict(os.environ, **env)
 
+        # Let the make we run share our job slots.
+        if jobserver and self.jobserver is not None:
+            self.jobserver.update_environ(env)
+            kwargs['pass_fds'] = tuple(kwargs.get('pass_fds', ())) + \
+                self.jobserver.fds
+
         # Add in the runtime library search paths.
         if runtime_libpaths:
             # Look up the current architecture
@@ -192,31 +268,41 @@ class Context:
             # Set the timer to None for now to make sure it's defined.
             timer = None
 
+        # Name the trace of the command after the program we run.
+        span = self.tracer.span(
+            os.path.basename(cmd.split()[0] if isinstance(cmd, str) else cmd[0]),
+            'execute',
+            cmd=cmd_string)
+
         starttime = time.time()
         try:
-            p = fbuild.subprocess.killableprocess.Popen(cmd,
-                stdin=fbuild.subprocess.PIPE if input else stdin,
-                stdout=stdout,
-                stderr=stderr,
-                env=env,
-                **kwargs)
-
-            try:
-                if timeout:
-                    timer = threading.Timer(timeout, timeout_function, (p,))
-                    timer.start()
-
-                with self.scheduler.interruptible():
-                    stdout, stderr = p.communicate(input)
-                    returncode = p.wait()
-            except KeyboardInterrupt:
-                # Make sure if we get a keyboard interrupt to kill the process.
-                p.kill(group=True, sigint=True)
-                raise
-            else:
-                # Detect Ctrl-C in subprocess.
-                if returncode == -signal.SIGINT:
-                    raise KeyboardInterrupt
+            with span:
+                p = fbuild.subprocess.killableprocess.Popen(cmd,
+                    stdin=fbuild.subprocess.PIPE if input else stdin,
+                    stdout=stdout,
+                    stderr=stderr,
+                    env=env,
+                    **kwargs)
+
+                try:
+                    if timeout:
+                        timer = threading.Timer(timeout, timeout_function, (p,))
+                        timer.start()
+
+                    with self.scheduler.interruptible():
+                        stdout, stderr = p.communicate(input)
+                        returncode = p.wait()
+                except KeyboardInterrupt:
+                    # Make sure if we get a keyboard interrupt to kill the
+                    # process.
+                    p.kill(group=True, sigint=True)
+                    raise
+                else:
+                    span.args['returncode'] = returncode
+
+                    # Detect Ctrl-C in subprocess.
+                    if returncode == -signal.SIGINT:
+                        raise KeyboardInterrupt
         except OSError as e:
             # flush the logger
             self.logger.log('command failed: ' + cmd_string, color='red')
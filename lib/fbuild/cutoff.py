@@ -0,0 +1,41 @@
+import threading
+
+# ------------------------------------------------------------------------------
+
+class EarlyCutoff:
+    """
+    Counts the compiles that were skipped because the preprocessed source
+    didn't change. A header change makes every source that includes it dirty,
+    even if the change was a comment or to code the source doesn't use, so
+    the builders digest the preprocessed source, without line markers, and
+    only compile the source if that digest differs from the one it was
+    compiled from last time.
+    """
+
+    def __init__(self, *, logger=None):
+        self.logger = logger
+        self.saved = {}
+        self.compiled = {}
+        self._lock = threading.Lock()
+
+    def record(self, builder, saved):
+        """Record whether the builder skipped a compile."""
+
+        name = str(builder)
+
+        with self._lock:
+            counts = self.saved if saved else self.compiled
+            counts[name] = counts.get(name, 0) + 1
+
+    def close(self):
+        """Report how many compiles each builder saved."""
+
+        if self.logger is None:
+            return
+
+        for name in sorted(set(self.saved) | set(self.compiled)):
+            self.logger.check(' * early cutoff %s' % name,
+                '%d saved, %d compiled' % (
+                    self.saved.get(name, 0),
+                    self.compiled.get(name, 0)),
+                color='yellow')
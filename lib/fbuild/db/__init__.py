@@ -53,6 +53,16 @@ class SRCS(SRC):
         return srcs
 
 
+class INTERFACE_SRCS(SRCS):
+    """An annotation that's used to designate an argument as a list of source
+    paths, such as shared libraries, that may carry an I{interface} file. The
+    call depends on the interface rather than the path, so it isn't rerun
+    when only the implementation changes."""
+    @staticmethod
+    def convert(srcs):
+        return [getattr(src, 'interface', None) or src for src in srcs]
+
+
 class DST:
     """An annotation that's used to designate an argument is a destination
     path."""
@@ -265,3 +275,19 @@ class cacheproperty:
         _check_ctx(instance.ctx, instance.__class__.__name__,
                    'cache<member>.call')
         return instance.ctx.db.call(types.MethodType(self.method, instance))
+
+# ------------------------------------------------------------------------------
+
+def configures(obj):
+    """L{configures} marks a cached function, or a L{PersistentObject} class,
+    as configuring the build. The result of a call must only depend on its
+    arguments and the programs they run, so that the config cache can share
+    the result with other projects."""
+
+    obj.__fbuild_config__ = True
+
+    # The database calls the function that caches wraps.
+    if isinstance(obj, caches):
+        obj.function.__fbuild_config__ = True
+
+    return obj
@@ -1,7 +1,14 @@
+import collections
+import concurrent.futures
+import hashlib
 import io
+import os
 import pickle
+import threading
 import time
+import types
 
+import fbuild.digest
 from fbuild.path import Path
 
 # ------------------------------------------------------------------------------
@@ -12,6 +19,9 @@ class Backend:
 
     def __init__(self, ctx):
         self._ctx = ctx
+        self._functions_lock = threading.Lock()
+        self._forget_functions()
+        self._seen_task_keys = set()
 
     def version(self):
         """Return a string detailing the database specification version used."""
@@ -19,13 +29,17 @@ class Backend:
 
     @classmethod
     def latest_version(self):
-        """Return a string detailing the latest database specification version."""
-        return self._LATEST_VERSION
+        """Return a string detailing the latest database specification version.
+        This includes the digest algorithm, since the stored digests can't be
+        compared with digests made by another algorithm."""
+        return '%s:%s' % (self._LATEST_VERSION,
+            fbuild.digest.default_algorithm())
 
     # --------------------------------------------------------------------------
 
     def connect(self, *args, **kwargs):
         """Connect to the database."""
+        self._forget_functions()
         self._connect(*args, **kwargs)
         if self._file_name is not None and self.version() != self.latest_version():
             # Database cache spec has been updated in the mean time, so re-create it.
@@ -33,6 +47,9 @@ class Backend:
             self._file_name.remove()
             self._connect(*args, **kwargs)
 
+        # Only the durations of the tasks that run from now on are kept.
+        self._seen_task_keys = set()
+
     def _connect(self, *args, **kwargs):
         """Connect to the database (backend implementation)."""
         raise NotImplementedError
@@ -58,18 +75,24 @@ class Backend:
         else:
             call_dirty, call_id, old_result = self.find_call(fun_id, bound)
 
-        # Add the source files to the database. We always run this because it
-        # adds our call files to the database for us.
-        call_file_digests = self.check_call_files(call_id, srcs)
-
-        # Check extra external call files.
+        # Look up the extra external call files.
         if call_id is None:
             external_srcs = frozenset()
             external_dsts = frozenset()
-            external_digests = ()
         else:
-            external_srcs, external_dsts, external_digests = \
-                self.check_external_files(call_id)
+            external_srcs = self.find_external_srcs(call_id)
+            external_dsts = self.find_external_dsts(call_id)
+
+        # Add the source files to the database. We always run this because it
+        # adds our call files to the database for us. The external sources are
+        # checked in the same batch, but they may since have been removed.
+        files = self.add_files(srcs, external_srcs)
+
+        call_file_digests = self.check_call_files(call_id, srcs, files)
+
+        # Check extra external call files.
+        external_digests = self.check_external_files(call_id, external_srcs,
+            files)
 
         return (
             fun_dirty,
@@ -118,31 +141,129 @@ class Backend:
 
     def check_function(self, fun_name, already_checked=None):
         """Returns whether or not the function is dirty. Returns True or false
-        as well as the function's digest."""
+        as well as the function's id.
+
+        The answers are remembered until the function, or one of the functions
+        it depends on, is saved or deleted, so every function is only checked
+        once per session rather than once per call."""
 
         # Work around a circular import.
         from fbuild.db.database import Database
 
+        records = self._load_functions()
+
+        try:
+            return self._checked_functions[fun_name]
+        except KeyError:
+            pass
+
         if already_checked is None:
             already_checked = set()
         already_checked.add(fun_name)
 
         fun_digest = Database.get_function_digest_from_map(fun_name)
-        fun_id, old_digest, fun_dependents = self.find_function(fun_name)
+        fun_id, old_digest, fun_dependents = records.get(fun_name,
+            (None, None, ()))
 
         # Has the function changed?
         fun_dirty = old_digest is None or fun_digest != old_digest
         if not fun_dirty:
             # Have any of it's dependents changed?
             for dep in set(fun_dependents) - already_checked:
-                dep_dirty, _ = self.check_function(dep)
+                dep_dirty, _ = self.check_function(dep, already_checked)
                 if dep_dirty:
                     fun_dirty = True
                     break
 
+        with self._functions_lock:
+            self._checked_functions.setdefault(fun_name, (fun_dirty, fun_id))
+
+            # Everything that depends on a dirty function is dirty as well.
+            if fun_dirty:
+                # Replace any earlier answer, as a dependent in a cycle may
+                # have been checked before we knew.
+                for dependent in self._find_dependents(fun_name):
+                    self._checked_functions[dependent] = \
+                        (True, records[dependent][0])
+
         return fun_dirty, fun_id
 
 
+    def _forget_functions(self):
+        """Forget the functions we've loaded and checked."""
+
+        with self._functions_lock:
+            self._function_records = None
+            self._function_dependents = None
+            self._checked_functions = {}
+
+
+    def _load_functions(self):
+        """Load all the function records, and index which functions depend on
+        each of them."""
+
+        records = self._function_records
+        if records is not None:
+            return records
+
+        records = self.find_functions()
+
+        with self._functions_lock:
+            if self._function_records is None:
+                self._function_records = records
+                self._function_dependents = collections.defaultdict(set)
+                for fun_name, (_, _, fun_dependents) in records.items():
+                    for dep in fun_dependents:
+                        self._function_dependents[dep].add(fun_name)
+
+            return self._function_records
+
+
+    def _find_dependents(self, fun_name):
+        """Return every function that depends on the function, directly or
+        through other functions. The functions lock must be held."""
+
+        dependents = set()
+        stack = [fun_name]
+        while stack:
+            for dependent in self._function_dependents.get(stack.pop(), ()):
+                if dependent not in dependents and dependent != fun_name:
+                    dependents.add(dependent)
+                    stack.append(dependent)
+
+        return dependents
+
+
+    def _function_changed(self, fun_name, record):
+        """Update the loaded function records after the function was saved,
+        or deleted if I{record} is None. The function and every function that
+        depends on it have to be checked again."""
+
+        with self._functions_lock:
+            if self._function_records is None:
+                return
+
+            old_record = self._function_records.pop(fun_name, None)
+            if old_record is not None:
+                for dep in old_record[2]:
+                    self._function_dependents[dep].discard(fun_name)
+
+            if record is not None:
+                self._function_records[fun_name] = record
+                for dep in record[2]:
+                    self._function_dependents[dep].add(fun_name)
+
+            self._checked_functions.pop(fun_name, None)
+            for dependent in self._find_dependents(fun_name):
+                self._checked_functions.pop(dependent, None)
+
+
+    def find_functions(self):
+        """Returns a dictionary of the function names to their ids, digests
+        and dependents."""
+        raise NotImplementedError
+
+
     def find_function(self, fun_name):
         """Returns the function record or None if it does not exist."""
         raise NotImplementedError
@@ -161,7 +282,8 @@ class Backend:
 
     def find_call(self, fun_id, bound):
         """Returns the function call index and result or None if it does not
-        exist."""
+        exist. The result may be a L{PickledResult}, so it should be passed
+        through L{load_result} before it's used."""
         raise NotImplementedError
 
 
@@ -169,14 +291,29 @@ class Backend:
         """Insert or update the function call."""
         raise NotImplementedError
 
+
+    def load_result(self, result):
+        """Return the value of a result returned by L{find_call}, unpickling
+        it if it's still pickled. This doesn't use the database, so it can be
+        called from any thread."""
+
+        if isinstance(result, PickledResult):
+            return result.load(lambda data: pickle_loads(self._ctx, data))
+        return result
+
     # --------------------------------------------------------------------------
 
-    def check_call_files(self, call_id, file_names):
-        """Returns all of the dirty call files."""
+    def check_call_files(self, call_id, file_names, files=None):
+        """Returns all of the dirty call files. I{files} is the result of
+        L{add_files} if the files were already added to the database."""
+
+        if files is None:
+            files = self.add_files(file_names)
 
         digests = set()
         for file_name in file_names:
-            d, file_id, file_digest = self.check_call_file(call_id, file_name)
+            d, file_id, file_digest = self._check_call_file(call_id,
+                files[file_name])
             if d:
                 digests.add((file_id, file_name, file_digest))
 
@@ -198,7 +335,14 @@ class Backend:
         assert isinstance(file_name, str), file_name
 
         # Compute the digest of the file.
-        dirty, file_id, mtime, digest = self.add_file(file_name)
+        return self._check_call_file(call_id, self.add_file(file_name))
+
+
+    def _check_call_file(self, call_id, file_info):
+        """Returns if the call file is dirty and the file's digest, given the
+        result of L{add_file} for the file."""
+
+        dirty, file_id, file_stat, digest = file_info
 
         # Exit early if we don't have a valid call_id.
         if call_id is None:
@@ -228,30 +372,28 @@ class Backend:
 
     # --------------------------------------------------------------------------
 
-    def check_external_files(self, call_id):
-        """Returns all of the externally specified call files, and the dirty
-        list."""
+    def check_external_files(self, call_id, srcs, files):
+        """Returns the dirty externally specified call src files. I{files} is
+        the result of L{add_files}, which leaves out the sources that no
+        longer exist."""
 
         # Do nothing if we don't have a valid call.
         if call_id is None:
-            srcs = frozenset()
-            dsts = frozenset()
-            external_digests = ()
-        else:
-            srcs = self.find_external_srcs(call_id)
-            dsts = self.find_external_dsts(call_id)
+            return ()
 
-            external_digests = []
-            for src in srcs:
-                try:
-                    d, file_id, file_digest = self.check_call_file(call_id, src)
-                except OSError:
-                    pass
-                else:
-                    if d:
-                        external_digests.append((file_id, src, file_digest))
+        external_digests = []
+        for src in srcs:
+            try:
+                file_info = files[src]
+            except KeyError:
+                pass
+            else:
+                d, file_id, file_digest = self._check_call_file(call_id,
+                    file_info)
+                if d:
+                    external_digests.append((file_id, src, file_digest))
 
-        return srcs, dsts, external_digests
+        return external_digests
 
 
     def find_external_srcs(self, call_id):
@@ -277,27 +419,80 @@ class Backend:
         # Make sure we got the right types.
         assert isinstance(file_name, str), file_name
 
-        # Look up the old data.
-        file_id, old_mtime, old_digest = self.find_file(file_name)
+        return self.add_files((file_name,))[file_name]
+
 
-        # Now, create a path object and find it's mtime.
-        file_path = Path(file_name)
-        file_mtime = file_path.getmtime()
+    def add_files(self, file_names, optional_file_names=()):
+        """Insert or update the file information of many files at once.
+        Returns a dictionary that maps every file name to what L{add_file}
+        would return for it. Files in I{optional_file_names} that cannot be
+        read are left out of the dictionary."""
 
-        if old_mtime is not None:
-            # If the file was modified less than 1.0 seconds ago, recompute the
-            # hash since it still could have changed even with the same mtime.
-            # If True, then assume the file has not been modified.
-            if file_mtime == old_mtime and time.time() - file_mtime > 1.0:
-                return False, file_id, file_mtime, old_digest
+        required = set(file_names)
+        optional = set(optional_file_names) - required
 
-        # The mtime changed, so let's see if the content's changed.
-        digest = file_path.digest()
+        # Make sure we got the right types.
+        assert all(isinstance(f, str) for f in required), required
+        assert all(isinstance(f, str) for f in optional), optional
+
+        # Look up the old data.
+        old_files = {f: self.find_file(f) for f in required | optional}
+
+        # Stat all the files in one pass. Take the time first so we err on
+        # the side of recomputing the hash.
+        now_ns = int(time.time() * 1e9)
+        file_stats = _map_files(_stat_file, old_files)
+
+        results = {}
+        changed = []
+        for file_name, (file_id, old_stat, old_digest) in old_files.items():
+            file_stat = file_stats[file_name]
+            if isinstance(file_stat, OSError):
+                if file_name in required:
+                    raise file_stat
+                continue
+
+            # If nothing about the file changed, assume it has not been
+            # modified. We never save the stat of a file that could still
+            # change without changing its stat, so we can trust this.
+            if old_stat is not None and file_stat == old_stat:
+                results[file_name] = False, file_id, file_stat, old_digest
+                continue
+
+            changed.append(file_name)
+
+        # The stats changed, so let's see if the contents changed.
+        file_digests = _map_files(_digest_file, changed)
+
+        for file_name in changed:
+            digest = file_digests[file_name]
+            if isinstance(digest, OSError):
+                if file_name in required:
+                    raise digest
+                continue
+
+            file_stat = file_stats[file_name]
+            if _is_racy(file_stat, now_ns):
+                # The file was modified so recently that it could change again
+                # within the same timestamp. Don't save the stat so that we
+                # hash the file again next time.
+                file_stat = None
+
+            file_id, old_stat, old_digest = old_files[file_name]
+            results[file_name] = self._update_file(file_id, file_name,
+                file_stat, old_digest, digest)
+
+        return results
+
+
+    def _update_file(self, file_id, file_name, file_stat, old_digest, digest):
+        """Save the freshly computed digest of the file. Returns what
+        L{add_file} returns."""
 
         if digest == old_digest:
-            # Save the new mtime.
-            self.save_file(file_id, file_name, file_mtime, digest)
-            return False, file_id, file_mtime, digest
+            # Save the new stat.
+            self.save_file(file_id, file_name, file_stat, digest)
+            return False, file_id, file_stat, digest
 
         if file_id is not None:
             # Since the function changed, all of the calls that used this
@@ -308,20 +503,21 @@ class Backend:
             file_id = None
 
         # Now, add the file back to the database.
-        file_id = self.save_file(file_id, file_name, file_mtime, digest)
+        file_id = self.save_file(file_id, file_name, file_stat, digest)
 
         # Returns True since the file changed.
-        return True, file_id, file_mtime, digest
+        return True, file_id, file_stat, digest
 
 
     def find_file(self, file_name):
-        """Returns the file's old mtime and digest or None if it does not
+        """Returns the file's old L{FileStat} and digest or None if it does not
         exist."""
         raise NotImplementedError
 
 
-    def save_file(self, file_id, file_name, file_mtime, file_digest):
-        """Insert or update the file."""
+    def save_file(self, file_id, file_name, file_stat, file_digest):
+        """Insert or update the file. I{file_stat} is None if the stat can't
+        be trusted to detect changes to the file."""
         raise NotImplementedError
 
 
@@ -329,6 +525,143 @@ class Backend:
         """Remove the file from the database."""
         raise NotImplementedError
 
+    # --------------------------------------------------------------------------
+
+    def find_task_durations(self, task_keys):
+        """Returns a dictionary of how many seconds each of the scheduler's
+        tasks took the last time they ran. Tasks that never ran are left
+        out."""
+        raise NotImplementedError
+
+
+    def save_task_durations(self, durations):
+        """Insert or update how many seconds the scheduler's tasks took, and
+        forget the tasks that haven't run since we connected."""
+        raise NotImplementedError
+
+
+    def delete_task_durations(self, task_keys):
+        """Remove how long the tasks took from the database."""
+        raise NotImplementedError
+
+# ------------------------------------------------------------------------------
+
+# Batches with fewer files than this are handled on the calling thread.
+_PARALLEL_FILE_COUNT = 8
+
+# The most files from one directory a worker handles at a time.
+_FILE_CHUNK_SIZE = 64
+
+_file_pool = None
+_file_pool_lock = threading.Lock()
+
+def _get_file_pool():
+    """Return the thread pool used to stat and digest files. Both os.stat and
+    hashlib release the GIL, so the pool runs alongside the rest of the
+    build."""
+
+    global _file_pool
+
+    with _file_pool_lock:
+        if _file_pool is None:
+            _file_pool = concurrent.futures.ThreadPoolExecutor()
+        return _file_pool
+
+
+# The stat information we use to tell if a file changed without reading it.
+FileStat = collections.namedtuple('FileStat', 'mtime_ns size inode ctime_ns')
+
+# On filesystems with fine-grained timestamps, the timestamps are still only
+# updated once per clock tick, so a file modified more recently than this could
+# change again without changing its stat.
+_RACY_NS = 10 * 1000 * 1000
+
+def _stat_file(file_name):
+    st = os.stat(file_name)
+    return FileStat(st.st_mtime_ns, st.st_size, st.st_ino, st.st_ctime_ns)
+
+
+def _is_racy(file_stat, now_ns):
+    """Returns True if the file could still be modified without changing its
+    stat."""
+
+    changed_ns = max(file_stat.mtime_ns, file_stat.ctime_ns)
+
+    if changed_ns % 1000000000 == 0:
+        # The filesystem probably only has whole-second timestamps, or even
+        # two-second ones like FAT.
+        window = 2000000000
+    else:
+        window = _RACY_NS
+
+    return now_ns - changed_ns < window
+
+
+def _digest_file(file_name):
+    return Path(file_name).digest()
+
+
+def _map_files(function, file_names):
+    """Call I{function} on every file, and return a dictionary of the results.
+    Files in the same directory are handled together by one worker, and any
+    OSError raised for a file is returned in place of its result."""
+
+    def run(names):
+        results = []
+        for name in names:
+            try:
+                results.append((name, function(name)))
+            except OSError as e:
+                results.append((name, e))
+        return results
+
+    file_names = list(file_names)
+    if len(file_names) < _PARALLEL_FILE_COUNT:
+        return dict(run(file_names))
+
+    directories = collections.defaultdict(list)
+    for file_name in file_names:
+        directories[os.path.dirname(file_name)].append(file_name)
+
+    chunks = []
+    for names in directories.values():
+        for i in range(0, len(names), _FILE_CHUNK_SIZE):
+            chunks.append(names[i:i + _FILE_CHUNK_SIZE])
+
+    results = {}
+    for chunk in _get_file_pool().map(run, chunks):
+        results.update(chunk)
+
+    return results
+
+# ------------------------------------------------------------------------------
+
+_UNLOADED = object()
+
+class PickledResult:
+    """A call result that is kept pickled in the database, so that loading
+    the database doesn't have to unpickle the results of every call that was
+    ever made. It's unpickled the first time it's used, and only its pickled
+    data is saved."""
+
+    __slots__ = ('data', '_value')
+
+    def __init__(self, data, value=_UNLOADED):
+        self.data = data
+        self._value = value
+
+    def __reduce__(self):
+        return self.__class__, (self.data,)
+
+    def load(self, loads):
+        """Return the result, unpickling it with I{loads} if this is the first
+        time it's used."""
+
+        value = self._value
+        if value is _UNLOADED:
+            value = self._value = loads(self.data)
+        return value
+
 # ------------------------------------------------------------------------------
 
 class Pickler(pickle.Pickler):
@@ -359,6 +692,111 @@ class Unpickler(pickle.Unpickler):
                 pid)
 
 
+def digest_bound(ctx, bound):
+    """Compute a stable digest of the bound arguments of a call. Arguments
+    that compare equal produce the same digest across runs, so the digest can
+    be used as an index to find a previous call without comparing the
+    arguments against every call that has been made before."""
+
+    m = hashlib.md5()
+    _digest_value(ctx, m.update, bound, set())
+    return m.hexdigest()
+
+
+def _digest_value(ctx, update, obj, active):
+    """Feed a canonical encoding of I{obj} into I{update}."""
+
+    if obj is ctx:
+        update(b'x')
+        return
+
+    if obj is None:
+        update(b'n')
+        return
+
+    # Numbers that compare equal need to digest the same, so True, 1 and 1.0
+    # are all folded into the same integer encoding.
+    if isinstance(obj, (bool, int, float)):
+        if isinstance(obj, float) and not obj.is_integer():
+            update(b'f' + repr(obj).encode() + b';')
+        else:
+            update(b'i%d;' % int(obj))
+        return
+
+    if isinstance(obj, str):
+        s = obj.encode('utf-8', 'surrogatepass')
+        update(b's%d:' % len(s) + s)
+    elif isinstance(obj, (bytes, bytearray)):
+        update(b'b%d:' % len(obj) + bytes(obj))
+    elif isinstance(obj, (type, types.FunctionType, types.BuiltinFunctionType,
+            types.ModuleType)):
+        name = '%s.%s' % (
+            getattr(obj, '__module__', None),
+            getattr(obj, '__qualname__', obj.__name__))
+        update(b'g' + name.encode() + b';')
+        return
+
+    # Guard against recursive containers.
+    if id(obj) in active:
+        update(b'r')
+        return
+    active.add(id(obj))
+
+    try:
+        if isinstance(obj, str):
+            # Str subclasses, like Library, may carry extra attributes.
+            state = getattr(obj, '__dict__', None)
+            if state:
+                update(b'a')
+                _digest_value(ctx, update, type(obj), active)
+                _digest_value(ctx, update, state, active)
+        elif isinstance(obj, (bytes, bytearray)):
+            pass
+        elif isinstance(obj, (tuple, list)):
+            update((b't' if isinstance(obj, tuple) else b'l') +
+                b'%d:' % len(obj))
+            for item in obj:
+                _digest_value(ctx, update, item, active)
+        elif isinstance(obj, dict):
+            # Dictionaries and sets are unordered, so sort the digests of the
+            # items to get a canonical order.
+            items = []
+            for key, value in obj.items():
+                m = hashlib.md5()
+                _digest_value(ctx, m.update, key, active)
+                _digest_value(ctx, m.update, value, active)
+                items.append(m.digest())
+            items.sort()
+            update(b'd%d:' % len(items) + b''.join(items))
+        elif isinstance(obj, (set, frozenset)):
+            items = []
+            for item in obj:
+                m = hashlib.md5()
+                _digest_value(ctx, m.update, item, active)
+                items.append(m.digest())
+            items.sort()
+            update(b'e%d:' % len(items) + b''.join(items))
+        elif isinstance(obj, types.MethodType):
+            update(b'm')
+            _digest_value(ctx, update, obj.__self__, active)
+            _digest_value(ctx, update, obj.__func__, active)
+        elif hasattr(obj, '__dict__'):
+            # Objects, such as PersistentObjects, are compared by their state.
+            update(b'o')
+            _digest_value(ctx, update, type(obj), active)
+            _digest_value(ctx, update, obj.__dict__, active)
+        else:
+            # We don't know how these objects compare, and their repr may
+            # include their address, so only the type goes into the digest.
+            # The backends compare the arguments of the calls that share a
+            # digest, so equal objects still find their calls.
+            update(b'?')
+            _digest_value(ctx, update, type(obj), active)
+    finally:
+        active.discard(id(obj))
+
+# ------------------------------------------------------------------------------
+
 def pickle_dumps(ctx, obj):
     f = io.BytesIO()
     pickler = Pickler(ctx, f)
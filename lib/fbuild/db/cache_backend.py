@@ -3,30 +3,34 @@ import fbuild.db.backend
 # ------------------------------------------------------------------------------
 
 class CacheBackend(fbuild.db.backend.Backend):
-    _LATEST_VERSION = '1'
+    _LATEST_VERSION = '4'
 
     def _connect(self, filename=None):
         """Create the database cache (backend implementation)."""
 
         if not hasattr(self, '_file_name'):
             self._file_name = None
-        self._version = self._LATEST_VERSION
+        self._version = self.latest_version()
         self._functions = {}
         self._function_calls = {}
+        self._call_digests = {}
         self._files = {}
         self._call_files = {}
         self._external_srcs = {}
         self._external_dsts = {}
+        self._task_durations = {}
 
     def close(self):
         """Clear the database cache."""
 
         del self._functions
         del self._function_calls
+        del self._call_digests
         del self._files
         del self._call_files
         del self._external_srcs
         del self._external_dsts
+        del self._task_durations
 
     # --------------------------------------------------------------------------
 
@@ -50,6 +54,16 @@ class CacheBackend(fbuild.db.backend.Backend):
         return fun_id, fun_digest, fun_dependents
 
 
+    def find_functions(self):
+        """Returns a dictionary of the function names to their ids, digests
+        and dependents."""
+
+        # The name is the id.
+        return {fun_name: (fun_name, fun_digest, fun_dependents)
+            for fun_name, (fun_digest, fun_dependents)
+            in self._functions.items()}
+
+
     def save_function(self, fun_id, fun_name, fun_digest, fun_dependents):
         """Insert or update the function's digest."""
 
@@ -62,6 +76,8 @@ class CacheBackend(fbuild.db.backend.Backend):
         # We don't have separate code paths for existing and non-existing
         # functions.
         self._functions[fun_name] = (fun_digest, fun_dependents)
+        self._function_changed(fun_name,
+            (fun_name, fun_digest, fun_dependents))
 
         # The name is the id.
         return fun_name
@@ -90,6 +106,13 @@ class CacheBackend(fbuild.db.backend.Backend):
         else:
             function_existed |= True
 
+        try:
+            del self._call_digests[fun_name]
+        except KeyError:
+            pass
+        else:
+            function_existed |= True
+
         try:
             del self._external_srcs[fun_name]
         except KeyError:
@@ -129,6 +152,8 @@ class CacheBackend(fbuild.db.backend.Backend):
             else:
                 function_existed |= True
 
+        self._function_changed(fun_name, None)
+
         return function_existed
 
     # --------------------------------------------------------------------------
@@ -143,12 +168,16 @@ class CacheBackend(fbuild.db.backend.Backend):
 
         try:
             datas = self._function_calls[fun_id]
+            call_digests = self._call_digests[fun_id]
         except KeyError:
             return True, None, None
 
-        # We've called this before, so search the data to see if we've called
-        # it with the same arguments.
-        for call_index, (old_bound, old_result) in enumerate(datas):
+        # We've called this before, so look up the calls that were made with
+        # arguments that have the same digest, and check if any of them were
+        # called with the same arguments.
+        call_digest = fbuild.db.backend.digest_bound(self._ctx, bound)
+        for call_index in call_digests.get(call_digest, ()):
+            old_bound, old_result = datas[call_index]
             if bound == old_bound:
                 # We've found a matching call so just return the index.
                 return False, (fun_id, call_index), old_result
@@ -182,6 +211,7 @@ class CacheBackend(fbuild.db.backend.Backend):
             # The function be new or may have been deleted. So ignore the
             # call_id and just create a new list.
             self._function_calls[fun_id] = [(bound, result)]
+            self._call_digests[fun_id] = {}
 
             call_index = 0
         else:
@@ -189,7 +219,15 @@ class CacheBackend(fbuild.db.backend.Backend):
                 datas.append((bound, result))
                 call_index = len(datas) - 1
             else:
+                # The arguments are unchanged, so the digest index is still
+                # valid.
                 datas[call_index] = (bound, result)
+                return (fun_id, call_index)
+
+        # Index the new call by the digest of its arguments.
+        call_digest = fbuild.db.backend.digest_bound(self._ctx, bound)
+        self._call_digests.setdefault(fun_id, {}). \
+            setdefault(call_digest, []).append(call_index)
 
         return (fun_id, call_index)
 
@@ -291,47 +329,59 @@ class CacheBackend(fbuild.db.backend.Backend):
         srcs = frozenset(srcs)
         dsts = frozenset(dsts)
 
-        self._external_srcs.setdefault(fun_name, {})[call_index] = srcs
-        self._external_dsts.setdefault(fun_name, {})[call_index] = dsts
+        self._save_external_file_names(call_id, srcs, dsts)
+
+        files = self.add_files(srcs)
 
         external_digests = []
         for src in srcs:
-            dirty, file_id, mtime, digest = self.add_file(src)
+            dirty, file_id, file_stat, digest = files[src]
             external_digests.append((file_id, src, digest))
 
         self.save_call_files(call_id, external_digests)
 
+
+    def _save_external_file_names(self, call_id, srcs, dsts):
+        """Insert or update the names of the externally specified call
+        files."""
+
+        fun_name, call_index = call_id
+
+        self._external_srcs.setdefault(fun_name, {})[call_index] = srcs
+        self._external_dsts.setdefault(fun_name, {})[call_index] = dsts
+
     # --------------------------------------------------------------------------
 
     def find_file(self, file_name):
-        """Returns the mtime and digest of the file, or None if it does not
+        """Returns the stat and digest of the file, or None if it does not
         exist."""
 
         # Make sure we got the right types.
         assert isinstance(file_name, str), file_name
 
         try:
-            file_mtime, file_digest = self._files[file_name]
+            file_stat, file_digest = self._files[file_name]
         except KeyError:
-            file_mtime = None
+            file_stat = None
             file_digest = None
 
         # We'll return the file_name as the file_id.
-        return file_name, file_mtime, file_digest
+        return file_name, file_stat, file_digest
 
 
-    def save_file(self, file_id, file_name, file_mtime, file_digest):
+    def save_file(self, file_id, file_name, file_stat, file_digest):
         """Insert or update the file."""
 
         # Make sure we got the right types.
         assert file_id is file_name or file_id is None, (file_id, file_name)
         assert isinstance(file_name, str), file_name
-        assert isinstance(file_mtime, float), file_mtime
+        assert isinstance(file_stat, fbuild.db.backend.FileStat) or \
+            file_stat is None, file_stat
         assert isinstance(file_digest, str), file_digest
 
         # We don't have separate code paths for existing and non-existing
         # files.
-        self._files[file_name] = (file_mtime, file_digest)
+        self._files[file_name] = (file_stat, file_digest)
 
         # We'll return the file_name as the file_id.
         return file_name
@@ -360,3 +410,44 @@ class CacheBackend(fbuild.db.backend.Backend):
             file_existed |= True
 
         return file_existed
+
+    # --------------------------------------------------------------------------
+
+    def find_task_durations(self, task_keys):
+        """Returns a dictionary of how many seconds each of the scheduler's
+        tasks took the last time they ran. Tasks that never ran are left
+        out."""
+
+        durations = {}
+        for task_key in task_keys:
+            try:
+                durations[task_key] = self._task_durations[task_key]
+            except KeyError:
+                pass
+
+        return durations
+
+
+    def save_task_durations(self, durations):
+        """Insert or update how many seconds the scheduler's tasks took, and
+        forget the tasks that haven't run since we connected."""
+
+        # Make sure we got the right types.
+        assert all(isinstance(k, str) for k in durations), durations
+
+        self._seen_task_keys.update(durations)
+        self._task_durations.update(durations)
+
+        # Otherwise the tasks of sources that were deleted or renamed are kept
+        # forever.
+        stale = [task_key for task_key in self._task_durations
+            if task_key not in self._seen_task_keys]
+        if stale:
+            self.delete_task_durations(stale)
+
+
+    def delete_task_durations(self, task_keys):
+        """Remove how long the tasks took from the database."""
+
+        for task_key in task_keys:
+            self._task_durations.pop(task_key, None)
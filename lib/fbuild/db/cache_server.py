@@ -0,0 +1,144 @@
+"""
+A small reference server for L{fbuild.db.remote_cache.HTTPRemoteCache}, which
+keeps the cache in a local directory. It's meant for tests and for trying out
+the remote cache, rather than for serving a whole build farm:
+
+    python3 -m fbuild.db.cache_server --port 8080 cache-dir
+"""
+
+import argparse
+import hashlib
+import http.server
+import os
+import re
+import socketserver
+import threading
+
+# ------------------------------------------------------------------------------
+
+# Keys and digests are always hex, which also keeps requests from escaping
+# the cache directory.
+_NAME = re.compile(r'[0-9a-f]{8,128}\Z')
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    # Keep connections alive so that the clients can reuse them.
+    protocol_version = 'HTTP/1.1'
+
+    def _find(self):
+        """Return the kind, name and file of the request's path, or Nones if
+        the path isn't valid."""
+
+        parts = self.path.split('/')
+        if len(parts) != 3 or parts[0] != '' or parts[1] not in ('ac', 'cas') \
+                or not _NAME.match(parts[2]):
+            return None, None, None
+
+        kind, name = parts[1:]
+        return kind, name, os.path.join(self.server.root, kind, name[:2],
+            name[2:])
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _respond(self, status, body=b''):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        kind, name, path = self._find()
+        if path is None:
+            self._respond(400)
+            return
+
+        try:
+            with open(path, 'rb') as f:
+                body = f.read()
+        except FileNotFoundError:
+            self._respond(404)
+        else:
+            self._respond(200, body)
+
+    def do_PUT(self):
+        kind, name, path = self._find()
+        body = self._read_body()
+        if path is None:
+            self._respond(400)
+            return
+
+        # Files are addressed by their contents, so don't store bad ones.
+        if kind == 'cas' and hashlib.sha256(body).hexdigest() != name:
+            self._respond(400)
+            return
+
+        # Write to a temporary file first so that a concurrent GET never
+        # sees a partially written file.
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '%s.%d.tmp' % (path, threading.get_ident())
+        with open(tmp, 'wb') as f:
+            f.write(body)
+        os.replace(tmp, path)
+
+        self._respond(201)
+
+    def do_POST(self):
+        body = self._read_body()
+        if self.path != '/cas/contains':
+            self._respond(400)
+            return
+
+        found = []
+        for digest in body.decode().split():
+            if _NAME.match(digest) and os.path.exists(os.path.join(
+                    self.server.root, 'cas', digest[:2], digest[2:])):
+                found.append(digest)
+
+        self._respond(200, '\n'.join(found).encode())
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class CacheServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """Serve the cache in the I{root} directory at the address."""
+
+    daemon_threads = True
+
+    def __init__(self, root, address=('localhost', 0), *, verbose=False):
+        self.root = root
+        self.verbose = verbose
+        super().__init__(address, _Handler)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+# ------------------------------------------------------------------------------
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Serve a remote cache for fbuild builds.')
+    parser.add_argument('root', help='the directory to keep the cache in')
+    parser.add_argument('--host', default='localhost',
+                        help='the address to listen on (default: localhost)')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='the port to listen on (default: 8080)')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False,
+                        help='log every request')
+    options = parser.parse_args(argv)
+
+    server = CacheServer(options.root, (options.host, options.port),
+        verbose=options.verbose)
+    print('serving %s at %s' % (options.root, server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
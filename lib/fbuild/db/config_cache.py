@@ -0,0 +1,297 @@
+import os
+import subprocess
+import threading
+import types
+
+import fbuild.db.backend
+from fbuild.path import Path
+
+# ------------------------------------------------------------------------------
+
+def default_root():
+    """Return the directory the config cache is kept in by default."""
+
+    cache_home = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return Path(cache_home, 'fbuild', 'config')
+
+# ------------------------------------------------------------------------------
+
+class ConfigCache:
+    """
+    A cache of configuration results that is shared by every project of a
+    user. Calls to functions and classes marked with L{fbuild.db.configures},
+    such as finding programs, creating builders and the L{fbuild.config.c}
+    tests, only depend on their arguments and on the toolchain, so a project
+    can reuse the result another project found rather than probing the
+    compiler again.
+
+    Calls are stored by the digest of the function, the arguments and the
+    fingerprint of every program the arguments use, which is the digest of the
+    program, what it prints for I{--version} and where it searches for
+    headers and libraries. Changing a compiler changes the keys of all the
+    calls that used it. Relative search paths are resolved against the
+    project, so projects with their own headers don't share results. Entries
+    are never changed once they are written, so projects only ever read
+    what's there and add the calls that are missing. Failed probes aren't
+    shared, as installing a package makes them succeed without changing the
+    toolchain.
+    """
+
+    def __init__(self, root, *, logger=None):
+        self.root = Path(root)
+        self.logger = logger
+        self.hits = 0
+        self.misses = 0
+        self._programs = {}
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return self.root / key[:2] / key[2:]
+
+    def digest_call(self, ctx, fun_name, fun_digest, function, bound):
+        """Compute the key of the call, or return None if the call can't be
+        shared because a program it uses can't be found."""
+
+        programs = set()
+        search_paths = set()
+        _find_programs(ctx, bound, programs, search_paths, set())
+
+        try:
+            fingerprints = {exe: self._fingerprint(exe, args)
+                for exe, args in programs}
+        except OSError:
+            return None
+
+        # Config tests share the function that runs them, so the descriptor
+        # itself tells the tests apart.
+        if isinstance(function, types.MethodType):
+            function = function.__func__
+
+        return fbuild.db.backend.digest_bound(ctx, {
+            'fun_name': fun_name,
+            'fun_digest': fun_digest,
+            'function': function,
+            'bound': bound,
+            'programs': fingerprints,
+            'search_paths': sorted(search_paths),
+            # Programs are found by searching the path, and compilers also
+            # search these.
+            'environ': {name: os.environ.get(name)
+                for name in ('PATH',) + _SEARCH_PATH_VARIABLES},
+        })
+
+    def _fingerprint(self, exe, args):
+        """Return the digest and version of the program, and what it prints
+        for the I{args}, which are only recomputed when the program
+        changes."""
+
+        st = os.stat(exe)
+
+        with self._lock:
+            try:
+                stamp, fingerprint = self._programs[exe, args]
+            except KeyError:
+                pass
+            else:
+                if stamp == (st.st_mtime, st.st_size):
+                    return fingerprint
+
+        fingerprint = (Path(exe).digest(), _run(exe, ('--version',)),
+            _run(exe, args) if args else None)
+
+        with self._lock:
+            self._programs[exe, args] = ((st.st_mtime, st.st_size),
+                fingerprint)
+
+        return fingerprint
+
+    def find_call(self, ctx, key, external_srcs, function_digest):
+        """Return whether the call stored under the key was found and its
+        result. The external srcs of the call are added to
+        I{external_srcs}. I{function_digest} is used to look up the current
+        digests of the functions the call made."""
+
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                record = fbuild.db.backend.pickle_loads(ctx, f.read())
+
+            # The program the call found changed, or one was installed ahead
+            # of it on the path, so the entry is wrong for every project.
+            if any(_stamp(name) != stamp
+                    for name, stamp in record.get('stamps', {}).items()):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                raise LookupError(key)
+
+            found = all(function_digest(fun_name) == digest
+                for fun_name, digest in record['dependents'].items()) and \
+                all(Path(src).digest() == digest
+                    for src, digest in record['external_srcs'].items())
+        except Exception:
+            # A missing or unreadable entry, or one that refers to functions
+            # or files that no longer exist, is a miss.
+            found = False
+
+        with self._lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if not found:
+            return False, None
+
+        external_srcs.update(record['external_srcs'])
+        return True, record['result']
+
+    def save_call(self, ctx, key, result, dependents, external_srcs):
+        """Store the call under the key, unless another project already has.
+        I{dependents} maps the functions the call made to their digests."""
+
+        # A probe that failed may pass once a package is installed.
+        if result is None or result is False:
+            return
+
+        path = self._path(key)
+        if path.exists():
+            return
+
+        try:
+            data = fbuild.db.backend.pickle_dumps(ctx, {
+                'result': result,
+                'dependents': dependents,
+                'external_srcs': {src: Path(src).digest()
+                    for src in external_srcs},
+                'stamps': _program_stamps(result),
+            })
+        except Exception:
+            # Skip results that can't be pickled.
+            return
+
+        # Write to a temporary file first so that another project never sees
+        # a partially written entry.
+        tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        try:
+            path.parent.makedirs()
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+    def close(self):
+        """Report how well the cache worked."""
+
+        if self.logger is not None and (self.hits or self.misses):
+            self.logger.check(' * config cache',
+                '%d hits, %d misses' % (self.hits, self.misses),
+                color='yellow')
+
+# ------------------------------------------------------------------------------
+
+# The environment variables the compilers find headers and libraries with.
+_SEARCH_PATH_VARIABLES = ('CPATH', 'C_INCLUDE_PATH', 'CPLUS_INCLUDE_PATH',
+    'OBJC_INCLUDE_PATH', 'LIBRARY_PATH', 'INCLUDE', 'LIB', 'SDKROOT')
+
+# The attributes and arguments that hold header and library search paths.
+_SEARCH_PATHS = ('includes', 'libpaths')
+
+def _find_programs(ctx, obj, programs, search_paths, active):
+    """Add the programs that the tools in I{obj}, such as
+    L{fbuild.builders.c.gcc.Gcc}, run to I{programs}, and the relative search
+    paths they use, made absolute, to I{search_paths}. Tools keep their
+    program in their I{exe} attribute, and the arguments that make it print
+    where it searches, such as its sysroot, in I{search_dirs_flags}."""
+
+    if obj is ctx or isinstance(obj, (str, bytes, int, float, type(None),
+            type, types.FunctionType, types.ModuleType)):
+        return
+
+    if id(obj) in active:
+        return
+    active.add(id(obj))
+
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            if key in _SEARCH_PATHS:
+                _add_search_paths(value, search_paths)
+            _find_programs(ctx, value, programs, search_paths, active)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for value in obj:
+            _find_programs(ctx, value, programs, search_paths, active)
+    elif isinstance(obj, types.MethodType):
+        _find_programs(ctx, obj.__self__, programs, search_paths, active)
+    elif hasattr(obj, '__dict__'):
+        exe = obj.__dict__.get('exe')
+        if isinstance(exe, str):
+            programs.add((Path(exe).abspath(),
+                tuple(getattr(obj, 'search_dirs_flags', ()))))
+
+        _find_programs(ctx, obj.__dict__, programs, search_paths, active)
+
+
+def _add_search_paths(paths, search_paths):
+    if isinstance(paths, str):
+        paths = [paths]
+
+    try:
+        for path in paths:
+            if isinstance(path, str) and not os.path.isabs(path):
+                search_paths.add(Path(path).abspath())
+    except TypeError:
+        pass
+
+
+def _stamp(path):
+    """Return the mtime and size of the file, or None if it doesn't
+    exist."""
+
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)
+
+
+def _program_stamps(result):
+    """If the call found a program, such as L{fbuild.builders.find_program},
+    return the stamps of the program and of the directories on the path,
+    which change when a program is installed in one of them."""
+
+    if not isinstance(result, str) or not os.path.isfile(result):
+        return {}
+
+    stamps = {Path(result).abspath(): _stamp(result)}
+    for dirname in os.environ.get('PATH', '').split(os.pathsep):
+        if dirname:
+            stamps[dirname] = _stamp(dirname)
+
+    return stamps
+
+
+def _run(exe, args):
+    """Return what the program prints when it's run with the I{args}."""
+
+    try:
+        p = subprocess.Popen([exe] + list(args),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+    except OSError:
+        return None
+
+    try:
+        stdout, _ = p.communicate(timeout=30)
+    except subprocess.TimeoutExpired:
+        p.kill()
+        p.communicate()
+        return None
+
+    return stdout
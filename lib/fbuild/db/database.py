@@ -1,52 +1,174 @@
-import hashlib
+import contextlib
 import itertools
 import pprint
 import threading
 
 import fbuild
+import fbuild.digest
 import fbuild.functools
 import fbuild.inspect
 import fbuild.path
 import fbuild.rpc
 
 import fbuild.db
+import fbuild.db.backend
 import fbuild.db.pickle_backend
 import fbuild.db.cache_backend
 import fbuild.db.sqlite_backend
 
 # ------------------------------------------------------------------------------
 
+class _Call:
+    """The state of a cached call while its function runs: the call it was
+    made from, the functions it calls, the files it adds as dependencies and
+    what it returned the last time it ran, which may still be pickled. Tasks
+    the call starts on other scheduler threads add to it as well, so it's
+    locked."""
+
+    def __init__(self, parent=None, old_result=None):
+        self.parent = parent
+        self.old_result = old_result
+        self.dependents = []
+        self.external_srcs = set()
+        self.external_dsts = set()
+        self.lock = threading.Lock()
+
+    def add_dependent(self, fun_name):
+        with self.lock:
+            self.dependents.append(fun_name)
+
+    def add_external_dependencies(self, srcs, dsts):
+        with self.lock:
+            self.external_srcs.update(srcs)
+            self.external_dsts.update(dsts)
+
+# ------------------------------------------------------------------------------
+
+class _CallSignature:
+    """What calling a cached function needs to know about it: its argument
+    spec, the arguments that are srcs and dsts and how to convert them to
+    filenames, and its return type. It's worked out once per function rather
+    than on every call."""
+
+    def __init__(self, function):
+        self.spec = fbuild.inspect.getfullargspec(function)
+        self.srcs = []
+        self.dsts = []
+        self.return_type = None
+
+        for akey, avalue in function.__annotations__.items():
+            if akey == 'return':
+                self.return_type = avalue
+            elif issubclass(avalue, fbuild.db.SRC):
+                self.srcs.append((akey, avalue.convert))
+            elif issubclass(avalue, fbuild.db.DST):
+                self.dsts.append((akey, avalue.convert))
+
+    def bind(self, function, args, kwargs):
+        """Bind the arguments of a call, and return them with the srcs and
+        dsts they name."""
+
+        bound = fbuild.functools.bind_args(function, args, kwargs, self.spec)
+
+        srcs = set()
+        for akey, convert in self.srcs:
+            srcs.update(convert(bound[akey]))
+
+        dsts = set()
+        for akey, convert in self.dsts:
+            dsts.update(convert(bound[akey]))
+
+        return bound, srcs, dsts
+
+# ------------------------------------------------------------------------------
+
 class Database:
     """L{Database} persistently stores the results of argument calls."""
 
     _FUN_DIGESTS = {}
+    _CALL_SIGNATURES = {}
 
-    def __init__(self, ctx, *, engine, explain=False):
+    def __init__(self, ctx, *, engine, explain=False, concurrent=False,
+            fast=False,
+            remote_cache=None,
+            config_cache=None):
         def handle_rpc(method, *args, **kwargs):
             return method(*args, **kwargs)
 
         self._ctx = ctx
-        self._callstack = []
+        self._local = threading.local()
         self._explain = explain
         self._connected = False
+        self._concurrent = concurrent
+        self._remote_cache = remote_cache
+        self._config_cache = config_cache
 
         if engine == 'pickle':
             self._backend = fbuild.db.pickle_backend.PickleBackend(self._ctx)
         elif engine == 'cache':
             self._backend = fbuild.db.cache_backend.CacheBackend(self._ctx)
         elif engine == 'sqlite':
-            self._backend = fbuild.db.sqlite_backend.SqliteBackend(self._ctx)
+            self._backend = fbuild.db.sqlite_backend.SqliteBackend(self._ctx,
+                concurrent=concurrent,
+                fast=fast)
         else:
             raise fbuild.Error('unknown backend: %s' % engine)
 
+        # Only the sqlite backend can be safely accessed from multiple
+        # threads. The other backends are serialized through the rpc thread.
+        if concurrent and engine != 'sqlite':
+            raise fbuild.Error('backend does not support concurrent access: %s'
+                % engine)
+
+        if fast and engine != 'sqlite':
+            raise fbuild.Error('backend does not support fast mode: %s'
+                % engine)
+
         self._rpc = fbuild.rpc.RPC(handle_rpc)
         self._rpc.daemon = True
         self.active_files = set()
         self.start()
 
+    @property
+    def _calls(self):
+        """The stack of the calls the current thread is running. Each
+        scheduler thread has its own, so that concurrent calls don't become
+        dependents of each other. A None entry stands for a task that wasn't
+        started by a call."""
+
+        try:
+            return self._local.calls
+        except AttributeError:
+            self._local.calls = []
+            return self._local.calls
+
+    def _current_call(self):
+        """Return the call the current thread is running, or None."""
+
+        calls = self._calls
+        return calls[-1] if calls else None
+
+    def call_context(self):
+        """Return a context manager that runs code as part of the call the
+        current thread is running. The scheduler enters it when it runs a
+        task on another thread, so that the calls and dependencies the task
+        makes are recorded with the call that started it."""
+
+        return self._running(self._current_call())
+
+    @contextlib.contextmanager
+    def _running(self, call):
+        calls = self._calls
+        calls.append(call)
+        try:
+            yield
+        finally:
+            calls.pop()
+
     def start(self):
         """Start the server thread."""
-        self._rpc.start()
+        if not self._concurrent:
+            self._rpc.start()
 
     def shutdown(self, *args, **kwargs):
         """Inform and wait for the L{DatabaseThread} to shut down."""
@@ -56,16 +178,24 @@ class Database:
         """Connect to the database backend."""
         assert not self._connected, 'Already connected to the backend.'
 
-        result = self._rpc.call(self._backend.connect, *args, **kwargs)
+        result = self._call_backend(self._backend.connect, *args, **kwargs)
         self._connected = True
         return result
 
     def close(self, *args, **kwargs):
         """Close the connection to the backend."""
-        result = self._rpc.call(self._backend.close, *args, **kwargs)
+        result = self._call_backend(self._backend.close, *args, **kwargs)
         self._connected = False
         return result
 
+    def _call_backend(self, method, *args, **kwargs):
+        """Call the backend method. Unless the backend supports concurrent
+        access, the call is run inside the rpc thread."""
+        if self._concurrent:
+            return method(*args, **kwargs)
+        else:
+            return self._rpc.call(method, *args, **kwargs)
+
     def call(self, function, *args, **kwargs):
         """Call the function and return the result, src dependencies, and dst
         dependencies. If the function has been previously called with the same
@@ -75,16 +205,28 @@ class Database:
         "srcs" are also modified.  Finally, if any of the filenames in "dsts"
         do not exist, re-run the function no matter what."""
 
+        with self._ctx.tracer.span('call', 'db') as span:
+            return self._call(span, function, *args, **kwargs)
+
+    def _call(self, span, function, *args, **kwargs):
+        """Implement L{call}, recording what happened in the trace span."""
+
         # Make sure none of the arguments are a generator.
         assert all(not fbuild.inspect.isgenerator(arg)
             for arg in itertools.chain(args, kwargs.values())), \
             "Cannot store generator in database"
 
         outer_function = function
+        if self._config_cache is not None and \
+                self._is_config_function(function):
+            config_function = function
+        else:
+            config_function = None
         fun_name, function, args, kwargs = self._find_function_name(
             function,
             args,
             kwargs)
+        span.name = fun_name
 
         # Decorator magic.
         if hasattr(outer_function, '__fbuild_wrapped__'):
@@ -94,10 +236,11 @@ class Database:
         else:
             outer_function = function
 
-        # If there is a call stack, then this function is a dependent of the
-        # parent.
-        if self._callstack:
-            self._callstack[-1].append(fun_name)
+        # If there is a call running, then this function is a dependent of
+        # the parent.
+        parent = self._current_call()
+        if parent is not None:
+            parent.add_dependent(fun_name)
 
         # Get the function digest.
         fun_digest = self.get_function_digest_from_map(fun_name)
@@ -108,9 +251,10 @@ class Database:
             args,
             kwargs)
 
-        fun_dirty, fun_id, call_dirty, call_id, old_result, call_file_digests, \
-            external_srcs, external_dsts, external_digests = \
-                self._rpc.call(self._backend.prepare,
+        with self._ctx.tracer.span('prepare', 'db'):
+            fun_dirty, fun_id, call_dirty, call_id, old_result, \
+                call_file_digests, external_srcs, external_dsts, \
+                external_digests = self._call_backend(self._backend.prepare,
                     fun_name,
                     fun_digest,
                     call_bound,
@@ -124,11 +268,16 @@ class Database:
                 call_dirty or \
                 call_file_digests or \
                 external_digests):
+            # The result is only unpickled now that we know we'll use it.
+            # Unpickling doesn't touch the database, so it's done on this
+            # thread.
+            cached_result = self._backend.load_result(old_result)
+
             # If the result is a dst filename, make sure it exists. If not,
             # we're dirty.
             if return_type is not None and \
                     issubclass(return_type, fbuild.db.DST):
-                return_dsts = return_type.convert(old_result)
+                return_dsts = return_type.convert(cached_result)
             else:
                 return_dsts = ()
 
@@ -146,7 +295,10 @@ class Database:
                 all_dsts.update(return_dsts)
                 # Update the active file list.
                 self.active_files.update(all_srcs | all_dsts)
-                return old_result, all_srcs, all_dsts
+                span.args['cached'] = True
+                return cached_result, all_srcs, all_dsts
+
+        span.args['cached'] = False
 
         if self._explain:
             # Explain why we are going to run the function.
@@ -173,32 +325,90 @@ class Database:
                 for dst in dirty_dsts:
                     self._ctx.logger.log('\t%s' % dst)
 
-        self._callstack.append([])
-
         # Clear external srcs and dsts since they'll be recomputed inside
         # the function.
-        external_srcs = set()
-        external_dsts = set()
+        call = _Call(parent, old_result)
+        external_srcs = call.external_srcs
+        external_dsts = call.external_dsts
+
+        # Another build may have already made the dsts, so look for them in
+        # the remote cache before running the function.
+        if self._remote_cache is not None and return_type is not None and \
+                issubclass(return_type, fbuild.db.DST):
+            remote_key = self._digest_remote_call(fun_name, fun_digest,
+                call_bound, srcs)
+            # Let the other tasks run while we wait on the server.
+            with self._ctx.tracer.span('remote', 'db') as remote_span, \
+                    self._ctx.scheduler.interruptible():
+                remote_found, call_result = self._remote_cache.find_call(
+                    remote_key, external_srcs, external_dsts)
+                remote_span.args['found'] = remote_found
+        else:
+            remote_key = None
+            remote_found = False
+
+        # Another project may have already found the result of a config call,
+        # so look for it in the config cache. Calls that make files are left
+        # to the remote cache.
+        if config_function is not None and not srcs and not dsts and (
+                return_type is None or
+                not issubclass(return_type, fbuild.db.DST)):
+            config_key = self._config_cache.digest_call(self._ctx, fun_name,
+                fun_digest, config_function, call_bound)
+        else:
+            config_key = None
+
+        if config_key is not None:
+            with self._ctx.tracer.span('config', 'db') as config_span:
+                config_found, call_result = self._config_cache.find_call(
+                    self._ctx, config_key, external_srcs,
+                    self.get_function_digest_from_map)
+                config_span.args['found'] = config_found
+        else:
+            config_found = False
 
         # The call was dirty, so recompute it.
-        call_result = outer_function(*args, **kwargs)
-        fun_dependents = tuple(self._callstack.pop())
+        if not remote_found and not config_found:
+            with self._running(call):
+                call_result = outer_function(*args, **kwargs)
+        fun_dependents = tuple(call.dependents)
+
+        # Share the result with other projects, along with the digests of the
+        # functions the call made so that they can tell if those changed.
+        if config_key is not None and not config_found and not external_dsts:
+            with self._ctx.tracer.span('config', 'db'):
+                self._config_cache.save_call(self._ctx, config_key,
+                    call_result,
+                    {name: self.get_function_digest_from_map(name)
+                        for name in fun_dependents},
+                    external_srcs)
 
         # Make sure the result is not a generator.
         assert not fbuild.inspect.isgenerator(call_result), \
             "Cannot store generator in database"
 
         # Save the results in the database.
-        self._rpc.call(self._backend.cache,
-            fun_dirty, fun_id, fun_name, fun_digest, fun_dependents,
-            call_id, call_bound, call_result,
-            call_file_digests, external_srcs, external_dsts)
+        with self._ctx.tracer.span('cache', 'db'):
+            self._call_backend(self._backend.cache,
+                fun_dirty, fun_id, fun_name, fun_digest, fun_dependents,
+                call_id, call_bound, call_result,
+                call_file_digests, external_srcs, external_dsts)
 
         if return_type is not None and issubclass(return_type, fbuild.db.DST):
             return_dsts = return_type.convert(call_result)
         else:
             return_dsts = ()
 
+        # Share the dsts with other builds. Calls that call other cached
+        # functions are skipped, as we'd need to record those calls too.
+        if remote_key is not None and not remote_found and \
+                not fun_dependents:
+            with self._ctx.tracer.span('remote', 'db'), \
+                    self._ctx.scheduler.interruptible():
+                self._remote_cache.save_call(remote_key, call_result,
+                    dsts.union(external_dsts, return_dsts),
+                    external_srcs, external_dsts)
+
         all_srcs = srcs.union(external_srcs)
         all_dsts = dsts.union(external_dsts)
         all_dsts.update(return_dsts)
@@ -209,12 +419,31 @@ class Database:
     def delete_function(self, fun_name):
         """Delete the function from the database."""
 
-        return self._rpc.call(self._backend.delete_function, fun_name)
+        return self._call_backend(self._backend.delete_function, fun_name)
 
     def delete_file(self, file_name):
         """Delete the file from the database."""
 
-        return self._rpc.call(self._backend.delete_file, file_name)
+        return self._call_backend(self._backend.delete_file, file_name)
+
+    def find_task_durations(self, task_keys):
+        """Look up how long the scheduler's tasks took the last time they
+        ran."""
+
+        if not self._connected:
+            return {}
+
+        return self._call_backend(self._backend.find_task_durations,
+            task_keys)
+
+    def save_task_durations(self, durations):
+        """Remember how long the scheduler's tasks took."""
+
+        if not self._connected:
+            return
+
+        return self._call_backend(self._backend.save_task_durations,
+            durations)
 
     def dump_database(self):
         """Print the database."""
@@ -233,6 +462,21 @@ class Database:
         """Get the function digest from the global function map."""
         return self._FUN_DIGESTS[fun_name]()
 
+    @staticmethod
+    def _is_config_function(function):
+        """Return whether the function, or the class a PersistentObject is
+        being created from, is marked with L{fbuild.db.configures}."""
+
+        owner = getattr(function, '__self__', None)
+        if isinstance(owner, fbuild.db.PersistentMeta) and \
+                getattr(function, '__name__', None) == '__call_super__':
+            return getattr(owner, '__fbuild_config__', False)
+
+        # Look through bound methods, such as the cacheproperties of config
+        # tests.
+        function = getattr(function, '__func__', function)
+        return getattr(function, '__fbuild_config__', False)
+
     @staticmethod
     def _find_function_name(wrapped_function, args, kwargs):
         """Extract the function name from the function."""
@@ -283,50 +527,72 @@ class Database:
             # the source. If the function is a builtin, we will raise
             # an exception.
             src = fbuild.inspect.getsource(function)
-            digest = hashlib.md5(src.encode()).hexdigest()
+            digest = fbuild.digest.new(src.encode()).hexdigest()
         else:
             # The function is a functor so let it digest itself.
             digest = str(hash(function))
 
         return digest
 
+    @classmethod
+    def _find_call_signature(self, function):
+        """Return the L{_CallSignature} of the function."""
+
+        # Methods are bound again each time they're looked up, so key them
+        # by the function they wrap.
+        key = (getattr(function, '__func__', function),
+            fbuild.inspect.ismethod(function))
+
+        try:
+            return self._CALL_SIGNATURES[key]
+        except KeyError:
+            signature = self._CALL_SIGNATURES[key] = _CallSignature(function)
+            return signature
+
     def _find_call_filenames(self, function, args, kwargs):
         """Return the filenames needed for the function."""
 
-        # Bind the arguments so that we can look up normal args by name.
-        bound = fbuild.functools.bind_args(function, args, kwargs)
+        signature = self._find_call_signature(function)
+        bound, srcs, dsts = signature.bind(function, args, kwargs)
 
-        # Check if any of the files changed.
-        return_type = None
-        srcs = set()
-        dsts = set()
-        for akey, avalue in function.__annotations__.items():
-            if akey == 'return':
-                return_type = avalue
-            elif issubclass(avalue, fbuild.db.SRC):
-                srcs.update(avalue.convert(bound[akey]))
-            elif issubclass(avalue, fbuild.db.DST):
-                dsts.update(avalue.convert(bound[akey]))
+        return bound, srcs, dsts, signature.return_type
 
-        return bound, srcs, dsts, return_type
+    def _digest_remote_call(self, fun_name, fun_digest, bound, srcs):
+        """Compute the key of the call in the remote cache from everything
+        that's known about the call before it runs."""
 
-    def add_external_dependencies_to_call(self, *, srcs=(), dsts=()):
-        """When inside a cached method, register additional src
-        dependencies for the call. This function can only be called from
-        a cached function and will error out if it is called from an
-        uncached function."""
+        return fbuild.db.backend.digest_bound(self._ctx, {
+            'fun_name': fun_name,
+            'fun_digest': fun_digest,
+            'bound': bound,
+            'srcs': {src: fbuild.path.Path(src).digest() for src in srcs},
+        })
 
-        # Hack in additional dependencies
-        frame = fbuild.inspect.currentframe()
+    def find_old_result(self):
+        """Return what the running cached call returned the last time it ran
+        with the same arguments, or None if it hasn't. This function can only
+        be called from a cached function."""
 
-        if frame is None:
-            return
+        call = self._current_call()
+        if call is None:
+            raise fbuild.Error(
+                'find_old_result must be called from a cached function')
+
+        old_result = call.old_result
+        if old_result is None:
+            return None
 
-        frame = frame.f_back
+        return self._backend.load_result(old_result)
+
+    def add_external_dependencies_to_call(self, *, srcs=(), dsts=()):
+        """When inside a cached method, register additional src
+        dependencies for the call, and for the calls it was made from. This
+        does nothing if it is called from an uncached function."""
 
-        while frame:
-            if frame.f_code == self.call.__code__:
-                frame.f_locals['external_srcs'].update(srcs)
-                frame.f_locals['external_dsts'].update(dsts)
+        srcs = tuple(srcs)
+        dsts = tuple(dsts)
 
-            frame = frame.f_back
+        call = self._current_call()
+        while call is not None:
+            call.add_external_dependencies(srcs, dsts)
+            call = call.parent
@@ -1,18 +1,47 @@
 import io
 import pickle
+import struct
+import uuid
+import zlib
 
+import fbuild.db.backend
 import fbuild.db.cache_backend
 import fbuild.path
 
 # ------------------------------------------------------------------------------
 
 class PickleBackend(fbuild.db.cache_backend.CacheBackend):
-    _LATEST_VERSION = '2'
+    """A backend that keeps the database in memory and saves it into a pickled
+    snapshot file. Rather than re-pickling the whole database on every run,
+    every change made to the tables is appended to a journal next to the
+    snapshot, and the snapshot is only rewritten once the journal grows past a
+    threshold."""
+
+    _LATEST_VERSION = '7'
+
+    # The journal starts with this magic followed by the id of the snapshot it
+    # applies to.
+    _JOURNAL_MAGIC = b'fbuild-journal\n'
+
+    # Every journal record is prefixed with the length and crc32 of the
+    # record, so that we can detect records that were partially written.
+    _JOURNAL_HEADER = struct.Struct('<II')
+
+    # Rewrite the snapshot once the journal is larger than the snapshot, or
+    # this many bytes, whichever is bigger.
+    _JOURNAL_COMPACT_SIZE = 1 << 20
 
     def _connect(self, filename):
-        """Load the database from the file."""
+        """Load the database from the snapshot and replay the journal."""
 
         self._file_name = fbuild.path.Path(filename)
+        self._journal_name = self._file_name + '.log'
+        self._result_data = {}
+        self._journal_file = None
+        self._journal_batch = None
+        self._journal_size = 0
+        self._snapshot_id = None
+        self._snapshot_size = 0
 
         if self._file_name.exists():
             with open(self._file_name, 'rb') as f:
@@ -24,14 +53,32 @@ class PickleBackend(fbuild.db.cache_backend.CacheBackend):
                     super()._connect()
                     return
 
-                if len(data) == 6:
-                    # This was created before DB versioning was introduced. Use
-                    # a fake version.
-                    data = (self._NULL_VERSION,) + data
+                self._snapshot_size = f.tell()
+
+            if len(data) == 6:
+                # This was created before DB versioning was introduced. Use a
+                # fake version.
+                data = (self._NULL_VERSION,) + data
+
+            if data[0] != self.latest_version():
+                # The tables have changed since this was saved. Start clean
+                # and let connect() throw the old file away.
+                super()._connect()
+                self._version = data[0]
+                return
+
+            self._version, self._snapshot_id, self._functions, \
+                self._function_calls, self._call_digests, self._files, \
+                self._call_files, self._external_srcs, \
+                self._external_dsts, self._task_durations = data
+
+            self._open_journal()
 
-                self._version, self._functions, self._function_calls, \
-                    self._files, self._call_files, self._external_srcs, \
-                    self._external_dsts = data
+            # The snapshot already shares the data of identical results, but
+            # the journal doesn't.
+            for datas in self._function_calls.values():
+                for bound, result in datas:
+                    self._intern_result(result)
         else:
             super()._connect()
 
@@ -39,17 +86,38 @@ class PickleBackend(fbuild.db.cache_backend.CacheBackend):
     def close(self):
         """Save the database to the file."""
 
+        if self._journal_file is not None:
+            self._journal_file.close()
+            self._journal_file = None
+
+        # Only rewrite the snapshot if we don't have one yet, or if replaying
+        # the journal would take longer than loading a new snapshot.
+        if self._snapshot_id is None or self._journal_size > \
+                max(self._snapshot_size, self._JOURNAL_COMPACT_SIZE):
+            self._save_snapshot()
+
+    # --------------------------------------------------------------------------
+
+    def _save_snapshot(self):
+        """Pickle all the tables into a new snapshot and discard the
+        journal."""
+
+        snapshot_id = uuid.uuid4().hex
+
         f = io.BytesIO()
         pickler = fbuild.db.backend.Pickler(self._ctx, f)
 
         pickler.dump((
-            self._LATEST_VERSION,
+            self.latest_version(),
+            snapshot_id,
             self._functions,
             self._function_calls,
+            self._call_digests,
             self._files,
             self._call_files,
             self._external_srcs,
-            self._external_dsts))
+            self._external_dsts,
+            self._task_durations))
 
         s = f.getvalue()
 
@@ -71,3 +139,179 @@ class PickleBackend(fbuild.db.cache_backend.CacheBackend):
 
         if old.exists():
             old.remove()
+
+        # The journal now refers to an old snapshot, so it's safe to remove.
+        # Should we get interrupted before then, the journal will be ignored
+        # on the next load since the snapshot id no longer matches.
+        if self._journal_name.exists():
+            self._journal_name.remove()
+
+        self._snapshot_id = snapshot_id
+        self._snapshot_size = len(s)
+        self._journal_size = 0
+
+
+    def _open_journal(self):
+        """Replay the journal on top of the snapshot, then open it for
+        appending."""
+
+        header = self._JOURNAL_MAGIC + self._snapshot_id.encode('ascii')
+
+        if self._journal_name.exists():
+            with open(self._journal_name, 'r+b') as f:
+                if f.read(len(header)) == header:
+                    end = self._replay_journal(f)
+
+                    # Drop any partially written records at the end.
+                    f.truncate(end)
+
+                    self._journal_file = open(self._journal_name, 'ab')
+                    self._journal_size = end
+                    return
+
+        # The journal is missing or belongs to a different snapshot, so start
+        # a fresh one.
+        self._journal_file = open(self._journal_name, 'wb')
+        self._journal_file.write(header)
+        self._journal_size = len(header)
+
+
+    def _replay_journal(self, f):
+        """Apply all the complete records in the journal, and return the
+        offset after the last good record."""
+
+        cache_backend = fbuild.db.cache_backend.CacheBackend
+        size = self._JOURNAL_HEADER.size
+
+        while True:
+            end = f.tell()
+
+            header = f.read(size)
+            if len(header) < size:
+                return end
+
+            length, crc = self._JOURNAL_HEADER.unpack(header)
+            record = f.read(length)
+            if len(record) < length or zlib.crc32(record) != crc:
+                return end
+
+            try:
+                ops = fbuild.db.backend.pickle_loads(self._ctx, record)
+            except (AttributeError, ImportError, pickle.UnpicklingError):
+                # Likely a moved member. Stop replaying here.
+                return end
+
+            # Apply the operations with the plain in-memory implementations
+            # so they don't get journaled again.
+            for name, args in ops:
+                getattr(cache_backend, name)(self, *args)
+
+
+    def _journal(self, name, *args):
+        """Append an operation to the journal."""
+
+        if self._journal_file is None:
+            return
+
+        if self._journal_batch is not None:
+            self._journal_batch.append((name, args))
+        else:
+            self._write_journal([(name, args)])
+
+
+    def _write_journal(self, ops):
+        """Write a record of operations that will be replayed together."""
+
+        if not ops:
+            return
+
+        record = fbuild.db.backend.pickle_dumps(self._ctx, ops)
+        self._journal_file.write(self._JOURNAL_HEADER.pack(
+            len(record),
+            zlib.crc32(record)))
+        self._journal_file.write(record)
+        self._journal_size += self._JOURNAL_HEADER.size + len(record)
+
+    # --------------------------------------------------------------------------
+
+    def cache(self, *args, **kwargs):
+        # Group all the changes made while caching a call into one record, so
+        # that they are either all replayed or not at all.
+        self._journal_batch = []
+        try:
+            return super().cache(*args, **kwargs)
+        finally:
+            ops, self._journal_batch = self._journal_batch, None
+            if self._journal_file is not None:
+                self._write_journal(ops)
+
+
+    def save_function(self, *args):
+        result = super().save_function(*args)
+        self._journal('save_function', *args)
+        return result
+
+
+    def delete_function(self, *args):
+        result = super().delete_function(*args)
+        self._journal('delete_function', *args)
+        return result
+
+
+    def save_call(self, call_id, fun_id, bound, result):
+        # Pickle the result now, so that loading the database only has to
+        # unpickle the results of the calls that are used. The result is
+        # kept too, so this run doesn't have to unpickle it.
+        result = self._intern_result(fbuild.db.backend.PickledResult(
+            fbuild.db.backend.pickle_dumps(self._ctx, result),
+            result))
+
+        new_call_id = super().save_call(call_id, fun_id, bound, result)
+        self._journal('save_call', call_id, fun_id, bound, result)
+        return new_call_id
+
+
+    def _intern_result(self, result):
+        """Share the pickled data of I{result} with the other results that
+        pickled to the same data. Many calls return the same value, so this
+        keeps one copy of it in memory and in the snapshot. Each call still
+        unpickles its own value."""
+
+        result.data = self._result_data.setdefault(result.data, result.data)
+        return result
+
+
+    def save_call_file(self, *args):
+        result = super().save_call_file(*args)
+        self._journal('save_call_file', *args)
+        return result
+
+
+    def _save_external_file_names(self, *args):
+        result = super()._save_external_file_names(*args)
+        self._journal('_save_external_file_names', *args)
+        return result
+
+
+    def save_file(self, *args):
+        result = super().save_file(*args)
+        self._journal('save_file', *args)
+        return result
+
+
+    def delete_file(self, *args):
+        result = super().delete_file(*args)
+        self._journal('delete_file', *args)
+        return result
+
+
+    def save_task_durations(self, *args):
+        result = super().save_task_durations(*args)
+        self._journal('save_task_durations', *args)
+        return result
+
+
+    def delete_task_durations(self, *args):
+        result = super().delete_task_durations(*args)
+        self._journal('delete_task_durations', *args)
+        return result
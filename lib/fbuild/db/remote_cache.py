@@ -0,0 +1,318 @@
+import hashlib
+import http.client
+import json
+import os
+import queue
+import stat
+import threading
+import urllib.parse
+
+import fbuild
+from fbuild.path import Path
+
+# ------------------------------------------------------------------------------
+
+class RemoteCache:
+    """
+    A cache of the files made by cached functions, shared by all the builds
+    that use the same cache server. Before the database re-runs a dirty call
+    whose result names dst files, it looks for a record of the same call made
+    by another build, and downloads the dsts that call made instead.
+
+    Records are stored by the digest of the call. A record holds the result,
+    the digests of the external srcs that the call depended on, and the
+    digests and modes of the files it made. Files themselves are stored by
+    the sha256 of their contents. Subclasses implement how records and files
+    are transferred.
+    """
+
+    def __init__(self, *, logger=None):
+        self.logger = logger
+        self.hits = 0
+        self.misses = 0
+        self._failed = False
+        self._lock = threading.Lock()
+
+    def get_record(self, key):
+        """Return the record stored under the key, or None."""
+        raise NotImplementedError
+
+    def put_record(self, key, data):
+        """Store the record under the key."""
+        raise NotImplementedError
+
+    def get_file(self, digest):
+        """Return the contents of the file with the digest, or None."""
+        raise NotImplementedError
+
+    def put_file(self, digest, data):
+        """Store the contents of the file with the digest."""
+        raise NotImplementedError
+
+    def contains_files(self, digests):
+        """Return which of the file digests are stored."""
+        raise NotImplementedError
+
+    # --------------------------------------------------------------------------
+
+    def find_call(self, key, external_srcs, external_dsts):
+        """Restore the dst files of the call recorded under the key, and
+        return whether the call was found and its result. The external srcs
+        and dsts of the call are added to I{external_srcs} and
+        I{external_dsts}."""
+
+        try:
+            found, result = self._find_call(key, external_srcs, external_dsts)
+        except (OSError, http.client.HTTPException) as e:
+            self._fail(e)
+            found, result = False, None
+        except (KeyError, TypeError, ValueError):
+            # Treat a malformed record as a miss.
+            found, result = False, None
+
+        with self._lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        return found, result
+
+    def _find_call(self, key, external_srcs, external_dsts):
+        if self._failed:
+            return False, None
+
+        data = self.get_record(key)
+        if data is None:
+            return False, None
+
+        record = json.loads(data.decode())
+
+        # Make sure we have the same external srcs the call depended on.
+        for src, digest in record['external_srcs']:
+            try:
+                if Path(src).digest() != digest:
+                    return False, None
+            except OSError:
+                return False, None
+
+        # Download all the files before writing any of them out.
+        files = []
+        for dst, digest, mode in record['dsts']:
+            if not isinstance(mode, int):
+                raise ValueError('bad mode: %r' % (mode,))
+
+            contents = self.get_file(digest)
+            if contents is None or \
+                    hashlib.sha256(contents).hexdigest() != digest:
+                return False, None
+            files.append((Path(dst), contents, mode))
+
+        for dst, contents, mode in files:
+            dst.parent.makedirs()
+            with open(dst, 'wb') as f:
+                f.write(contents)
+
+            # Keep programs executable.
+            os.chmod(dst, stat.S_IMODE(mode))
+
+        if self.logger is not None:
+            self.logger.check(' * remote cache',
+                ' '.join(dst for dst, contents, mode in files),
+                color='compile')
+
+        external_srcs.update(src for src, digest in record['external_srcs'])
+        external_dsts.update(record['external_dsts'])
+
+        return True, _decode_result(record['result'])
+
+    def save_call(self, key, result, dsts, external_srcs, external_dsts):
+        """Record the call under the key, and upload the dst files it made.
+        Calls whose result can't be recorded are skipped."""
+
+        try:
+            self._save_call(key, result, dsts, external_srcs, external_dsts)
+        except (OSError, http.client.HTTPException) as e:
+            self._fail(e)
+
+    def _save_call(self, key, result, dsts, external_srcs, external_dsts):
+        if self._failed:
+            return
+
+        try:
+            result = _encode_result(result)
+        except TypeError:
+            return
+
+        files = {}
+        for dst in sorted(dsts):
+            with open(dst, 'rb') as f:
+                contents = f.read()
+                mode = stat.S_IMODE(os.fstat(f.fileno()).st_mode)
+            files[dst] = (hashlib.sha256(contents).hexdigest(), contents, mode)
+
+        # Only upload the files the server doesn't already have.
+        stored = self.contains_files(
+            [digest for digest, _, _ in files.values()])
+        for digest, contents, mode in files.values():
+            if digest not in stored:
+                self.put_file(digest, contents)
+                stored.add(digest)
+
+        record = {
+            'result': result,
+            'dsts': [(dst, digest, mode)
+                for dst, (digest, _, mode) in files.items()],
+            'external_srcs': [(src, Path(src).digest())
+                for src in sorted(external_srcs)],
+            'external_dsts': sorted(external_dsts),
+        }
+
+        self.put_record(key, json.dumps(record, sort_keys=True).encode())
+
+    def _fail(self, e):
+        """Stop using the cache after it fails, rather than failing the
+        build."""
+
+        with self._lock:
+            if self._failed:
+                return
+            self._failed = True
+
+        if self.logger is not None:
+            self.logger.log('remote cache failed, no longer using it: %s' % e,
+                color='red')
+
+    def close(self):
+        """Report how well the cache worked."""
+
+        if self.logger is not None and (self.hits or self.misses):
+            self.logger.check(' * remote cache',
+                '%d hits, %d misses' % (self.hits, self.misses),
+                color='yellow')
+
+# ------------------------------------------------------------------------------
+
+class HTTPRemoteCache(RemoteCache):
+    """
+    A remote cache that talks to a server over http. Records live under
+    I{/ac/} and files under I{/cas/}, both fetched with GET and stored with
+    PUT. Which files are stored is checked in one request by POSTing their
+    digests, one per line, to I{/cas/contains}. Connections are kept alive
+    and reused by the worker threads.
+    """
+
+    def __init__(self, url, *, timeout=30, **kwargs):
+        super().__init__(**kwargs)
+
+        url = urllib.parse.urlsplit(url)
+        if url.scheme != 'http':
+            raise fbuild.Error('unsupported remote cache url: %s' %
+                url.geturl())
+
+        self._host = url.netloc
+        self._path = url.path.rstrip('/')
+        self._timeout = timeout
+        self._connections = queue.LifoQueue()
+
+    def _request(self, method, path, body=None):
+        """Send the request and return the status and body of the response,
+        retrying once if a pooled connection was closed by the server."""
+
+        for retry in (True, False):
+            try:
+                connection = self._connections.get_nowait()
+            except queue.Empty:
+                connection = http.client.HTTPConnection(self._host,
+                    timeout=self._timeout)
+                retry = False
+
+            try:
+                connection.request(method, self._path + path, body)
+                response = connection.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                if retry:
+                    continue
+                raise
+
+            self._connections.put(connection)
+            return response.status, data
+
+    def _get(self, path):
+        status, data = self._request('GET', path)
+        if status == 404:
+            return None
+        if status != 200:
+            raise http.client.HTTPException('GET %s: %d' % (path, status))
+        return data
+
+    def _put(self, path, data):
+        status, _ = self._request('PUT', path, data)
+        if status not in (200, 201, 204):
+            raise http.client.HTTPException('PUT %s: %d' % (path, status))
+
+    def get_record(self, key):
+        return self._get('/ac/' + key)
+
+    def put_record(self, key, data):
+        self._put('/ac/' + key, data)
+
+    def get_file(self, digest):
+        return self._get('/cas/' + digest)
+
+    def put_file(self, digest, data):
+        self._put('/cas/' + digest, data)
+
+    def contains_files(self, digests):
+        if not digests:
+            return set()
+
+        status, data = self._request('POST', '/cas/contains',
+            '\n'.join(digests).encode())
+        if status != 200:
+            raise http.client.HTTPException('POST /cas/contains: %d' % status)
+        return set(data.decode().split())
+
+    def close(self):
+        super().close()
+
+        while True:
+            try:
+                self._connections.get_nowait().close()
+            except queue.Empty:
+                break
+
+# ------------------------------------------------------------------------------
+
+def make_remote_cache(url, **kwargs):
+    """Create the remote cache for the url."""
+
+    return HTTPRemoteCache(url, **kwargs)
+
+# ------------------------------------------------------------------------------
+
+def _encode_result(result):
+    """Convert a result into json. Only paths and sequences of paths are
+    supported, as those are what the functions that make dsts return."""
+
+    if type(result) in (str, Path):
+        return ['path', result]
+    elif type(result) in (list, tuple) and \
+            all(type(r) in (str, Path) for r in result):
+        return [type(result).__name__, list(result)]
+    else:
+        raise TypeError('cannot record result: %r' % (result,))
+
+
+def _decode_result(result):
+    kind, value = result
+    if kind == 'path':
+        return Path(value)
+    elif kind == 'list':
+        return [Path(v) for v in value]
+    elif kind == 'tuple':
+        return tuple(Path(v) for v in value)
+    else:
+        raise ValueError('unknown result kind: %r' % kind)
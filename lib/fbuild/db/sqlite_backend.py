@@ -1,6 +1,7 @@
 import io
-import pickle
 import sqlite3
+import threading
+import time
 import weakref
 
 import fbuild.db
@@ -9,10 +10,28 @@ import fbuild.path
 
 # ------------------------------------------------------------------------------
 
-class _ObjectID:
-    def __init__(self, cls, state):
-        self.cls = cls
-        self.state = state
+class _Pickler(fbuild.db.backend.Pickler):
+    """Pickle L{fbuild.db.PersistentObject}s by their class and members, so
+    that unpickling them doesn't create them through the database again."""
+
+    def persistent_id(self, obj):
+        if isinstance(obj, fbuild.db.PersistentObject):
+            return obj.__class__, obj.__dict__
+        else:
+            return super().persistent_id(obj)
+
+class _Unpickler(fbuild.db.backend.Unpickler):
+    """Unpickle the objects pickled with L{_Pickler}."""
+
+    def persistent_load(self, pid):
+        if isinstance(pid, tuple):
+            cls, state = pid
+            obj = object.__new__(cls)
+            for key, value in state.items():
+                setattr(obj, key, value)
+            return obj
+        else:
+            return super().persistent_load(pid)
 
 # ------------------------------------------------------------------------------
 
@@ -21,19 +40,35 @@ class SqliteBackend(fbuild.db.backend.Backend):
     A sqlite-based fbuild backend database.
     """
 
-    _LATEST_VERSION = '2'
+    _LATEST_VERSION = '6'
 
-    def __init__(self, *args, **kwargs):
+    # How many seconds a thread waits for another thread's write transaction
+    # before giving up.
+    _BUSY_TIMEOUT = 60.0
+
+    # In fast mode, commit once this many calls were cached, or once this many
+    # seconds passed since the last commit.
+    _COMMIT_CALLS = 256
+    _COMMIT_INTERVAL = 5.0
+
+    def __init__(self, *args, concurrent=False, fast=False, **kwargs):
         super().__init__(*args, **kwargs)
 
-        self._pickle_data = io.BytesIO()
-        self._pickler = fbuild.db.backend.Pickler(
-            self._ctx,
-            self._pickle_data)
+        # When we're concurrent, every thread gets its own connection to the
+        # database so that readers don't have to wait on each other.
+        self._concurrent = concurrent
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
 
-        self._unpickler = fbuild.db.backend.Unpickler(
-            self._ctx,
-            self._pickle_data)
+        # Fast mode trades durability for speed: the database is written
+        # ahead and only synced at checkpoints, and the cached calls are
+        # committed in groups. If the build crashes, the calls since the last
+        # commit are lost and are run again next time, but the database stays
+        # consistent.
+        self._fast = fast
+        self._uncommitted_calls = 0
+        self._last_commit = time.monotonic()
 
 
     def _connect(self, filename):
@@ -41,30 +76,94 @@ class SqliteBackend(fbuild.db.backend.Backend):
 
         self._file_name = fbuild.path.Path(filename)
 
-        self.conn = sqlite3.connect(self._file_name)
-        self.cursor = self.conn.cursor()
+        self._open_connection()
 
-        self._initialize_database()
+        if self._concurrent or self._fast:
+            # Write-ahead logging lets readers proceed while another
+            # connection is writing, and only needs to sync at checkpoints.
+            self.cursor.execute('PRAGMA journal_mode = WAL')
 
         # Load the version.
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS Version (
+                id INTEGER PRIMARY KEY,
+                version TEXT)''')
         self.cursor.execute('SELECT version FROM Version')
         rows = self.cursor.fetchall()
         assert len(rows) <= 1
         self._version = rows[0][0] if rows else self._NULL_VERSION
 
+        # Only create the tables if they are compatible with our version,
+        # otherwise the schema may not match. connect() will throw away the
+        # old database anyway.
+        self.cursor.execute('''
+            SELECT name FROM sqlite_master
+            WHERE type='table' AND name='Call'
+            ''')
+        if self._version == self.latest_version() or \
+                not self.cursor.fetchall():
+            self._initialize_database()
+
 
     def close(self):
         # Update the version.
 
         if self._version == self._NULL_VERSION:
             self.cursor.execute('INSERT INTO Version (version) VALUES (?)',
-                                self._LATEST_VERSION)
+                                (self.latest_version(),))
         else:
             self.cursor.execute('UPDATE Version SET version=?',
-                                self._LATEST_VERSION)
-        self.conn.commit()
+                                (self.latest_version(),))
+        self._commit()
+
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+
+        # Forget all the per-thread connections.
+        self._local = threading.local()
+
+
+    @property
+    def conn(self):
+        """The connection for the current thread."""
+        try:
+            return self._local.conn
+        except AttributeError:
+            return self._open_connection()[0]
+
+
+    @property
+    def cursor(self):
+        """The cursor for the current thread."""
+        try:
+            return self._local.cursor
+        except AttributeError:
+            return self._open_connection()[1]
+
+
+    def _open_connection(self):
+        """Open a connection to the database for the current thread."""
+
+        # The connections are only used by the thread that opened them, but
+        # they are closed from whichever thread closes the backend.
+        conn = sqlite3.connect(self._file_name,
+            timeout=self._BUSY_TIMEOUT,
+            check_same_thread=False)
+        cursor = conn.cursor()
+        cursor.execute('PRAGMA foreign_keys = ON')
+
+        if self._concurrent or self._fast:
+            cursor.execute('PRAGMA synchronous = NORMAL')
+
+        with self._connections_lock:
+            self._connections.append(conn)
+
+        self._local.conn = conn
+        self._local.cursor = cursor
 
-        self.conn.close()
+        return conn, cursor
 
 
     def _initialize_database(self):
@@ -88,15 +187,19 @@ class SqliteBackend(fbuild.db.backend.Backend):
                 fun_id INTEGER REFERENCES Function(fun_id)
                     ON DELETE CASCADE
                     ON UPDATE CASCADE,
+                call_digest TEXT,
                 call_bound BLOB,
                 call_result BLOB);
-            CREATE INDEX IF NOT EXISTS Call_fun_id_index ON
-                Call (fun_id);
+            CREATE INDEX IF NOT EXISTS Call_fun_id_digest_index ON
+                Call (fun_id, call_digest);
 
             CREATE TABLE IF NOT EXISTS File (
                 file_id INTEGER PRIMARY KEY AUTOINCREMENT,
                 file_name TEXT UNIQUE,
-                file_mtime INTEGER,
+                file_mtime_ns INTEGER,
+                file_size INTEGER,
+                file_inode INTEGER,
+                file_ctime_ns INTEGER,
                 file_digest TEXT);
             CREATE INDEX IF NOT EXISTS File_name_index ON
                 File (file_name);
@@ -128,13 +231,75 @@ class SqliteBackend(fbuild.db.backend.Backend):
                     ON DELETE CASCADE
                     ON UPDATE CASCADE,
                 PRIMARY KEY (call_id, file_id));
+
+            CREATE TABLE IF NOT EXISTS TaskDuration (
+                task_key TEXT PRIMARY KEY,
+                task_duration REAL);
             ''')
 
     # --------------------------------------------------------------------------
 
+    def prepare(self, *args, **kwargs):
+        # prepare() may update the file table. When we're concurrent, we
+        # can't leave that transaction open since it would block all the other
+        # threads from writing.
+        if self._concurrent:
+            return self._transaction(super().prepare, *args, **kwargs)
+        else:
+            return super().prepare(*args, **kwargs)
+
+
     def cache(self, *args, **kwargs):
+        if self._concurrent:
+            # Other connections can't write while we have a transaction open,
+            # so this always commits.
+            return self._transaction(super().cache, *args, **kwargs)
+        elif self._fast:
+            try:
+                result = super().cache(*args, **kwargs)
+            except BaseException:
+                # Throw away the whole group rather than keep half a call,
+                # along with the functions we remember it saving.
+                self.conn.rollback()
+                self._forget_functions()
+                self._uncommitted_calls = 0
+                raise
+
+            self._uncommitted_calls += 1
+            if self._uncommitted_calls >= self._COMMIT_CALLS or \
+                    time.monotonic() - self._last_commit >= \
+                    self._COMMIT_INTERVAL:
+                self._commit()
+
+            return result
+        else:
+            with self.conn:
+                return super().cache(*args, **kwargs)
+
+
+    def _commit(self):
+        """Commit the calls that were cached since the last commit."""
+
+        self.conn.commit()
+        self._uncommitted_calls = 0
+        self._last_commit = time.monotonic()
+
+
+    def _transaction(self, function, *args, **kwargs):
+        """Run the function inside a transaction. Read only transactions can
+        run concurrently with each other. If another thread changed the rows we
+        were about to write, rerun the function while holding the write lock
+        for the whole transaction."""
+
+        try:
+            with self.conn:
+                return function(*args, **kwargs)
+        except (sqlite3.IntegrityError, sqlite3.OperationalError):
+            pass
+
         with self.conn:
-            return super().cache(*args, **kwargs)
+            self.cursor.execute('BEGIN IMMEDIATE')
+            return function(*args, **kwargs)
 
     # --------------------------------------------------------------------------
 
@@ -161,6 +326,19 @@ class SqliteBackend(fbuild.db.backend.Backend):
             return fun_id, fun_digest, split_dependents
 
 
+    def find_functions(self):
+        """Returns a dictionary of the function names to their ids, digests
+        and dependents."""
+
+        self.cursor.execute(
+            'SELECT fun_id,fun_name,fun_digest,fun_dependents FROM Function')
+
+        return {fun_name: (fun_id, fun_digest,
+                fun_dependents.split('\0') if fun_dependents else [])
+            for fun_id, fun_name, fun_digest, fun_dependents
+            in self.cursor.fetchall()}
+
+
     def save_function(self, fun_id, fun_name, fun_digest, fun_dependents):
         """Insert or update the function's digest."""
 
@@ -173,14 +351,26 @@ class SqliteBackend(fbuild.db.backend.Backend):
 
         if fun_id is None:
             self.cursor.execute(
-                'INSERT INTO Function (fun_name, fun_digest, fun_dependents) VALUES (?,?,?)',
+                'INSERT OR IGNORE INTO Function (fun_name, fun_digest, fun_dependents) VALUES (?,?,?)',
                 (fun_name, fun_digest, joined_dependents))
 
-            fun_id = self.cursor.lastrowid
-        else:
-            self.cursor.execute(
-                'UPDATE Function SET fun_digest=?, fun_dependents=? WHERE fun_id=?',
-                (fun_digest, joined_dependents, fun_id))
+            if self.cursor.rowcount == 1:
+                fun_id = self.cursor.lastrowid
+                self._function_changed(fun_name,
+                    (fun_id, fun_digest, list(fun_dependents)))
+                return fun_id
+
+            # Another connection added the function since we looked it up, so
+            # update that row instead.
+            fun_id, = self.cursor.execute(
+                'SELECT fun_id FROM Function WHERE fun_name=?',
+                (fun_name,)).fetchone()
+
+        self.cursor.execute(
+            'UPDATE Function SET fun_digest=?, fun_dependents=? WHERE fun_id=?',
+            (fun_digest, joined_dependents, fun_id))
+        self._function_changed(fun_name,
+            (fun_id, fun_digest, list(fun_dependents)))
 
         return fun_id
 
@@ -217,57 +407,22 @@ class SqliteBackend(fbuild.db.backend.Backend):
         self.cursor.execute(
             'DELETE FROM Function WHERE fun_name=?',
             (fun_name,))
+        self._function_changed(fun_name, None)
 
     # --------------------------------------------------------------------------
 
     def _pickle_dumps(self, obj):
-        def persistent_id(obj):
-            if obj is self._ctx:
-                return b'ctx'
-            else:
-                return None
-
         f = io.BytesIO()
-        pickler = pickle._Pickler(f, protocol=pickle.HIGHEST_PROTOCOL)
-        pickler.persistent_id = persistent_id
-
-        def persist(obj):
-            if isinstance(obj, fbuild.db.PersistentObject):
-                # Make sure all the values are persisted.
-                state = {k: persist(v) for k, v in obj.__dict__.items()}
-                return _ObjectID(obj.__class__, state)
-            else:
-                return obj
-
-        obj = persist(obj)
-        pickler.dump(obj)
-
+        _Pickler(self._ctx, f).dump(obj)
         return f.getvalue()
 
 
     def _pickle_loads(self, value):
-        def persistent_load(pid):
-            if pid == b'ctx':
-                return self._ctx
-            else:
-                raise pickle.UnpicklingError(
-                    'unsupported persistent object: %r'  % pid)
-
-        f = io.BytesIO(value)
-        unpickler = pickle._Unpickler(f)
-        unpickler.persistent_load = persistent_load
-        obj = unpickler.load()
-
-        def unpersist(obj):
-            if isinstance(obj, _ObjectID):
-                o = object.__new__(obj.cls)
-                for key, value in obj.state.items():
-                    setattr(o, key, unpersist(value))
-                return o
-            else:
-                return obj
+        return _Unpickler(self._ctx, io.BytesIO(value)).load()
 
-        return unpersist(obj)
+
+    def load_result(self, result):
+        return result.load(self._pickle_loads)
 
 
     def find_call(self, fun_id, bound):
@@ -278,19 +433,23 @@ class SqliteBackend(fbuild.db.backend.Backend):
         assert isinstance(fun_id, int), fun_id
         assert isinstance(bound, dict), bound
 
-        # We've called this before, so search the data to see if we've called
-        # it with the same arguments.
+        call_digest = fbuild.db.backend.digest_bound(self._ctx, bound)
+
+        # We've called this before, so search the calls that were made with
+        # arguments that have the same digest to see if we've called it with
+        # the same arguments.
         for call_id, old_bound, old_result in self.cursor.execute('''
                 SELECT call_id, call_bound, call_result
                 FROM Call
-                WHERE fun_id=?
-                ''', (fun_id,)):
+                WHERE fun_id=? AND call_digest=?
+                ''', (fun_id, call_digest)):
             old_bound = self._pickle_loads(old_bound)
 
             if bound == old_bound:
-                old_result = self._pickle_loads(old_result)
-
-                return False, call_id, old_result
+                # Leave the result pickled until the call is known to be
+                # clean.
+                return False, call_id, \
+                    fbuild.db.backend.PickledResult(old_result)
         else:
             return True, None, None
 
@@ -307,13 +466,15 @@ class SqliteBackend(fbuild.db.backend.Backend):
 
         # Insert or update the call result.
         if call_id is None:
+            call_digest = fbuild.db.backend.digest_bound(self._ctx, call_bound)
             call_bound = self._pickle_dumps(call_bound)
 
             self.cursor.execute('''
-                INSERT INTO Call (fun_id,call_bound,call_result)
-                VALUES (?,?,?)
+                INSERT INTO Call (fun_id,call_digest,call_bound,call_result)
+                VALUES (?,?,?,?)
                 ''', (
                     fun_id,
+                    call_digest,
                     sqlite3.Binary(call_bound),
                     sqlite3.Binary(call_result)))
 
@@ -364,6 +525,19 @@ class SqliteBackend(fbuild.db.backend.Backend):
             VALUES (?,?,?)
             ''', (call_id, file_id, file_digest))
 
+
+    def save_call_files(self, call_id, digests):
+        """Insert or update the call files."""
+
+        # Make sure we got the right types.
+        assert isinstance(call_id, int), call_id
+
+        self.cursor.executemany('''
+            INSERT OR REPLACE INTO CallFile (call_id,file_id,file_digest)
+            VALUES (?,?,?)
+            ''', ((call_id, file_id, file_digest)
+                for file_id, file_name, file_digest in digests))
+
     # --------------------------------------------------------------------------
 
     def find_external_srcs(self, call_id):
@@ -423,7 +597,8 @@ class SqliteBackend(fbuild.db.backend.Backend):
         if srcs:
             # XXX: There's a python bug where you can't pass a generator that
             # itself inserts into sqlite, so we need to force the generator.
-            src_call_files = [self.check_call_file(call_id, src)
+            files = self.add_files(srcs)
+            src_call_files = [self._check_call_file(call_id, files[src])
                 for src in srcs]
 
             self.cursor.executemany(
@@ -445,7 +620,8 @@ class SqliteBackend(fbuild.db.backend.Backend):
             # once.
             # XXX: There's a python bug where you can't pass a generator that
             # itself inserts into sqlite, so we need to force the generator.
-            dst_call_files = [self.check_call_file(call_id, dst)
+            files = self.add_files(dsts)
+            dst_call_files = [self._check_call_file(call_id, files[dst])
                 for dst in dsts]
 
             self.cursor.executemany(
@@ -456,11 +632,12 @@ class SqliteBackend(fbuild.db.backend.Backend):
     # --------------------------------------------------------------------------
 
     def find_file(self, file_name):
-        """Returns the mtime and digest of the file, or None if it does not
+        """Returns the stat and digest of the file, or None if it does not
         exist."""
 
         self.cursor.execute('''
-            SELECT file_id,file_mtime,file_digest
+            SELECT file_id,file_mtime_ns,file_size,file_inode,file_ctime_ns,
+                file_digest
             FROM File
             WHERE file_name=?
             ''', (file_name,))
@@ -470,30 +647,54 @@ class SqliteBackend(fbuild.db.backend.Backend):
         if not rows:
             return None, None, None
 
-        (file_id, file_mtime, file_digest), = rows
+        (file_id, mtime_ns, size, inode, ctime_ns, file_digest), = rows
 
-        return file_id, file_mtime, file_digest
+        if mtime_ns is None:
+            file_stat = None
+        else:
+            file_stat = fbuild.db.backend.FileStat(mtime_ns, size,
+                inode % (1 << 64), ctime_ns)
+
+        return file_id, file_stat, file_digest
 
 
-    def save_file(self, file_id, file_name, file_mtime, file_digest):
+    def save_file(self, file_id, file_name, file_stat, file_digest):
         """Insert or update the file."""
 
         # Make sure we got the right types.
         assert isinstance(file_name, str) or file_id is None, file_name
-        assert isinstance(file_mtime, float), file_mtime
+        assert isinstance(file_stat, fbuild.db.backend.FileStat) or \
+            file_stat is None, file_stat
         assert isinstance(file_digest, str), file_digest
 
+        if file_stat is None:
+            file_stat = (None, None, None, None)
+        elif file_stat.inode >= 1 << 63:
+            # sqlite only stores signed 64 bit integers.
+            file_stat = file_stat._replace(inode=file_stat.inode - (1 << 64))
+
         if file_id is None:
             self.cursor.execute('''
-                INSERT INTO File (file_name,file_mtime,file_digest)
-                VALUES (?,?,?)
-                ''', (file_name, file_mtime, file_digest))
+                INSERT OR IGNORE INTO File (file_name,file_mtime_ns,file_size,
+                    file_inode,file_ctime_ns,file_digest)
+                VALUES (?,?,?,?,?,?)
+                ''', (file_name,) + tuple(file_stat) + (file_digest,))
 
-            file_id = self.cursor.lastrowid
-        else:
-            self.cursor.execute(
-                'UPDATE File SET file_mtime=?, file_digest=? WHERE file_id=?',
-                (file_mtime, file_digest, file_id))
+            if self.cursor.rowcount == 1:
+                return self.cursor.lastrowid
+
+            # Another connection added the file since we looked it up, so
+            # update that row instead.
+            file_id, = self.cursor.execute(
+                'SELECT file_id FROM File WHERE file_name=?',
+                (file_name,)).fetchone()
+
+        self.cursor.execute('''
+            UPDATE File
+            SET file_mtime_ns=?, file_size=?, file_inode=?, file_ctime_ns=?,
+                file_digest=?
+            WHERE file_id=?
+            ''', tuple(file_stat) + (file_digest, file_id))
 
         return file_id
 
@@ -527,3 +728,55 @@ class SqliteBackend(fbuild.db.backend.Backend):
             (file_id,))
 
         self.cursor.execute('DELETE FROM File WHERE file_name=?', (file_name,))
+
+    # --------------------------------------------------------------------------
+
+    def find_task_durations(self, task_keys):
+        """Returns a dictionary of how many seconds each of the scheduler's
+        tasks took the last time they ran. Tasks that never ran are left
+        out."""
+
+        durations = {}
+        for task_key in task_keys:
+            self.cursor.execute(
+                'SELECT task_duration FROM TaskDuration WHERE task_key=?',
+                (task_key,))
+
+            rows = self.cursor.fetchall()
+            if rows:
+                (durations[task_key],), = rows
+
+        return durations
+
+
+    def save_task_durations(self, durations):
+        """Insert or update how many seconds the scheduler's tasks took, and
+        forget the tasks that haven't run since we connected."""
+
+        # Make sure we got the right types.
+        assert all(isinstance(k, str) for k in durations), durations
+
+        self._seen_task_keys.update(durations)
+
+        with self.conn:
+            self.cursor.executemany('''
+                INSERT OR REPLACE INTO TaskDuration (task_key, task_duration)
+                VALUES (?,?)
+                ''', durations.items())
+
+        # Otherwise the tasks of sources that were deleted or renamed are kept
+        # forever.
+        stale = [task_key for task_key, in self.cursor.execute(
+                'SELECT task_key FROM TaskDuration').fetchall()
+            if task_key not in self._seen_task_keys]
+        if stale:
+            self.delete_task_durations(stale)
+
+
+    def delete_task_durations(self, task_keys):
+        """Remove how long the tasks took from the database."""
+
+        with self.conn:
+            self.cursor.executemany(
+                'DELETE FROM TaskDuration WHERE task_key=?',
+                ((task_key,) for task_key in task_keys))
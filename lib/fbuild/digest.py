@@ -0,0 +1,89 @@
+import hashlib
+import mmap
+import os
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# ------------------------------------------------------------------------------
+
+# The algorithms that can be used to digest files and functions.
+ALGORITHMS = {
+    'md5': hashlib.md5,
+    'sha1': hashlib.sha1,
+}
+
+if hasattr(hashlib, 'blake2b'):
+    ALGORITHMS['blake2b'] = lambda *args: hashlib.blake2b(*args, digest_size=16)
+
+if xxhash is not None:
+    ALGORITHMS['xxhash'] = getattr(xxhash, 'xxh3_128', xxhash.xxh64)
+
+_default_algorithm = 'md5'
+
+# Files at least this big are mapped into memory instead of being read.
+_MMAP_SIZE = 1 << 20
+
+# ------------------------------------------------------------------------------
+
+def set_default_algorithm(name):
+    '''
+    Set the algorithm used to compute digests.
+    '''
+    if name not in ALGORITHMS:
+        raise ValueError('unknown digest algorithm: %r' % name)
+
+    global _default_algorithm
+    _default_algorithm = name
+
+
+def default_algorithm():
+    '''
+    Return the name of the algorithm used to compute digests.
+    '''
+    return _default_algorithm
+
+# ------------------------------------------------------------------------------
+
+def new(data=b''):
+    '''
+    Create a new hash object using the default algorithm.
+    '''
+    m = ALGORITHMS[_default_algorithm]()
+    if data:
+        m.update(data)
+    return m
+
+
+def digest_file(filename, chunksize=65536):
+    '''
+    Hash the contents of the file and return the hex digest. Large files are
+    hashed straight from a memory map, and the rest are read into a single
+    reused buffer.
+    '''
+
+    m = new()
+
+    with open(filename, 'rb', buffering=0) as f:
+        if os.fstat(f.fileno()).st_size >= _MMAP_SIZE:
+            try:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                # Not every file can be mapped, so fall back to reading it.
+                pass
+            else:
+                with mapped:
+                    m.update(mapped)
+                return m.hexdigest()
+
+        buf = bytearray(chunksize)
+        view = memoryview(buf)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            m.update(view[:n])
+
+    return m.hexdigest()
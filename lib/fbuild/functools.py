@@ -65,10 +65,11 @@ def call(function, *args, **kwargs):
 
 # ------------------------------------------------------------------------------
 
-def normalize_args(function, args, kwargs):
+def normalize_args(function, args, kwargs, spec=None):
     '''
     L{normalize_args} returns a normalized set of args and kwargs, with all the
-    defaults of the function specified.
+    defaults of the function specified. I{spec} is the function's
+    getfullargspec, if the caller already has it.
 
     >>> def foo(a, b, c='a', *args, e, f='b', **kwargs):
     ...     pass
@@ -86,7 +87,8 @@ def normalize_args(function, args, kwargs):
     True
     '''
     # Get the specification of the arguments for the function
-    spec = inspect.getfullargspec(function)
+    if spec is None:
+        spec = inspect.getfullargspec(function)
     fn_args = spec.args
     fn_kwargs = spec.kwonlyargs
     varargs = spec.varargs is not None
@@ -212,10 +214,11 @@ def normalize_args(function, args, kwargs):
 
 # ------------------------------------------------------------------------------
 
-def bind_args(function, args, kwargs):
+def bind_args(function, args, kwargs, spec=None):
     """
     Bind a function and all of it's arguments to the named values. This helps
-    with annotations from arbitrary functions.
+    with annotations from arbitrary functions. I{spec} is the function's
+    getfullargspec, if the caller already has it.
 
     >>> def foo(a, b, c=1, *args, d, e=2, **kwargs): pass
     >>> bind_args(foo, (1, 2), {'d': 3}) == {
@@ -230,8 +233,9 @@ def bind_args(function, args, kwargs):
     """
 
     function = unwrap(function)
-    args, kwargs = normalize_args(function, args, kwargs)
-    spec = inspect.getfullargspec(function)
+    if spec is None:
+        spec = inspect.getfullargspec(function)
+    args, kwargs = normalize_args(function, args, kwargs, spec)
     fn_args = spec.args
 
     if inspect.ismethod(function):
@@ -0,0 +1,59 @@
+import os
+
+# ------------------------------------------------------------------------------
+
+class JobServer:
+    """
+    A GNU make compatible jobserver. It holds a token for each job slot in a
+    pipe. The scheduler's worker threads take a token before they run a task,
+    and any make we run inherits the pipe through MAKEFLAGS to take tokens
+    for its own jobs. This keeps the total number of jobs, including those
+    of nested builds, within the slots:
+
+    >>> jobserver = JobServer(2)
+    >>> token = jobserver.acquire()
+    >>> jobserver.release(token)
+    >>> env = {'MAKEFLAGS': 'k -- FOO=bar'}
+    >>> jobserver.update_environ(env)
+    >>> env['MAKEFLAGS'] # doctest: +ELLIPSIS
+    'k -j --jobserver-fds=...,... --jobserver-auth=...,... -- FOO=bar'
+    >>> jobserver.close()
+    """
+
+    def __init__(self, slots):
+        self.slots = max(1, slots)
+        self._read_fd, self._write_fd = os.pipe()
+
+        # Unlike make, we don't keep an implicit slot for ourselves. The
+        # thread that spawns a make hands its slot over to it.
+        os.write(self._write_fd, b'+' * self.slots)
+
+    @property
+    def fds(self):
+        """The file descriptors that need to be passed on to a make."""
+        return (self._read_fd, self._write_fd)
+
+    def acquire(self):
+        """Wait for a free job slot and return its token."""
+        return os.read(self._read_fd, 1)
+
+    def release(self, token):
+        """Return the token of a job slot."""
+        os.write(self._write_fd, token)
+
+    def update_environ(self, env):
+        """Add the jobserver to the MAKEFLAGS of the environment. Both the
+        old and the new option names are set, so that any version of make
+        will find them."""
+
+        flags = ' -j --jobserver-fds={0},{1} --jobserver-auth={0},{1}'.format(
+            *self.fds)
+
+        # Everything after a '--' is a variable definition.
+        head, sep, tail = env.get('MAKEFLAGS', '').partition(' -- ')
+        env['MAKEFLAGS'] = (head + flags).strip() + sep + tail
+
+    def close(self):
+        """Close the pipe."""
+        os.close(self._read_fd)
+        os.close(self._write_fd)
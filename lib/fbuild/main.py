@@ -208,7 +208,23 @@ def main(argv=None):
         finally:
             ctx.save_configuration()
             ctx.db.shutdown()
+
+            if ctx.object_cache is not None:
+                ctx.object_cache.close()
+
+            if ctx.remote_cache is not None:
+                ctx.remote_cache.close()
+
+            if ctx.config_cache is not None:
+                ctx.config_cache.close()
+
+            if ctx.early_cutoff is not None:
+                ctx.early_cutoff.close()
+
+            if ctx.distributor is not None:
+                ctx.distributor.close()
     finally:
         ctx.scheduler.shutdown()
+        ctx.tracer.close()
 
     return result
@@ -0,0 +1,168 @@
+import os
+import shutil
+import sys
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from fbuild.path import Path
+
+# ------------------------------------------------------------------------------
+
+# The linux ioctl that makes a file share the blocks of another file.
+_FICLONE = 0x40049409
+
+def default_root():
+    """Return the directory the object cache is kept in by default."""
+
+    cache_home = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return Path(cache_home, 'fbuild', 'objects')
+
+# ------------------------------------------------------------------------------
+
+class ObjectCache:
+    """
+    A content addressed cache of compiled objects that is shared between
+    builds. A build that compiles the same code with the same compiler and
+    flags as an earlier build, even one in another checkout or buildroot,
+    copies the earlier object instead of running the compiler again. Once
+    the cache grows past I{max_size} bytes, the least recently used objects
+    are evicted.
+    """
+
+    def __init__(self, root, max_size, *, logger=None):
+        self.root = Path(root)
+        self.max_size = max_size
+        self.logger = logger
+        self.hits = 0
+        self.misses = 0
+        self._stored = 0
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return self.root / key[:2] / key[2:]
+
+    def restore(self, key, dst):
+        """Copy the object cached under the key to I{dst}. Returns False if
+        no object has been cached under the key."""
+
+        path = self._path(key)
+        try:
+            _clone(path, dst)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return False
+
+        # Mark the object as recently used so that it is evicted last.
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        with self._lock:
+            self.hits += 1
+        return True
+
+    def store(self, key, src):
+        """Cache the object I{src} under the key. The cache is only an
+        optimization, so failing to write to it doesn't fail the build."""
+
+        path = self._path(key)
+
+        # Write to a temporary file first so that concurrent builds never see
+        # a partially written object.
+        tmp = path + '.%d.%d.tmp' % (os.getpid(), threading.get_ident())
+        try:
+            path.parent.makedirs()
+            _clone(src, tmp)
+            os.replace(tmp, path)
+            size = path.getsize()
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+
+        with self._lock:
+            self._stored += size
+
+    def trim(self):
+        """Evict the least recently used objects until the cache fits in
+        its size limit again, and return how many were evicted."""
+
+        entries = []
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                # Skip objects that are still being written.
+                if filename.endswith('.tmp'):
+                    continue
+
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+        if total <= self.max_size:
+            return 0
+
+        # Leave some room so that we don't need to trim after every build.
+        limit = self.max_size * 0.9
+
+        evicted = 0
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= limit:
+                break
+
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+
+            total -= size
+            evicted += 1
+
+        return evicted
+
+    def close(self):
+        """Report how well the cache worked, and trim it if this build
+        added anything to it."""
+
+        evicted = self.trim() if self._stored else 0
+
+        if self.logger is not None and (self.hits or self.misses):
+            self.logger.check(' * object cache',
+                '%d hits, %d misses, %d evicted' % (
+                    self.hits, self.misses, evicted),
+                color='yellow')
+
+# ------------------------------------------------------------------------------
+
+def _clone(src, dst):
+    """Copy I{src} to I{dst}, sharing the blocks of the file if the
+    filesystem supports it. We don't hard link the files, as tools like
+    strip and objcopy modify objects in place, which would corrupt the
+    cache."""
+
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            if fcntl is not None and sys.platform.startswith('linux'):
+                try:
+                    fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+                except OSError:
+                    pass
+                else:
+                    return
+
+            shutil.copyfileobj(fsrc, fdst)
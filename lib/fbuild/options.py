@@ -2,6 +2,9 @@ import argparse
 import optparse
 import warnings
 
+import fbuild.db.config_cache
+import fbuild.digest
+import fbuild.objcache
 import fbuild.target
 
 # ------------------------------------------------------------------------------
@@ -95,6 +98,14 @@ def make_parser():
                         help='print out extra debugging info')
     parser.add_argument('-j', '--jobs', dest='threadcount', metavar='N', type=int,
                         default=1, help='Allow N jobs at once')
+    parser.add_argument('--jobserver', action='store_true', default=False,
+                        help='share the -j job slots with the make commands ' \
+                             'that are run with jobserver=True through a GNU ' \
+                             'make jobserver')
+    parser.add_argument('--no-scheduler-lock', dest='scheduler_locked',
+                        action='store_false', default=True,
+                        help='run jobs concurrently all the time instead of only ' \
+                             'while they wait on commands (jobs must be thread safe)')
     parser.add_argument('--no-color', action='store_true', default=False,
                         help='do not use colors')
     parser.add_argument('--nocolor', action='store_true', default=False,
@@ -127,6 +138,43 @@ def make_parser():
                         help='explain why a function was not cached')
     parser.add_argument('--database-engine', choices=('pickle', 'sqlite', 'cache'),
                         default='pickle', help='which database engine to use')
+    parser.add_argument('--concurrent-database', action='store_true', default=False,
+                        help='access the database directly from the worker threads ' \
+                             'instead of through the database thread (sqlite engine only)')
+    parser.add_argument('--fast-database', action='store_true', default=False,
+                        help='commit the database in groups of calls with write-ahead ' \
+                             'logging, which may lose the last calls made if the build ' \
+                             'crashes (sqlite engine only)')
+    parser.add_argument('--digest', choices=sorted(fbuild.digest.ALGORITHMS),
+                        default='md5', help='which algorithm to use to detect changed files')
+    parser.add_argument('--object-cache', metavar='DIR', nargs='?',
+                        const=fbuild.objcache.default_root(),
+                        help='reuse compiled objects from other builds by caching them ' \
+                             'in DIR (default: %s)' % fbuild.objcache.default_root())
+    parser.add_argument('--object-cache-size', metavar='MB', type=int, default=5120,
+                        help='evict the least recently used objects once the object ' \
+                             'cache is bigger than MB megabytes (default: 5120)')
+    parser.add_argument('--config-cache', metavar='DIR', nargs='?',
+                        const=fbuild.db.config_cache.default_root(),
+                        help='share the results of configuration checks with other ' \
+                             'projects by caching them in DIR (default: %s)' %
+                             fbuild.db.config_cache.default_root())
+    parser.add_argument('--no-config-batching', dest='config_batching',
+                        action='store_false', default=True,
+                        help='run every config test in a program of its own, instead ' \
+                             'of merging the tests of a header into one program')
+    parser.add_argument('--early-cutoff', action='store_true', default=False,
+                        help='skip compiling sources whose preprocessed code did not ' \
+                             'change, such as after editing comments in a header')
+    parser.add_argument('--workers', metavar='HOST:PORT,...',
+                        help='compile objects on the fbuild-workers at these ' \
+                             'addresses, and raise -j to match their slots')
+    parser.add_argument('--remote-cache', metavar='URL',
+                        help='share the files made by cached functions with other ' \
+                             'builds through the cache server at URL')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='write a chrome trace of the build to FILE, which ' \
+                             'can be loaded into chrome://tracing or Perfetto')
     parser.add_argument('--no-warnings', action='store_true', default=False,
                         help='suppress warnings for the build script')
 
@@ -1,10 +1,10 @@
 import collections
-import hashlib
 import itertools
 import os
 import shutil
 import sys
 
+import fbuild.digest
 import fbuild.fnmatch
 import fbuild.glob
 
@@ -293,15 +293,9 @@ class Path(str):
             raise
 
     def digest(self, chunksize=65536):
-        """Hash the file usind md5 and return the digest."""
-        with open(self, 'rb') as f:
-            m = hashlib.md5()
-            while True:
-                d = f.read(chunksize)
-                if not d:
-                    break
-                m.update(d)
-            return m.hexdigest()
+        """Hash the file using the default digest algorithm and return the
+        digest."""
+        return fbuild.digest.digest_file(self, chunksize)
 
     def mkdir(self):
         return os.mkdir(self)
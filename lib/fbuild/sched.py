@@ -1,6 +1,8 @@
 import collections
 import contextlib
+import functools
 import io
+import itertools
 import operator
 import queue
 import sys
@@ -9,6 +11,7 @@ import time
 import _thread
 
 import fbuild
+import fbuild.trace
 
 # ------------------------------------------------------------------------------
 
@@ -66,9 +69,22 @@ class Scheduler:
     >>> scheduler.map_with_dependencies(deps, f, ['a', 'b', 'c'])
     ['c', 'b', 'a']
 
+    The tasks of *map_with_dependencies* are started in order of the longest
+    chain of work that depends on them, using how long each task took in
+    earlier builds if the scheduler has a *history*.
+
+    By default, only one task runs at a time, except inside of
+    *interruptible* blocks such as when waiting on a subprocess. If the tasks
+    are thread safe, the scheduler can be created with *locked* set to False,
+    which lets all the tasks run concurrently.
     """
 
-    def __init__(self, threadcount=0, *, logger=None):
+    # How long, in seconds, a worker thread that is waiting on nested tasks
+    # waits for one to finish before checking for new work.
+    _POLL_INTERVAL = 0.01
+
+    def __init__(self, threadcount=0, *, logger=None, locked=True,
+            history=None, jobserver=None, tracer=None, context=None):
         # We need at least 1 thread.
         threadcount = max(1, threadcount)
 
@@ -76,10 +92,21 @@ class Scheduler:
         self.__threads = []
 
         # Our work queue of ready tasks that is shared with all the worker
-        # threads. We use a lifo queue as we want to do work in the order it
-        # comes in since it's less likely to have dependencies on later
-        # functions.
-        self.__ready_queue = queue.LifoQueue()
+        # threads. Tasks with the same priority are run last in, first out,
+        # as we want to do work in the order it comes in since it's less
+        # likely to have dependencies on later functions.
+        self.__ready_queue = _ReadyQueue()
+
+        # Where we remember how long the tasks took, if anywhere. This needs
+        # find_task_durations and save_task_durations methods, such as the
+        # ones of fbuild.db.database.Database.
+        self.__history = history
+
+        # Where the tasks get the context they run in, if anywhere. This is
+        # called from the thread that schedules the tasks, and returns a
+        # context manager that's entered by the thread that runs them, such
+        # as fbuild.db.database.Database.call_context.
+        self.__context = context
 
         # All the worker threads need to share a logger object to make sure we
         # don't have races when we're logging to the console. So we need to
@@ -87,13 +114,24 @@ class Scheduler:
         if logger is None:
             import fbuild.console
             logger = fbuild.console.Log()
+        self.__logger = logger
 
-        # Set up the controlling lock.
-        self.__controlling_lock = threading.Lock()
+        # Set up the controlling lock. Without it, the tasks are free to run
+        # concurrently.
+        if locked:
+            self.__controlling_lock = threading.Lock()
+        else:
+            self.__controlling_lock = None
 
-        # Spin up our threads!
+        # Record the tasks we run in the fbuild.trace.Tracer, if we have one.
+        if tracer is None:
+            tracer = fbuild.trace.Tracer()
+
+        # Spin up our threads! If we have a fbuild.jobserver.JobServer, the
+        # threads share its job slots with the commands we run.
         for i in range(threadcount):
-            thread = WorkerThread(logger, self.__ready_queue, self.__controlling_lock)
+            thread = WorkerThread(logger, self.__ready_queue,
+                self.__controlling_lock, jobserver, tracer)
             self.__threads.append(thread)
             thread.start()
 
@@ -123,12 +161,15 @@ class Scheduler:
         context switching automatically.
         """
 
-        try:
-            self.__controlling_lock.release()
-        except (RuntimeError, _thread.error):
+        if self.__controlling_lock is None:
             was_locked = False
         else:
-            was_locked = True
+            try:
+                self.__controlling_lock.release()
+            except (RuntimeError, _thread.error):
+                was_locked = False
+            else:
+                was_locked = True
         # time.sleep(0) is an easy way of forcing a context switch.
         try:
             yield lambda: time.sleep(0)
@@ -171,8 +212,14 @@ class Scheduler:
                         # ignore missing dependencies
                         pass
 
+        # Start the tasks at the head of the longest chains first, so that
+        # they don't hold up the end of the build.
+        self._prioritize(tasks.values())
+
         # Evaluate the functions.
+        starttime = time.time()
         self._evaluate(list(tasks.values()))
+        self._report(tasks.values(), time.time() - starttime)
 
         # Sort the functions in a depth first order. Otherwise, the order of
         # the function evaluation could change between calls, which could break
@@ -194,9 +241,84 @@ class Scheduler:
 
         return results
 
+    def _prioritize(self, tasks):
+        """Set the priority of each task to the length of the longest chain of
+        tasks that depend on it, weighted by how long each task took the last
+        time it ran."""
+
+        if self.__history is None:
+            durations = {}
+        else:
+            durations = self.__history.find_task_durations(
+                list({t.key for t in tasks}))
+
+        # Tasks we haven't seen before are assumed to take an average amount
+        # of time.
+        if durations:
+            default = sum(durations.values()) / len(durations)
+        else:
+            default = 1.0
+
+        paths = _critical_paths(tasks,
+            lambda task: durations.get(task.key, default))
+
+        for task in tasks:
+            task.priority = paths[task]
+
+    def _report(self, tasks, elapsed):
+        """Log how much parallelism the tasks achieved compared to the bound
+        set by their critical path, and remember how long they took."""
+
+        durations = {t.key: t.endtime - t.starttime for t in tasks}
+        if not durations:
+            return
+
+        if self.__history is not None:
+            self.__history.save_task_durations(durations)
+
+        work = sum(t.endtime - t.starttime for t in tasks)
+        critical_path = max(_critical_paths(tasks,
+            lambda task: task.endtime - task.starttime).values())
+
+        # We can't do better than running all the threads all the time, or
+        # than running the critical path without any gaps.
+        if critical_path > 0:
+            bound = min(self.threadcount, work / critical_path)
+        else:
+            bound = self.threadcount
+
+        self.__logger.log(
+            ' - %d tasks, %.2f sec: parallelism %.2f, critical path %.2f sec '
+            'allows %.2f' % (
+                len(durations),
+                elapsed,
+                work / elapsed if elapsed > 0 else 0.0,
+                critical_path,
+                bound),
+            verbose=2)
+
     def _evaluate(self, tasks):
         """Evaluate the function over these tasks and return the results."""
 
+        # Detect if the current thread is one of our worker threads. See
+        # below.
+        current_thread = threading.current_thread()
+
+        # Tasks that weren't given a priority inherit it from the task that
+        # scheduled them, so that they aren't held up by less important work
+        # while that task is waiting on them.
+        if isinstance(current_thread, WorkerThread):
+            priority = current_thread.priority
+        else:
+            priority = 0.0
+
+        for task in tasks:
+            if task.priority is None:
+                task.priority = priority
+
+            if self.__context is not None:
+                task.context = self.__context()
+
         # Keep a counter for the number of active tasks. When this reaches 0 we
         # know we can exit.
         count = 0
@@ -229,7 +351,6 @@ class Scheduler:
         # one of our worker threads, and if so, we know we're are being used
         # recursively. When this happens, we know we can reuse this thread to
         # run another queued up function.
-        current_thread = threading.current_thread()
 
         # The list of function results.
         results = []
@@ -243,13 +364,21 @@ class Scheduler:
                     with self.interruptible():
                         task = current_thread.read_task(block=False)
                 except queue.Empty:
-                    pass
+                    ran_task = False
                 else:
                     current_thread.run_one(task)
+                    ran_task = True
 
-                # See if any of our tasks finished.
+                # See if any of our tasks finished. If there was nothing for
+                # us to run, wait a little while for them rather than
+                # spinning.
                 try:
-                    task = done_queue.get(block=False)
+                    if ran_task:
+                        task = done_queue.get(block=False)
+                    else:
+                        with self.interruptible():
+                            task = done_queue.get(
+                                timeout=self._POLL_INTERVAL)
                 except queue.Empty:
                     # No tasks done, so loop.
                     continue
@@ -318,21 +447,86 @@ class Scheduler:
 
 # ------------------------------------------------------------------------------
 
+class _ReadyQueue(queue.PriorityQueue):
+    """The queue of tasks that are ready to run. The tasks with the highest
+    priority come out first, and tasks of the same priority come out last in,
+    first out. The None we use to wake up the threads comes before any
+    task."""
+
+    def _init(self, maxsize):
+        super()._init(maxsize)
+        self._counter = itertools.count()
+
+    def _put(self, item):
+        if item is None:
+            priority = float('inf')
+        else:
+            done_queue, task = item
+            priority = task.priority or 0.0
+
+        super()._put((-priority, -next(self._counter), item))
+
+    def _get(self):
+        return super()._get()[-1]
+
+
+def _critical_paths(tasks, weight):
+    """Return a dictionary of the longest weighted chain of tasks that depend
+    on each task, starting with the task itself. Dependency loops are
+    ignored."""
+
+    dependents = collections.defaultdict(list)
+    for task in tasks:
+        for dep in task.dependencies:
+            dependents[dep].append(task)
+
+    # Walk the graph without recursion, since the chains can be long.
+    paths = {}
+    for root in tasks:
+        if root in paths:
+            continue
+
+        active = {root}
+        stack = [(root, iter(dependents[root]))]
+        while stack:
+            task, children = stack[-1]
+            for child in children:
+                if child not in paths and child not in active:
+                    active.add(child)
+                    stack.append((child, iter(dependents[child])))
+                    break
+            else:
+                stack.pop()
+                active.discard(task)
+                paths[task] = weight(task) + max(
+                    [paths[c] for c in dependents[task] if c in paths] or
+                    [0.0])
+
+    return paths
+
+# ------------------------------------------------------------------------------
+
 class WorkerThread(threading.Thread):
     """
     The scheduler's worker thread. This loops forever until there is no work
     left.
     """
 
-    def __init__(self, logger, ready_queue, controlling_lock):
+    def __init__(self, logger, ready_queue, controlling_lock, jobserver=None,
+            tracer=None):
         super().__init__()
         self.daemon = True
 
         self.__logger = logger
         self.__ready_queue = ready_queue
         self.__controlling_lock = controlling_lock
+        self.__jobserver = jobserver
+        self.__tracer = tracer or fbuild.trace.Tracer()
         self.__finished = False
 
+        # The priority of the task we're running.
+        self.priority = 0.0
+
     def shutdown(self):
         """Tell the thread to exit."""
         self.__finished = True
@@ -342,9 +536,25 @@ class WorkerThread(threading.Thread):
             while not self.__finished:
                 with self.__logger.log_from_thread():
                     queue_task = self.read_task()
-                    with self.__controlling_lock:
-                        if not self.run_one(queue_task):
-                            break
+
+                    # Wait for a job slot. Tasks run by nested calls to the
+                    # scheduler share the slot of the task that made them.
+                    if queue_task is not None and self.__jobserver is not None:
+                        token = self.__jobserver.acquire()
+                    else:
+                        token = None
+
+                    try:
+                        if self.__controlling_lock is None:
+                            if not self.run_one(queue_task):
+                                break
+                        else:
+                            with self.__controlling_lock:
+                                if not self.run_one(queue_task):
+                                    break
+                    finally:
+                        if token is not None:
+                            self.__jobserver.release(token)
         except KeyboardInterrupt:
             # let the main thread know we got a SIGINT
             _thread.interrupt_main()
@@ -370,9 +580,13 @@ class WorkerThread(threading.Thread):
                 return False
 
             done_queue, task = queue_task
+            priority = self.priority
+            self.priority = task.priority
             try:
-                task.run()
+                with self.__tracer.span(task.key, 'task'):
+                    task.run()
             finally:
+                self.priority = priority
                 done_queue.put(task)
         finally:
             self.__ready_queue.task_done()
@@ -394,6 +608,24 @@ class Task:
         self.done = False
         self.dependencies = []
         self.exc = None
+        self.priority = None
+        self.starttime = None
+        self.endtime = None
+        self.context = None
+
+    @property
+    def key(self):
+        """A name for this task that stays the same between builds."""
+
+        function = self.function
+        while isinstance(function, functools.partial):
+            function = function.func
+        function = getattr(function, '__func__', function)
+
+        return '%s.%s:%s' % (
+            getattr(function, '__module__', None),
+            getattr(function, '__qualname__', type(function).__name__),
+            self.src)
 
     def can_run(self):
         """Returns True if all of this task's dependencies are done. Otherwise
@@ -410,7 +642,14 @@ class Task:
     def run(self):
         """Run the task's function."""
 
+        self.starttime = time.time()
         try:
-            self.result = self.function(self.src)
+            if self.context is None:
+                self.result = self.function(self.src)
+            else:
+                with self.context:
+                    self.result = self.function(self.src)
         except Exception as e:
             self.exc = e
+        finally:
+            self.endtime = time.time()
@@ -0,0 +1,107 @@
+import json
+import os
+import threading
+import time
+
+# ------------------------------------------------------------------------------
+
+class Tracer:
+    """
+    Record what the build spends its time on as Chrome trace events, which
+    can be loaded into chrome://tracing or Perfetto. The events are written
+    out to the file as they finish, so a trace of an interrupted build can
+    still be loaded. Without a file name, nothing is recorded.
+    """
+
+    def __init__(self, filename=None):
+        self._lock = threading.Lock()
+        self._threads = set()
+        self._pid = os.getpid()
+        self._first = True
+
+        if filename is None:
+            self._file = None
+        else:
+            self._file = open(filename, 'w')
+            self._file.write('[')
+
+    def span(self, name, category, **args):
+        """Return a context manager that records the time spent inside of it.
+        The name and args can be changed until the span ends."""
+        return _Span(self if self._file is not None else None, name, category,
+            args)
+
+    def close(self):
+        """Finish writing the trace."""
+
+        with self._lock:
+            if self._file is not None:
+                self._file.write('\n]\n')
+                self._file.close()
+                self._file = None
+
+    def _write(self, event):
+        thread = threading.current_thread()
+
+        with self._lock:
+            if self._file is None:
+                return
+
+            # Name the thread the first time we see it.
+            if thread.ident not in self._threads:
+                self._threads.add(thread.ident)
+                self._write_event({
+                    'name': 'thread_name',
+                    'ph': 'M',
+                    'tid': thread.ident,
+                    'args': {'name': thread.name},
+                })
+
+            event['tid'] = thread.ident
+            self._write_event(event)
+
+    def _write_event(self, event):
+        event['pid'] = self._pid
+
+        if self._first:
+            self._first = False
+        else:
+            self._file.write(',')
+
+        self._file.write('\n')
+        self._file.write(json.dumps(event, default=str))
+
+# ------------------------------------------------------------------------------
+
+class _Span:
+    """A timed section of the build."""
+
+    def __init__(self, tracer, name, category, args):
+        self._tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        if self._tracer is not None:
+            self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._tracer is None:
+            return
+
+        end = time.time()
+
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+
+        # Chrome traces are measured in microseconds.
+        self._tracer._write({
+            'name': self.name,
+            'cat': self.category,
+            'ph': 'X',
+            'ts': int(self._start * 1e6),
+            'dur': int((end - self._start) * 1e6),
+            'args': self.args,
+        })
@@ -0,0 +1,430 @@
+"""
+Compile objects on other machines. An fbuild-worker runs on each machine
+that lends its cpus to the build:
+
+    fbuild-worker --port 8100 --jobs 8
+
+The build preprocesses each source itself, and a L{Distributor} sends the
+preprocessed source and the compiler's command line to a worker, which sends
+back the object. Workers run the compilers they are asked for, so they should
+only listen on a network that is trusted.
+"""
+
+import argparse
+import json
+import os
+import queue
+import shutil
+import socket
+import socketserver
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+
+import fbuild
+
+# ------------------------------------------------------------------------------
+
+# The compilers that workers run by default.
+COMPILERS = ('cc', 'c++', 'gcc', 'g++', 'clang', 'clang++')
+
+# Arguments that are replaced with the worker's own files.
+_INPUT = '{input}'
+_OUTPUT = '{output}'
+
+class ProtocolError(fbuild.Error):
+    pass
+
+def _send(f, header, data=b''):
+    """Send a message, which is a json header followed by some data."""
+
+    header = json.dumps(header).encode()
+    f.write(struct.pack('!II', len(header), len(data)))
+    f.write(header)
+    f.write(data)
+    f.flush()
+
+def _recv(f):
+    """Receive a message, or return None if the connection was closed."""
+
+    sizes = f.read(8)
+    if not sizes:
+        return None, None
+    if len(sizes) != 8:
+        raise ProtocolError('truncated message')
+
+    header_size, data_size = struct.unpack('!II', sizes)
+    header = f.read(header_size)
+    data = f.read(data_size)
+    if len(header) != header_size or len(data) != data_size:
+        raise ProtocolError('truncated message')
+
+    return json.loads(header.decode()), data
+
+def _compiler_version(exe):
+    """Return the first line of the compiler's version, which is used to
+    make sure that the build and the workers run the same compiler."""
+
+    try:
+        stdout = subprocess.check_output([exe, '--version'],
+            stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return stdout.decode(errors='replace').split('\n')[0]
+
+# ------------------------------------------------------------------------------
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server
+        _send(self.wfile, {
+            'slots': server.slots,
+            'compilers': server.compilers,
+        })
+
+        while True:
+            try:
+                header, data = _recv(self.rfile)
+            except (OSError, ProtocolError, ValueError):
+                return
+
+            if header is None:
+                return
+
+            with server.semaphore:
+                response, obj = server.compile(header, data)
+
+            try:
+                _send(self.wfile, response, obj)
+            except OSError:
+                return
+
+
+class Worker(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """Compile the preprocessed sources that builds send to the address,
+    running at most I{slots} compilers at a time."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('localhost', 0), *,
+            slots=None,
+            compilers=COMPILERS):
+        self.slots = slots or os.cpu_count() or 1
+        self.semaphore = threading.BoundedSemaphore(self.slots)
+
+        # Look the compilers up once, rather than for every compile.
+        self._exes = {}
+        self.compilers = {}
+        for name in compilers:
+            exe = shutil.which(name)
+            if exe is not None:
+                self._exes[name] = exe
+                self.compilers[name] = _compiler_version(exe)
+
+        super().__init__(address, _Handler)
+
+    def compile(self, header, data):
+        """Compile the preprocessed source, and return the response and the
+        object."""
+
+        argv = header['argv']
+        exe = self._exes.get(os.path.basename(argv[0]))
+        if exe is None:
+            return {
+                'returncode': -1,
+                'stdout': '',
+                'stderr': 'compiler not allowed: %s' % argv[0],
+            }, b''
+
+        with tempfile.TemporaryDirectory() as dirname:
+            # The suffix tells the compiler which language the source is in.
+            src = os.path.join(dirname, 'src' + os.path.basename(
+                header['suffix']))
+            dst = os.path.join(dirname, 'dst.o')
+            with open(src, 'wb') as f:
+                f.write(data)
+
+            cmd = [exe]
+            for arg in argv[1:]:
+                cmd.append(src if arg == _INPUT else dst if arg == _OUTPUT
+                    else arg)
+
+            p = subprocess.Popen(cmd,
+                cwd=dirname,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+            stdout, stderr = p.communicate()
+
+            obj = b''
+            if p.returncode == 0:
+                with open(dst, 'rb') as f:
+                    obj = f.read()
+
+        return {
+            'returncode': p.returncode,
+            'stdout': stdout.decode(errors='replace'),
+            'stderr': stderr.decode(errors='replace'),
+        }, obj
+
+    @property
+    def address(self):
+        host, port = self.server_address[:2]
+        return '%s:%d' % (host, port)
+
+# ------------------------------------------------------------------------------
+
+class _WorkerState:
+    def __init__(self, address):
+        host, _, port = address.rpartition(':')
+        self.address = address
+        self.host = host
+        self.port = int(port)
+        self.slots = None
+        self.compilers = {}
+        self.busy = 0
+        self.failed_until = 0
+        self.connections = queue.LifoQueue()
+
+    def free(self):
+        # Until we've connected, we don't know how many slots there are, so
+        # just try one compile.
+        return (self.slots or 1) - self.busy
+
+
+class Distributor:
+    """
+    Send compiles to the workers at the I{addresses}, which are of the form
+    I{host:port}. Each compile goes to the worker with the most free slots.
+    When all of the workers are busy, or one fails, the caller compiles the
+    source itself. A worker that fails isn't used again for a while.
+    """
+
+    def __init__(self, addresses, *, logger=None, retry_after=30,
+            timeout=300):
+        self.logger = logger
+        self.remote = 0
+        self.local = 0
+        self._workers = [_WorkerState(address) for address in addresses]
+        self._retry_after = retry_after
+        self._timeout = timeout
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def _version(self, exe):
+        with self._lock:
+            try:
+                return self._versions[exe]
+            except KeyError:
+                pass
+
+        version = _compiler_version(exe)
+
+        with self._lock:
+            self._versions[exe] = version
+        return version
+
+    def _acquire(self, compiler, version):
+        """Reserve a slot on the least busy worker that has the compiler."""
+
+        now = time.time()
+        with self._lock:
+            best = None
+            for worker in self._workers:
+                if worker.failed_until > now or worker.free() <= 0:
+                    continue
+
+                # Once we know what the worker has, skip it if it can't run
+                # the same compiler.
+                if worker.slots is not None and \
+                        worker.compilers.get(compiler) != version:
+                    continue
+
+                if best is None or worker.free() > best.free():
+                    best = worker
+
+            if best is not None:
+                best.busy += 1
+            return best
+
+    def _release(self, worker, connection, failed=False):
+        with self._lock:
+            worker.busy -= 1
+            if failed:
+                worker.failed_until = time.time() + self._retry_after
+
+        if failed:
+            if connection is not None:
+                connection.close()
+            if self.logger is not None:
+                self.logger.log('worker %s failed, compiling locally' %
+                    worker.address, color='red')
+        else:
+            worker.connections.put(connection)
+
+    def _connect(self, worker):
+        try:
+            return worker.connections.get_nowait()
+        except queue.Empty:
+            pass
+
+        sock = socket.create_connection((worker.host, worker.port),
+            timeout=self._timeout)
+        connection = sock.makefile('rwb')
+        sock.close()
+
+        header, _ = _recv(connection)
+        if header is None:
+            raise ProtocolError('worker closed the connection')
+
+        with self._lock:
+            worker.slots = header['slots']
+            worker.compilers = header['compilers']
+
+        return connection
+
+    def _discover(self):
+        """Connect to the workers we haven't heard from yet, so that we know
+        how many slots they have before sharing the compiles out."""
+
+        now = time.time()
+        for worker in self._workers:
+            with self._lock:
+                if worker.slots is not None or worker.failed_until > now:
+                    continue
+
+            try:
+                connection = self._connect(worker)
+            except (OSError, ValueError, ProtocolError):
+                with self._lock:
+                    worker.failed_until = time.time() + self._retry_after
+                if self.logger is not None:
+                    self.logger.log('worker %s failed, compiling locally' %
+                        worker.address, color='red')
+            else:
+                worker.connections.put(connection)
+
+    def slots(self):
+        """Connect to the workers, and return how many compiles they can run
+        at once."""
+
+        self._discover()
+
+        with self._lock:
+            return sum(worker.slots for worker in self._workers
+                if worker.slots is not None)
+
+    def compile(self, cmd, src, dst):
+        """Compile the preprocessed I{src} into I{dst} on a worker with the
+        command line I{cmd}. Returns the worker's address, stdout and stderr,
+        or None if the caller needs to compile the source itself."""
+
+        compiler = os.path.basename(cmd[0])
+        version = self._version(cmd[0])
+
+        self._discover()
+        worker = self._acquire(compiler, version)
+        if worker is None:
+            with self._lock:
+                self.local += 1
+            return None
+
+        connection = None
+        try:
+            connection = self._connect(worker)
+
+            # The first time we connect we learn which compilers the worker
+            # has, so check again.
+            if worker.compilers.get(compiler) != version:
+                self._release(worker, connection)
+                with self._lock:
+                    self.local += 1
+                return None
+
+            with open(src, 'rb') as f:
+                data = f.read()
+
+            _send(connection, {
+                'argv': [_INPUT if arg == src else _OUTPUT if arg == dst
+                    else str(arg) for arg in cmd],
+                'suffix': src.ext,
+            }, data)
+
+            header, obj = _recv(connection)
+            if header is None:
+                raise ProtocolError('worker closed the connection')
+        except (OSError, ValueError, ProtocolError):
+            self._release(worker, connection, failed=True)
+            with self._lock:
+                self.local += 1
+            return None
+
+        self._release(worker, connection)
+
+        # Let the caller compile sources that fail, so that the errors
+        # refer to the real files.
+        if header['returncode'] != 0:
+            with self._lock:
+                self.local += 1
+            return None
+
+        with open(dst, 'wb') as f:
+            f.write(obj)
+
+        with self._lock:
+            self.remote += 1
+
+        return worker.address, header['stdout'].encode(), \
+            header['stderr'].encode()
+
+    def close(self):
+        """Report where the sources were compiled, and disconnect from the
+        workers."""
+
+        if self.logger is not None and (self.remote or self.local):
+            self.logger.check(' * workers',
+                '%d compiled remotely, %d locally' % (self.remote, self.local),
+                color='yellow')
+
+        for worker in self._workers:
+            while True:
+                try:
+                    worker.connections.get_nowait().close()
+                except queue.Empty:
+                    break
+
+# ------------------------------------------------------------------------------
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Compile objects for fbuild builds on other machines.')
+    parser.add_argument('--host', default='localhost',
+                        help='the address to listen on (default: localhost)')
+    parser.add_argument('--port', type=int, default=8100,
+                        help='the port to listen on (default: 8100)')
+    parser.add_argument('-j', '--jobs', dest='slots', metavar='N', type=int,
+                        help='run at most N compilers at once ' \
+                             '(default: the number of cpus)')
+    parser.add_argument('--compiler', dest='compilers', metavar='NAME',
+                        action='append',
+                        help='allow the compiler NAME to be run, which can be ' \
+                             'given more than once (default: %s)' %
+                             ', '.join(COMPILERS))
+    options = parser.parse_args(argv)
+
+    worker = Worker((options.host, options.port),
+        slots=options.slots,
+        compilers=options.compilers or COMPILERS)
+    print('worker at %s with %d slots' % (worker.address, worker.slots))
+    try:
+        worker.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        worker.server_close()
+
+if __name__ == '__main__':
+    main()
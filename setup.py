@@ -44,7 +44,10 @@ setup(
         'fbuild.subprocess',
     ],
     entry_points={
-        'console_scripts': ['fbuild = fbuild.main:main']
+        'console_scripts': [
+            'fbuild = fbuild.main:main',
+            'fbuild-worker = fbuild.worker:main',
+        ]
     },
     package_dir={'': 'lib'},
     data_files=data_files,
@@ -7,10 +7,21 @@ import unittest
 
 sys.path.append(os.path.join(os.path.dirname(sys.argv[0]), '..', 'lib'))
 
+import test_config_c
+import test_config_cache
+import test_cutoff
+import test_database
 import test_fnmatch
 import test_functools
 import test_glob
+import test_interface
+import test_objcache
+import test_pch
+import test_remote_cache
 import test_scheduler
+import test_trace
+import test_unity
+import test_worker
 
 # -----------------------------------------------------------------------------
 
@@ -42,10 +53,21 @@ def main():
             else:
                 suite.addTest(test)
 
+    suite.addTest(test_config_c.suite())
+    suite.addTest(test_config_cache.suite())
+    suite.addTest(test_cutoff.suite())
+    suite.addTest(test_database.suite())
     suite.addTest(test_fnmatch.suite())
     suite.addTest(test_functools.suite())
     suite.addTest(test_glob.suite())
+    suite.addTest(test_interface.suite())
+    suite.addTest(test_objcache.suite())
+    suite.addTest(test_pch.suite())
+    suite.addTest(test_remote_cache.suite())
     suite.addTest(test_scheduler.suite())
+    suite.addTest(test_trace.suite())
+    suite.addTest(test_unity.suite())
+    suite.addTest(test_worker.suite())
 
     runner = unittest.TextTestRunner(verbosity=2)
     runner.run(suite)
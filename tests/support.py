@@ -0,0 +1,33 @@
+import tempfile
+import unittest
+
+import fbuild.context
+from fbuild.path import Path
+
+# -----------------------------------------------------------------------------
+
+class BuildTestCase(unittest.TestCase):
+    """A test case that builds in a temporary directory. I{args} are extra
+    options for the context, in which '{}' is replaced with the directory."""
+
+    args = []
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dirname = Path(self.tmpdir.name)
+
+        self.ctx = fbuild.context.make_default_context([
+            '--database-engine=cache',
+            '--buildroot', self.dirname / 'build'] +
+            [arg.format(self.dirname) for arg in self.args])
+        self.ctx.create_buildroot()
+        self.ctx.db.connect()
+
+    def tearDown(self):
+        self.ctx.db.shutdown()
+        self.ctx.scheduler.shutdown()
+        self.tmpdir.cleanup()
+
+    def write(self, name, code):
+        with open(self.dirname / name, 'w') as f:
+            f.write(code)
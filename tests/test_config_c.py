@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+import gc
+import shutil
+import tempfile
+import unittest
+
+import fbuild.builders.c.gcc
+import fbuild.config.c as c
+import fbuild.context
+from fbuild.path import Path
+
+# -----------------------------------------------------------------------------
+
+class stdlib_h(c.Test):
+    header = c.header_test('stdlib.h')
+
+    EXIT_SUCCESS = c.macro_test()
+    NOT_A_MACRO = c.macro_test()
+    div_t = c.type_test()
+    size_t = c.int_type_test()
+    abs = c.function_test('int', 'int')
+    abort = c.function_test('void', 'void')
+    not_a_function = c.function_test('int', 'int')
+    labs = c.function_test('long', 'long')
+    atoi = c.function_test('int', 'const char*', test='''
+        #include <stdlib.h>
+        int main() {
+            return atoi("5") == 5 ? 0 : 1;
+        }
+        ''')
+
+# -----------------------------------------------------------------------------
+
+@unittest.skipUnless(shutil.which('gcc'), 'gcc is not installed')
+class TestConfigBatching(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dirname = Path(self.tmpdir.name)
+        self.contexts = []
+
+    def tearDown(self):
+        for ctx in self.contexts:
+            ctx.db.shutdown()
+            ctx.scheduler.shutdown()
+
+        self.tmpdir.cleanup()
+
+    def check(self, *args):
+        ctx = fbuild.context.make_default_context([
+            '--database-engine=cache',
+            '--buildroot', self.dirname / 'build%d' % len(self.contexts),
+            '-j4'] + list(args))
+        ctx.create_buildroot()
+        ctx.db.connect()
+        self.contexts.append(ctx)
+
+        test = stdlib_h(fbuild.builders.c.gcc.static(ctx))
+
+        return dict(test.evaluate_all())
+
+    def testBatching(self):
+        results = self.check()
+
+        self.assertEqual(results['header'], 'stdlib.h')
+        self.assertEqual(results['EXIT_SUCCESS'], c.Macro())
+        self.assertEqual(results['NOT_A_MACRO'], None)
+        self.assertTrue(isinstance(results['div_t'], c.Type))
+        self.assertFalse(results['size_t'].signed)
+        self.assertTrue(isinstance(results['abs'], c.Function))
+        self.assertEqual(results['abort'], None)
+        self.assertEqual(results['not_a_function'], None)
+        self.assertTrue(isinstance(results['labs'], c.Function))
+        self.assertTrue(isinstance(results['atoi'], c.Function))
+
+        self.assertEqual(results, self.check('--no-config-batching'))
+
+class TestBatches(unittest.TestCase):
+    def testForget(self):
+        class Instance:
+            pass
+
+        instance = Instance()
+        batch = c._find_batch(instance, 'stdlib.h')
+        self.assertIs(c._find_batch(instance, 'stdlib.h'), batch)
+
+        # The batch is forgotten along with its instance.
+        key = id(instance)
+        del instance
+        gc.collect()
+        self.assertNotIn(key, c._batches)
+
+# -----------------------------------------------------------------------------
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(
+        TestConfigBatching))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestBatches))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+import fbuild.builders
+import fbuild.context
+import fbuild.db
+from fbuild.path import Path
+
+# -----------------------------------------------------------------------------
+
+class Tool(fbuild.db.PersistentObject):
+    search_dirs_flags = ('--search-dirs',)
+
+    def __init__(self, ctx, exe, includes=()):
+        super().__init__(ctx)
+        self.exe = exe
+        self.includes = includes
+
+checked = []
+
+@fbuild.db.configures
+@fbuild.db.caches
+def check(ctx, tool, flag):
+    checked.append(flag)
+    if flag == '-missing':
+        return None
+    return flag.upper()
+
+# -----------------------------------------------------------------------------
+
+class TestConfigCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dirname = Path(self.tmpdir.name)
+        self.contexts = []
+        del checked[:]
+
+        self.exe = self.dirname / 'tool'
+        self.search_dirs = self.dirname / 'search-dirs'
+        self.write_search_dirs('/usr/include')
+        self.write_tool('1')
+
+    def tearDown(self):
+        for ctx in self.contexts:
+            ctx.config_cache.close()
+            ctx.db.shutdown()
+            ctx.scheduler.shutdown()
+
+        self.tmpdir.cleanup()
+
+    def write_tool(self, version):
+        with open(self.exe, 'w') as f:
+            print('#!/bin/sh', file=f)
+            print('if [ "$1" = --search-dirs ]; then', file=f)
+            print('    cat %s' % self.search_dirs, file=f)
+            print('else', file=f)
+            print('    echo %s' % version, file=f)
+            print('fi', file=f)
+        os.chmod(self.exe, 0o755)
+
+    def write_search_dirs(self, search_dirs):
+        with open(self.search_dirs, 'w') as f:
+            print(search_dirs, file=f)
+
+    def check(self, flag, includes=()):
+        """Run the check in a new project, which has an empty database."""
+
+        ctx = fbuild.context.make_default_context([
+            '--database-engine=cache',
+            '--config-cache', self.dirname / 'cache'])
+        ctx.db.connect()
+        self.contexts.append(ctx)
+
+        return check(ctx, Tool(ctx, self.exe, includes), flag)
+
+    def testShare(self):
+        self.assertEqual(self.check('-a'), '-A')
+        self.assertEqual(checked, ['-a'])
+
+        # Another project reuses the result.
+        self.assertEqual(self.check('-a'), '-A')
+        self.assertEqual(checked, ['-a'])
+        self.assertEqual(self.contexts[-1].config_cache.hits, 1)
+
+        # But not for other arguments.
+        self.assertEqual(self.check('-b'), '-B')
+        self.assertEqual(checked, ['-a', '-b'])
+
+    def testToolChanged(self):
+        self.check('-a')
+
+        # Changing the program invalidates the results that used it.
+        self.write_tool('22')
+        self.check('-a')
+        self.assertEqual(checked, ['-a', '-a'])
+
+    def testSearchDirsChanged(self):
+        self.check('-a')
+
+        # Pointing the program at another sysroot invalidates the results.
+        # Touch the program too, as its fingerprint is kept until it changes.
+        self.write_search_dirs('/opt/sysroot/usr/include')
+        self.write_tool('1')
+        os.utime(self.exe, (0, 0))
+        self.check('-a')
+        self.assertEqual(checked, ['-a', '-a'])
+
+    def testRelativeIncludes(self):
+        cwd = os.getcwd()
+        try:
+            for name in ('project1', 'project2'):
+                os.mkdir(self.dirname / name)
+                os.chdir(self.dirname / name)
+                self.check('-a', includes=['include'])
+        finally:
+            os.chdir(cwd)
+
+        # Each project has its own headers, so they don't share results.
+        self.assertEqual(checked, ['-a', '-a'])
+
+    def testFailureNotShared(self):
+        self.assertEqual(self.check('-missing'), None)
+
+        # The probe may pass once the package is installed.
+        self.assertEqual(self.check('-missing'), None)
+        self.assertEqual(checked, ['-missing', '-missing'])
+
+    def find_program(self):
+        """Look for the program in a new project."""
+
+        ctx = fbuild.context.make_default_context([
+            '--database-engine=cache',
+            '--config-cache', self.dirname / 'cache'])
+        ctx.db.connect()
+        self.contexts.append(ctx)
+
+        return fbuild.builders.find_program(ctx, ['tool'], quieter=1)
+
+    def testProgramInstalled(self):
+        bin1 = self.dirname / 'bin1'
+        bin2 = self.dirname / 'bin2'
+        bin1.makedirs()
+        bin2.makedirs()
+        self.exe = bin2 / 'tool'
+        self.write_tool('1')
+
+        with unittest.mock.patch.dict(os.environ,
+                {'PATH': os.pathsep.join((bin1, bin2))}):
+            self.assertEqual(self.find_program(), bin2 / 'tool')
+            self.assertEqual(self.find_program(), bin2 / 'tool')
+            self.assertEqual(self.contexts[-1].config_cache.hits, 1)
+
+            # Installing the program earlier on the path finds it there.
+            self.exe = bin1 / 'tool'
+            self.write_tool('2')
+            self.assertEqual(self.find_program(), bin1 / 'tool')
+            self.assertEqual(self.find_program(), bin1 / 'tool')
+            self.assertEqual(self.contexts[-1].config_cache.hits, 1)
+
+# -----------------------------------------------------------------------------
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestConfigCache))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import shutil
+import unittest
+
+import fbuild.builders.c.gcc
+
+import support
+
+# -----------------------------------------------------------------------------
+
+@unittest.skipUnless(shutil.which('gcc'), 'gcc is not installed')
+class TestEarlyCutoff(support.BuildTestCase):
+    args = ['--early-cutoff']
+
+    def setUp(self):
+        super().setUp()
+
+        self.builder = fbuild.builders.c.gcc.static(self.ctx)
+        self.name = str(self.builder)
+
+        self.write('value.h', '#define VALUE 1\nint unused(void);\n')
+        self.write('a.c', '#include "value.h"\nint a(void) { return VALUE; }\n')
+
+    def compile(self):
+        return self.builder.compile(self.dirname / 'a.c')
+
+    def testCutoff(self):
+        obj = self.compile()
+        mtime = obj.getmtime()
+        self.assertEqual(self.ctx.early_cutoff.compiled, {self.name: 1})
+
+        # Changing comments and blank lines doesn't compile the source.
+        self.write('value.h',
+            '/* The value. */\n\n#define VALUE 1\nint unused(void);\n')
+        self.assertEqual(self.compile(), obj)
+        self.assertEqual(obj.getmtime(), mtime)
+        self.assertEqual(self.ctx.early_cutoff.saved, {self.name: 1})
+
+        # Neither does reformatting the source itself.
+        self.write('a.c',
+            '#include "value.h"\n\nint a(void) { return VALUE; }\n')
+        self.compile()
+        self.assertEqual(self.ctx.early_cutoff.saved, {self.name: 2})
+
+        # But changing the code does.
+        self.write('value.h', '#define VALUE 2\nint unused(void);\n')
+        self.compile()
+        self.assertEqual(self.ctx.early_cutoff.compiled, {self.name: 2})
+
+    def testDebug(self):
+        self.builder.compile(self.dirname / 'a.c', debug=True)
+
+        # Debug info records the lines of the code, so moving it compiles the
+        # source.
+        self.write('value.h',
+            '/* The value. */\n\n#define VALUE 1\nint unused(void);\n')
+        self.builder.compile(self.dirname / 'a.c', debug=True)
+        self.assertEqual(self.ctx.early_cutoff.compiled, {self.name: 2})
+        self.assertEqual(self.ctx.early_cutoff.saved, {})
+
+# -----------------------------------------------------------------------------
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(
+        TestEarlyCutoff))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main()
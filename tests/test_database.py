@@ -0,0 +1,628 @@
+#!/usr/bin/env python3
+
+import hashlib
+import os
+import tempfile
+import time
+import unittest
+
+import fbuild.context
+import fbuild.digest
+import fbuild.db
+import fbuild.db.backend
+import fbuild.db.cache_backend
+import fbuild.db.database
+import fbuild.db.pickle_backend
+import fbuild.db.sqlite_backend
+from fbuild.path import Path
+
+# -----------------------------------------------------------------------------
+
+@fbuild.db.caches
+def leaf(ctx):
+    return 1
+
+@fbuild.db.caches
+def middle(ctx):
+    return leaf(ctx)
+
+@fbuild.db.caches
+def top(ctx):
+    return middle(ctx)
+
+@fbuild.db.caches
+def depend_concurrently(ctx, srcs):
+    def f(src):
+        ctx.db.add_external_dependencies_to_call(srcs=[src])
+        return leaf(ctx)
+
+    return sum(ctx.scheduler.map(f, srcs))
+
+@fbuild.db.caches
+def copy(ctx, src:fbuild.db.SRC, dst:fbuild.db.DST) -> fbuild.db.DST:
+    with open(src) as f, open(dst, 'w') as g:
+        g.write(f.read())
+    return dst
+
+copied = []
+
+@fbuild.db.caches
+def copy_with_leaf(ctx, src:fbuild.db.SRC, dst:fbuild.db.DST) \
+        -> fbuild.db.DST:
+    copied.append(src)
+    leaf(ctx)
+    return copy(ctx, src, dst)
+
+class Copier(fbuild.db.PersistentObject):
+    @fbuild.db.cachemethod
+    def copy(self, src:fbuild.db.SRC, dst:fbuild.db.DST) -> fbuild.db.DST:
+        return copy(self.ctx, src, dst)
+
+class Slotted:
+    __slots__ = ('x',)
+
+    def __init__(self, x):
+        self.x = x
+
+    def __eq__(self, other):
+        return isinstance(other, Slotted) and self.x == other.x
+
+def fun_name(function):
+    return function.__module__ + '.' + function.__name__
+
+def fun_digest(function):
+    return fbuild.db.database.Database.get_function_digest_from_map(
+        fun_name(function))
+
+# -----------------------------------------------------------------------------
+
+class TestDigestBound(unittest.TestCase):
+    def setUp(self):
+        self.ctx = fbuild.context.make_default_context(['--database=cache'])
+
+    def tearDown(self):
+        self.ctx.db.shutdown()
+        self.ctx.scheduler.shutdown()
+
+    def digest(self, bound):
+        return fbuild.db.backend.digest_bound(self.ctx, bound)
+
+    def testEqualValues(self):
+        self.assertEqual(
+            self.digest({'a': 1, 'b': [1, 2], 'c': {'x', 'y', 'z'}}),
+            self.digest({'c': frozenset('zyx'), 'b': [1, 2], 'a': 1.0}))
+
+        self.assertEqual(
+            self.digest({'src': 'foo.c'}),
+            self.digest({'src': Path('foo.c')}))
+
+        self.assertEqual(
+            self.digest({'ctx': self.ctx}),
+            self.digest({'ctx': self.ctx}))
+
+    def testDifferentValues(self):
+        self.assertNotEqual(self.digest({'a': 1}), self.digest({'a': 2}))
+        self.assertNotEqual(self.digest({'a': 1}), self.digest({'b': 1}))
+        self.assertNotEqual(self.digest({'a': [1]}), self.digest({'a': (1,)}))
+        self.assertNotEqual(
+            self.digest({'a': ['ab', 'c']}),
+            self.digest({'a': ['a', 'bc']}))
+
+    def testOpaqueValues(self):
+        # Objects without a __dict__ usually have their address in their
+        # repr, so equal ones need to digest the same anyway.
+        a = Slotted(1)
+        b = Slotted(1)
+        self.assertEqual(self.digest({'a': a}), self.digest({'a': b}))
+
+    def testRecursive(self):
+        x = []
+        x.append(x)
+        self.assertEqual(self.digest({'x': x}), self.digest({'x': x}))
+
+# -----------------------------------------------------------------------------
+
+class TestDigest(unittest.TestCase):
+    def tearDown(self):
+        fbuild.digest.set_default_algorithm('md5')
+
+    def testDigestFile(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            # Check both reading the file and mapping it into memory.
+            for size in (0, 100000, fbuild.digest._MMAP_SIZE + 1):
+                data = bytes(i % 251 for i in range(size))
+                filename = Path(dirname, 'file%d' % size)
+                with open(filename, 'wb') as f:
+                    f.write(data)
+
+                self.assertEqual(filename.digest(),
+                    hashlib.md5(data).hexdigest())
+
+                fbuild.digest.set_default_algorithm('sha1')
+                self.assertEqual(filename.digest(),
+                    hashlib.sha1(data).hexdigest())
+                fbuild.digest.set_default_algorithm('md5')
+
+    def testVersion(self):
+        backend = fbuild.db.cache_backend.CacheBackend
+        version = backend.latest_version()
+
+        fbuild.digest.set_default_algorithm('blake2b')
+        self.assertNotEqual(backend.latest_version(), version)
+
+        self.assertRaises(ValueError, fbuild.digest.set_default_algorithm,
+            'unknown')
+
+# -----------------------------------------------------------------------------
+
+class TestCacheBackend(unittest.TestCase):
+    def setUp(self):
+        self.ctx = fbuild.context.make_default_context(['--database=cache'])
+        self.backend = fbuild.db.cache_backend.CacheBackend(self.ctx)
+        self.backend.connect()
+
+    def tearDown(self):
+        self.backend.close()
+        self.ctx.db.shutdown()
+        self.ctx.scheduler.shutdown()
+
+    def testFindCall(self):
+        fun_id = self.backend.save_function(None, 'f', 'digest', ())
+
+        for i in range(100):
+            self.backend.save_call(None, fun_id, {'x': i}, i * i)
+
+        self.assertEqual(
+            self.backend.find_call(fun_id, {'x': 7}),
+            (False, ('f', 7), 49))
+
+        self.assertEqual(
+            self.backend.find_call(fun_id, {'x': 100}),
+            (True, None, None))
+
+        # Updating a call keeps it findable.
+        self.backend.save_call(('f', 7), fun_id, {'x': 7}, 50)
+        self.assertEqual(
+            self.backend.find_call(fun_id, {'x': 7}),
+            (False, ('f', 7), 50))
+
+        # Deleting the function forgets all of its calls.
+        self.backend.delete_function('f')
+        self.assertEqual(
+            self.backend.find_call(fun_id, {'x': 7}),
+            (True, None, None))
+
+    def testFindCallOpaque(self):
+        fun_id = self.backend.save_function(None, 'f', 'digest', ())
+        self.backend.save_call(None, fun_id, {'x': Slotted(1)}, 1)
+        self.backend.save_call(None, fun_id, {'x': Slotted(2)}, 2)
+
+        # Calls whose arguments digest the same are told apart by comparing
+        # them.
+        self.assertEqual(
+            self.backend.find_call(fun_id, {'x': Slotted(2)}),
+            (False, ('f', 1), 2))
+
+    def save_function(self, function, *dependents, digest=None):
+        self.backend.save_function(None, fun_name(function),
+            digest or fun_digest(function),
+            [fun_name(dependent) for dependent in dependents])
+
+    def testCheckFunction(self):
+        self.save_function(leaf)
+        self.save_function(middle, leaf)
+        self.save_function(top, middle)
+
+        self.assertEqual(self.backend.check_function(fun_name(top)),
+            (False, fun_name(top)))
+
+        # Saving a function makes the functions that depend on it get checked
+        # again.
+        self.save_function(leaf, digest='old')
+        self.assertEqual(self.backend.check_function(fun_name(top)),
+            (True, fun_name(top)))
+        self.assertEqual(self.backend.check_function(fun_name(middle)),
+            (True, fun_name(middle)))
+
+        self.save_function(leaf)
+        self.assertEqual(self.backend.check_function(fun_name(top)),
+            (False, fun_name(top)))
+
+        # As does deleting it.
+        self.backend.delete_function(fun_name(middle))
+        self.assertEqual(self.backend.check_function(fun_name(top)),
+            (True, fun_name(top)))
+        self.assertEqual(self.backend.check_function(fun_name(middle)),
+            (True, None))
+
+    def testCheckFunctionCycle(self):
+        self.save_function(leaf, top)
+        self.save_function(middle, leaf)
+        self.save_function(top, middle)
+
+        self.assertEqual(self.backend.check_function(fun_name(top)),
+            (False, fun_name(top)))
+
+        self.save_function(middle, leaf, digest='old')
+        self.assertEqual(self.backend.check_function(fun_name(leaf)),
+            (True, fun_name(leaf)))
+
+    def testCheckFunctionCycleDependent(self):
+        # Checking top can find middle clean, as top is already being
+        # checked, before it finds that leaf is dirty.
+        self.save_function(leaf, digest='old')
+        self.save_function(middle, top)
+        self.save_function(top, middle, leaf)
+
+        self.assertEqual(self.backend.check_function(fun_name(top)),
+            (True, fun_name(top)))
+        self.assertEqual(self.backend.check_function(fun_name(middle)),
+            (True, fun_name(middle)))
+
+    def testAddFiles(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            srcs = [Path(dirname, 'src%d.c' % i) for i in range(20)]
+            for src in srcs:
+                with open(src, 'w') as f:
+                    print(src, file=f)
+
+            missing = Path(dirname, 'missing.c')
+
+            files = self.backend.add_files(srcs, [missing])
+            self.assertEqual(set(files), set(srcs))
+            for src in srcs:
+                dirty, file_id, mtime, digest = files[src]
+                self.assertTrue(dirty)
+                self.assertEqual(digest, src.digest())
+
+            # Only the modified file is dirty.
+            with open(srcs[0], 'a') as f:
+                print('changed', file=f)
+
+            files = self.backend.add_files(srcs)
+            self.assertTrue(files[srcs[0]][0])
+            self.assertFalse(any(files[src][0] for src in srcs[1:]))
+
+            self.assertRaises(OSError, self.backend.add_files, [missing])
+
+    def testTaskDurations(self):
+        self.backend.save_task_durations({'a': 1.0, 'b': 2.0})
+        self.backend.save_task_durations({'a': 3.0})
+        self.assertEqual(
+            self.backend.find_task_durations(['a', 'b', 'c']),
+            {'a': 3.0, 'b': 2.0})
+
+    def testFileStat(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            src = Path(dirname, 'src.c')
+            with open(src, 'w') as f:
+                print('foo', file=f)
+
+            # The file was just written, so we can't trust its stat yet.
+            self.backend.add_file(src)
+            self.assertEqual(self.backend.find_file(src)[1], None)
+
+            # Pretend the file was written a while ago. Setting the mtime
+            # changes the ctime though, so wait until that's not racy either.
+            os.utime(src, (0, 0))
+            time.sleep(0.1)
+            self.backend.add_file(src)
+            file_stat = self.backend.find_file(src)[1]
+            self.assertEqual(file_stat.mtime_ns, 0)
+            self.assertEqual(file_stat.size, 4)
+
+            # Changing the file without changing the mtime is still noticed.
+            with open(src, 'w') as f:
+                print('bar', file=f)
+            os.utime(src, (0, 0))
+
+            dirty, file_id, file_stat, digest = self.backend.add_file(src)
+            self.assertTrue(dirty)
+            self.assertEqual(digest, src.digest())
+
+# -----------------------------------------------------------------------------
+
+class TestPickleBackend(unittest.TestCase):
+    def setUp(self):
+        self.ctx = fbuild.context.make_default_context(['--database=cache'])
+
+    def tearDown(self):
+        self.ctx.db.shutdown()
+        self.ctx.scheduler.shutdown()
+
+    def connect(self, filename):
+        backend = fbuild.db.pickle_backend.PickleBackend(self.ctx)
+        backend.connect(filename)
+        return backend
+
+    def find_call(self, backend, bound):
+        call_dirty, call_id, result = backend.find_call('f', bound)
+        return call_dirty, call_id, backend.load_result(result)
+
+    def testJournal(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            filename = Path(dirname, 'state.db')
+
+            backend = self.connect(filename)
+            fun_id = backend.save_function(None, 'f', 'digest', ())
+            backend.save_call(None, fun_id, {'x': 1}, 1)
+            backend.close()
+
+            # The first run has to write a snapshot.
+            snapshot = filename.stat()
+
+            backend = self.connect(filename)
+            backend.cache(False, 'f', 'f', 'digest', (),
+                None, {'x': 2}, 4, (), (), ())
+            backend.close()
+
+            # Later runs only append to the journal.
+            self.assertEqual(filename.stat(), snapshot)
+            self.assertTrue((filename + '.log').exists())
+
+            # A partially written record gets ignored.
+            with open(filename + '.log', 'ab') as f:
+                f.write(b'\xff\xff\x00')
+
+            backend = self.connect(filename)
+            self.assertEqual(self.find_call(backend, {'x': 1}),
+                (False, ('f', 0), 1))
+            self.assertEqual(self.find_call(backend, {'x': 2}),
+                (False, ('f', 1), 4))
+
+            backend.delete_function('f')
+            backend.close()
+
+            backend = self.connect(filename)
+            self.assertEqual(backend.find_function('f'), (None, None, ()))
+            backend.close()
+
+    def testJournalTaskDurations(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            filename = Path(dirname, 'state.db')
+
+            for durations in {'a': 1.0, 'b': 2.0}, {'a': 3.0}, {'c': 4.0}:
+                backend = self.connect(filename)
+                backend.save_task_durations(durations)
+                backend.close()
+
+            # Replaying the journal forgets the same tasks the builds did.
+            backend = self.connect(filename)
+            self.assertEqual(
+                backend.find_task_durations(['a', 'b', 'c']),
+                {'c': 4.0})
+            backend.close()
+
+    def testLazyResults(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            filename = Path(dirname, 'state.db')
+
+            backend = self.connect(filename)
+            fun_id = backend.save_function(None, 'f', 'digest', ())
+            for x in range(3):
+                backend.save_call(None, fun_id, {'x': x}, [x % 2])
+            backend.close()
+
+            # The results aren't unpickled until they're used.
+            backend = self.connect(filename)
+            results = [backend.find_call('f', {'x': x})[2] for x in range(3)]
+            for result in results:
+                self.assertIsInstance(result,
+                    fbuild.db.backend.PickledResult)
+            self.assertEqual([backend.load_result(result)
+                for result in results], [[0], [1], [0]])
+
+            # Identical results only keep their data once, but each call
+            # gets a value of its own.
+            self.assertIs(results[0].data, results[2].data)
+            self.assertIsNot(backend.load_result(results[0]),
+                backend.load_result(results[2]))
+            backend.close()
+
+# -----------------------------------------------------------------------------
+
+class TestSqliteBackend(unittest.TestCase):
+    def setUp(self):
+        self.ctx = fbuild.context.make_default_context(['--database=cache'])
+        self.ctx.db.connect()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = Path(self.tmpdir.name, 'state.sqldb')
+
+    def tearDown(self):
+        self.ctx.db.shutdown()
+        self.ctx.scheduler.shutdown()
+        self.tmpdir.cleanup()
+
+    def connect(self, **kwargs):
+        backend = fbuild.db.sqlite_backend.SqliteBackend(self.ctx, **kwargs)
+        backend.connect(self.filename)
+        return backend
+
+    def cache(self, backend, x, result):
+        backend.cache(True, None, 'f', 'digest', (),
+            None, {'x': x}, result, (), (), ())
+
+    def find_call(self, backend, x):
+        fun_id, fun_digest, fun_dependents = backend.find_function('f')
+        call_dirty, call_id, result = backend.find_call(fun_id, {'x': x})
+        return backend.load_result(result)
+
+    def testPersistentObject(self):
+        copier = Copier(self.ctx)
+
+        backend = self.connect()
+        self.cache(backend, 1, [copier, copier])
+        backend.close()
+
+        # PersistentObjects are unpickled without creating them again, and
+        # get the current context.
+        backend = self.connect()
+        result = self.find_call(backend, 1)
+        self.assertEqual(result, [copier, copier])
+        self.assertIs(result[0].ctx, self.ctx)
+        backend.close()
+
+    def testTaskDurations(self):
+        backend = self.connect()
+        backend.save_task_durations({'a': 1.0, 'b': 2.0})
+        backend.close()
+
+        # The next build forgets the tasks that it doesn't run.
+        backend = self.connect()
+        backend.save_task_durations({'a': 3.0})
+        self.assertEqual(backend.find_task_durations(['a', 'b']), {'a': 3.0})
+        backend.close()
+
+    def testFast(self):
+        backend = self.connect(fast=True)
+        self.assertEqual(backend.cursor.execute(
+            'PRAGMA journal_mode').fetchone(), ('wal',))
+
+        # The calls are only committed once enough of them are cached.
+        backend._COMMIT_CALLS = 2
+        self.cache(backend, 1, 1)
+        self.assertTrue(backend.conn.in_transaction)
+        self.cache(backend, 2, 4)
+        self.assertFalse(backend.conn.in_transaction)
+
+        self.cache(backend, 3, 9)
+        backend.close()
+
+        backend = self.connect()
+        self.assertEqual([self.find_call(backend, x) for x in (1, 2, 3)],
+            [1, 4, 9])
+        backend.close()
+
+class TestConcurrentDatabase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dirname = Path(self.tmpdir.name)
+        self.filename = self.dirname / 'state.sqldb'
+        del copied[:]
+
+        self.srcs = []
+        for i in range(20):
+            src = self.dirname / 'src%d' % i
+            with open(src, 'w') as f:
+                f.write(src)
+            self.srcs.append(src)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def build(self):
+        """Copy the sources from the scheduler threads, which all write to
+        the database file directly."""
+
+        ctx = fbuild.context.make_default_context([
+            '--database-engine=sqlite',
+            '--concurrent-database',
+            '-j4'])
+        ctx.db.connect(self.filename)
+        try:
+            dsts = ctx.scheduler.map(
+                lambda src: copy_with_leaf(ctx, src, src + '.out'),
+                self.srcs)
+            self.assertEqual(dsts, [src + '.out' for src in self.srcs])
+
+            backend = ctx.db._backend
+            fun_id, fun_digest, fun_dependents = backend.find_function(
+                fun_name(copy_with_leaf))
+            self.assertEqual(set(fun_dependents),
+                {fun_name(leaf), fun_name(copy)})
+            self.assertEqual(backend.cursor.execute(
+                'SELECT COUNT(*) FROM Call WHERE fun_id=?',
+                (fun_id,)).fetchone(), (len(self.srcs),))
+        finally:
+            ctx.db.close()
+            ctx.db.shutdown()
+            ctx.scheduler.shutdown()
+
+    def testBuild(self):
+        self.build()
+        self.assertEqual(sorted(copied), sorted(self.srcs))
+
+        # Every call was saved, so the next build doesn't copy anything.
+        self.build()
+        self.assertEqual(len(copied), len(self.srcs))
+
+# -----------------------------------------------------------------------------
+
+class TestCallContext(unittest.TestCase):
+    def setUp(self):
+        self.ctx = fbuild.context.make_default_context(
+            ['--database-engine=cache', '-j4'])
+        self.ctx.db.connect()
+
+    def tearDown(self):
+        self.ctx.db.shutdown()
+        self.ctx.scheduler.shutdown()
+
+    def testTasks(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            srcs = [Path(dirname, 'src%d' % i) for i in range(20)]
+            for src in srcs:
+                with open(src, 'w') as f:
+                    f.write(src)
+
+            # The calls and dependencies that the tasks make on other threads
+            # belong to the call that started them.
+            result, call_srcs, call_dsts = depend_concurrently.call(
+                self.ctx, srcs)
+            self.assertEqual(result, 20)
+            self.assertEqual(call_srcs, set(srcs))
+
+            fun_id, fun_digest, fun_dependents = \
+                self.ctx.db._backend.find_function(
+                    fun_name(depend_concurrently))
+            self.assertEqual(set(fun_dependents), {fun_name(leaf)})
+
+    def testFindOldResult(self):
+        self.assertRaises(fbuild.Error, self.ctx.db.find_old_result)
+
+    def testCallSignature(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            src = Path(dirname, 'src')
+            with open(src, 'w') as f:
+                f.write('src')
+
+            result, call_srcs, call_dsts = copy.call(
+                self.ctx, src, Path(dirname, 'dst'))
+            self.assertEqual(call_srcs, {src})
+            self.assertEqual(call_dsts, {Path(dirname, 'dst')})
+
+            # Methods share a signature however they're bound.
+            signatures = fbuild.db.database.Database._CALL_SIGNATURES
+            counts = []
+            for dst in 'dst1', 'dst2':
+                copier = Copier(self.ctx)
+                self.assertEqual(copier.copy(src, Path(dirname, dst)),
+                    Path(dirname, dst))
+                counts.append(len(signatures))
+            self.assertEqual(counts[0], counts[1])
+
+            fun_name, function, args, kwargs = \
+                self.ctx.db._find_function_name(copy.function, (), {})
+            signature = self.ctx.db._find_call_signature(function)
+            self.assertEqual([akey for akey, convert in signature.srcs],
+                ['src'])
+            self.assertEqual([akey for akey, convert in signature.dsts],
+                ['dst'])
+            self.assertIs(signature.return_type, fbuild.db.DST)
+
+# -----------------------------------------------------------------------------
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestDigestBound))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestDigest))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestCacheBackend))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestPickleBackend))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestSqliteBackend))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(
+        TestConcurrentDatabase))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestCallContext))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+import shutil
+import unittest
+
+import fbuild.builders.c.gcc
+
+import support
+
+# -----------------------------------------------------------------------------
+
+@unittest.skipUnless(shutil.which('gcc') and shutil.which('nm'),
+    'gcc or nm is not installed')
+class TestLibraryInterface(support.BuildTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.builder = fbuild.builders.c.gcc.shared(self.ctx)
+
+        self.write('lib.c', 'int f(void) { return 1; }\n')
+        self.write('main.c', 'int f(void);\n'
+            'int main(void) { return f() == 1 ? 0 : 1; }\n')
+
+    def build(self):
+        lib = self.builder.build_lib('lib', [self.dirname / 'lib.c'])
+        exe = self.builder.build_exe('main', [self.dirname / 'main.c'],
+            libs=[lib])
+
+        return lib, exe
+
+    def testInterface(self):
+        lib, exe = self.build()
+        self.assertTrue(lib.interface.exists())
+
+        with open(lib.interface, 'rb') as f:
+            self.assertIn(b'f T\n', f.read())
+
+    def testImplementationChanged(self):
+        lib, exe = self.build()
+        lib_mtime = lib.getmtime()
+        exe_mtime = exe.getmtime()
+
+        # Changing the implementation of the library relinks it, but not the
+        # programs that use it.
+        self.write('lib.c', 'int f(void) { return 1 + 0 * 2; }\n'
+            'static int g(void) { return 2; }\n')
+        self.assertEqual(self.build(), (lib, exe))
+        self.assertNotEqual(lib.getmtime(), lib_mtime)
+        self.assertEqual(exe.getmtime(), exe_mtime)
+
+    def testInterfaceChanged(self):
+        lib, exe = self.build()
+        exe_mtime = exe.getmtime()
+
+        # Exporting another symbol relinks the programs.
+        self.write('lib.c', 'int f(void) { return 1; }\n'
+            'int g(void) { return 2; }\n')
+        self.build()
+        self.assertNotEqual(exe.getmtime(), exe_mtime)
+
+# -----------------------------------------------------------------------------
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(
+        TestLibraryInterface))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+
+import fbuild.objcache
+from fbuild.path import Path
+
+# -----------------------------------------------------------------------------
+
+class TestObjectCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dirname = Path(self.tmpdir.name)
+        self.cache = fbuild.objcache.ObjectCache(self.dirname / 'cache', 1000)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, name, data):
+        path = self.dirname / name
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def testRestore(self):
+        src = self.write('src.o', b'object')
+        dst = self.dirname / 'dst.o'
+
+        self.assertFalse(self.cache.restore('abcd', dst))
+        self.assertFalse(dst.exists())
+
+        self.cache.store('abcd', src)
+        self.assertTrue(self.cache.restore('abcd', dst))
+        self.assertEqual(self.read(dst), b'object')
+
+        # Changing the restored object leaves the cache alone.
+        self.write('dst.o', b'stripped')
+        self.assertTrue(self.cache.restore('abcd', dst))
+        self.assertEqual(self.read(dst), b'object')
+
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 1))
+
+    def testTrim(self):
+        for i in range(5):
+            self.cache.store('key%d' % i, self.write('src.o', b'x' * 300))
+
+            # Make the objects look like they were used in order.
+            os.utime(self.cache._path('key%d' % i), (i, i))
+
+        self.cache.restore('key0', self.dirname / 'dst.o')
+
+        self.assertEqual(self.cache.trim(), 2)
+        self.assertEqual(self.cache.trim(), 0)
+
+        # The recently used objects are kept.
+        for i, cached in enumerate([True, False, False, True, True]):
+            self.assertEqual(self.cache._path('key%d' % i).exists(), cached)
+
+# -----------------------------------------------------------------------------
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestObjectCache))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main()
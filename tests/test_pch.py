@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+import shutil
+import unittest
+
+import fbuild.builders.c
+import fbuild.builders.c.gcc
+
+import support
+
+# -----------------------------------------------------------------------------
+
+@unittest.skipUnless(shutil.which('gcc'), 'gcc is not installed')
+class TestPrecompiledHeader(support.BuildTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.builder = fbuild.builders.c.gcc.static(self.ctx)
+
+        # The sources don't include the header, so they only compile when it's
+        # included for them.
+        self.write('all.h', '#include "value.h"\n'
+            'static int f(void) { return VALUE; }\n')
+        self.write('value.h', '#define VALUE 5\n')
+        self.write('a.c', 'int a(void) { return f(); }\n')
+        self.write('main.c', 'int a(void);\n'
+            'int main(void) { return a() + f() == 10 ? 0 : 1; }\n')
+
+    def build(self):
+        return self.builder.build_objects(
+            [self.dirname / 'a.c', self.dirname / 'main.c'],
+            pch=self.dirname / 'all.h')
+
+    def testBuildObjects(self):
+        objs = self.build()
+        self.assertTrue(all(obj.exists() for obj in objs))
+
+        pch = self.builder.compile_pch(self.dirname / 'all.h')
+        self.assertTrue(isinstance(pch, fbuild.builders.c.PrecompiledHeader))
+        self.assertTrue(pch.endswith('all.h.gch'))
+        self.assertTrue(pch.exists())
+
+        exe = self.builder.link_exe(self.dirname / 'main', objs)
+        self.builder.run([exe])
+
+    def testHeaderChanged(self):
+        objs = self.build()
+        mtimes = [obj.getmtime() for obj in objs]
+
+        # Nothing is rebuilt if nothing changed.
+        self.assertEqual(self.build(), objs)
+        self.assertEqual([obj.getmtime() for obj in objs], mtimes)
+
+        # Changing a header the precompiled header includes rebuilds it, and
+        # every object that used it.
+        self.write('value.h', '#define VALUE 6\n')
+        self.build()
+        self.assertNotEqual([obj.getmtime() for obj in objs], mtimes)
+
+        exe = self.builder.link_exe(self.dirname / 'main', objs)
+        with self.assertRaises(fbuild.ExecutionError):
+            self.builder.run([exe], quieter=1)
+
+    def testInvalid(self):
+        self.build()
+
+        # A precompiled header gcc can't use makes it include the header.
+        pch = self.builder.compile_pch(self.dirname / 'all.h')
+        with open(pch, 'w') as f:
+            f.write('invalid')
+
+        self.write('b.c', 'int b(void) { return f(); }\n')
+        self.assertTrue(self.builder.compile(self.dirname / 'b.c',
+            pch=pch).exists())
+
+class TestPrecompiledHeaderObjectCache(TestPrecompiledHeader):
+    """The object cache works from preprocessed sources, which include the
+    header rather than the precompiled header."""
+
+    args = ['--object-cache', '{}/objects']
+
+# -----------------------------------------------------------------------------
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(
+        TestPrecompiledHeader))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(
+        TestPrecompiledHeaderObjectCache))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import hashlib
+import http.client
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import fbuild.builders.c.gcc
+import fbuild.context
+import fbuild.db
+import fbuild.db.cache_server
+import fbuild.db.remote_cache
+from fbuild.path import Path
+
+# -----------------------------------------------------------------------------
+
+copied = []
+
+@fbuild.db.caches
+def copy(ctx, src:fbuild.db.SRC, dst) -> fbuild.db.DST:
+    copied.append(src)
+    Path(src).copyfile(dst)
+    return Path(dst)
+
+@fbuild.db.caches
+def link(ctx, builder, src:fbuild.db.SRC, dst) -> fbuild.db.DST:
+    copied.append(src)
+    obj = builder.uncached_compile(src, quieter=1)
+    return Path(builder.uncached_link_exe(dst, [obj], quieter=1))
+
+# -----------------------------------------------------------------------------
+
+class TestRemoteCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dirname = Path(self.tmpdir.name)
+
+        self.server = fbuild.db.cache_server.CacheServer(self.dirname / 'cache')
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+        self.contexts = []
+        del copied[:]
+
+    def tearDown(self):
+        for ctx in self.contexts:
+            ctx.remote_cache.close()
+            ctx.db.shutdown()
+            ctx.scheduler.shutdown()
+
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        self.tmpdir.cleanup()
+
+    def make_context(self, *args):
+        """Make a context with an empty database, like a build on another
+        machine."""
+
+        ctx = fbuild.context.make_default_context([
+            '--database-engine=cache',
+            '--remote-cache', self.server.url] + list(args))
+        ctx.db.connect()
+        self.contexts.append(ctx)
+        return ctx
+
+    def testFiles(self):
+        cache = fbuild.db.remote_cache.HTTPRemoteCache(self.server.url)
+
+        digests = [hashlib.sha256(data).hexdigest() for data in (b'a', b'b')]
+        cache.put_file(digests[0], b'a')
+
+        self.assertEqual(cache.get_file(digests[0]), b'a')
+        self.assertEqual(cache.get_file(digests[1]), None)
+        self.assertEqual(cache.contains_files(digests), {digests[0]})
+
+        # The server only accepts files under their own digest.
+        self.assertRaises(http.client.HTTPException,
+            cache.put_file, digests[1], b'a')
+
+        cache.close()
+
+    def testCall(self):
+        src = self.dirname / 'src.txt'
+        dst = self.dirname / 'dst.txt'
+        with open(src, 'w') as f:
+            f.write('foo')
+
+        self.assertEqual(copy(self.make_context(), src, dst), dst)
+        self.assertEqual(copied, [src])
+
+        # Another build downloads the dst instead of making it.
+        dst.remove()
+        ctx = self.make_context()
+        self.assertEqual(copy(ctx, src, dst), dst)
+        self.assertEqual(copied, [src])
+        self.assertEqual(ctx.remote_cache.hits, 1)
+
+        with open(dst) as f:
+            self.assertEqual(f.read(), 'foo')
+
+        # Changing the src means the dst needs to be made again.
+        with open(src, 'w') as f:
+            f.write('bar')
+
+        self.assertEqual(copy(self.make_context(), src, dst), dst)
+        self.assertEqual(copied, [src, src])
+
+    @unittest.skipUnless(shutil.which('gcc'), 'gcc is not installed')
+    def testExecutable(self):
+        src = self.dirname / 'main.c'
+        with open(src, 'w') as f:
+            f.write('int main(void) { return 0; }\n')
+
+        def build():
+            ctx = self.make_context('--buildroot', self.dirname / 'build')
+            ctx.create_buildroot()
+            builder = fbuild.builders.c.gcc.static(ctx)
+            return ctx, link(ctx, builder, src, self.dirname / 'main')
+
+        ctx, exe = build()
+        mode = exe.stat().st_mode
+
+        # The restored program can still be run.
+        exe.remove()
+        ctx, exe = build()
+        self.assertEqual(copied, [src])
+        self.assertEqual(exe.stat().st_mode, mode)
+        self.assertTrue(os.access(exe, os.X_OK))
+        ctx.execute([exe], quieter=1)
+
+# -----------------------------------------------------------------------------
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestRemoteCache))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main()
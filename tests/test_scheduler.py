@@ -6,20 +6,25 @@ import unittest
 import gc
 
 from fbuild.console import Log
-from fbuild.sched import Scheduler
+from fbuild.jobserver import JobServer
+from fbuild.sched import Scheduler, Task
+import fbuild.context
+import fbuild.sched
 
 import threading
 
 # -----------------------------------------------------------------------------
 
 class TestScheduler(unittest.TestCase):
+    locked = True
+
     def setUp(self):
         # Make sure any latent contexts are cleaned up before we run.
         gc.collect()
 
         self.initial_thread_count = threading.active_count()
 
-        self.scheduler = Scheduler(self.threads)
+        self.scheduler = Scheduler(self.threads, locked=self.locked)
 
         if self.threads == 0:
             self.assertEqual(self.scheduler.threadcount, 1)
@@ -56,10 +61,138 @@ class TestScheduler(unittest.TestCase):
             self.threads = i
             super(TestScheduler, self).run(*args, **kwargs)
 
+class TestUnlockedScheduler(TestScheduler):
+    locked = False
+
+    def testConcurrent(self):
+        if self.scheduler.threadcount < 2:
+            return
+
+        # This only finishes if both tasks run at the same time.
+        barrier = threading.Barrier(2, timeout=10)
+
+        def f(x):
+            barrier.wait()
+            return x
+
+        self.assertEqual(self.scheduler.map(f, [0, 1]), [0, 1])
+
+# -----------------------------------------------------------------------------
+
+class History:
+    def __init__(self, durations):
+        self.durations = durations
+        self.saved = {}
+
+    def find_task_durations(self, keys):
+        return {k: self.durations[k] for k in keys if k in self.durations}
+
+    def save_task_durations(self, durations):
+        self.saved.update(durations)
+
+def identity(x):
+    return x
+
+class TestPriority(unittest.TestCase):
+    def testReadyQueue(self):
+        q = fbuild.sched._ReadyQueue()
+        tasks = [Task(None, i) for i in range(4)]
+        for task, priority in zip(tasks, [1.0, 2.0, 1.0, 0.0]):
+            task.priority = priority
+            q.put((None, task))
+        q.put(None)
+
+        self.assertEqual(q.get(), None)
+        self.assertEqual([q.get()[1].src for i in range(4)], [1, 2, 0, 3])
+
+    def testCriticalPaths(self):
+        # a depends on b, which depends on c. d is on its own.
+        a, b, c, d = tasks = [Task(None, src) for src in 'abcd']
+        a.dependencies.append(b)
+        b.dependencies.append(c)
+        weights = {'a': 1.0, 'b': 2.0, 'c': 3.0, 'd': 4.0}
+
+        paths = fbuild.sched._critical_paths(tasks, lambda t: weights[t.src])
+        self.assertEqual(paths, {a: 1.0, b: 3.0, c: 6.0, d: 4.0})
+
+        # Loops don't hang.
+        c.dependencies.append(a)
+        paths = fbuild.sched._critical_paths(tasks, lambda t: weights[t.src])
+        self.assertEqual(len(paths), 4)
+
+    def testHistory(self):
+        def deps(x):
+            return {'a': ['b'], 'b': [], 'c': []}[x]
+
+        history = History({Task(identity, 'b').key: 10.0})
+        scheduler = Scheduler(1, history=history)
+        try:
+            self.assertEqual(
+                scheduler.map_with_dependencies(deps, identity, 'abc'),
+                ['b', 'a', 'c'])
+        finally:
+            scheduler.shutdown()
+
+        self.assertEqual(
+            set(history.saved),
+            {Task(identity, src).key for src in 'abc'})
+
+# -----------------------------------------------------------------------------
+
+class TestJobServer(unittest.TestCase):
+    def testSlots(self):
+        jobserver = JobServer(2)
+        scheduler = Scheduler(4, locked=False, jobserver=jobserver)
+
+        lock = threading.Lock()
+        running = [0]
+        most = [0]
+
+        def f(x):
+            with lock:
+                running[0] += 1
+                most[0] = max(most[0], running[0])
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+            return x
+
+        try:
+            self.assertEqual(scheduler.map(f, range(20)), list(range(20)))
+        finally:
+            scheduler.shutdown()
+            jobserver.close()
+
+        self.assertLessEqual(most[0], 2)
+
+    def testExecute(self):
+        ctx = fbuild.context.make_default_context([
+            '--database-engine=cache', '--jobserver', '-j2'])
+        try:
+            cmd = ['sh', '-c', 'echo "$MAKEFLAGS"']
+
+            # Only the commands that ask for the jobserver get it.
+            stdout, stderr = ctx.execute(cmd, quieter=1,
+                env={'MAKEFLAGS': ''})
+            self.assertEqual(stdout, b'\n')
+
+            stdout, stderr = ctx.execute(cmd, quieter=1,
+                env={'MAKEFLAGS': ''}, jobserver=True)
+            self.assertIn(b'--jobserver-auth=', stdout)
+        finally:
+            ctx.db.shutdown()
+            ctx.scheduler.shutdown()
+            ctx.jobserver.close()
+
 # -----------------------------------------------------------------------------
 
 def suite():
-    return unittest.TestLoader().loadTestsFromTestCase(TestScheduler)
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestScheduler))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestUnlockedScheduler))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestPriority))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestJobServer))
+    return suite
 
 if __name__ == "__main__":
     unittest.main()
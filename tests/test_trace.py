@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+import json
+import tempfile
+import unittest
+
+from fbuild.path import Path
+from fbuild.trace import Tracer
+
+# -----------------------------------------------------------------------------
+
+class TestTracer(unittest.TestCase):
+    def testSpans(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            filename = Path(dirname, 'trace.json')
+
+            tracer = Tracer(filename)
+            with tracer.span('outer', 'task') as span:
+                span.name = 'renamed'
+                with tracer.span('inner', 'db', cached=True):
+                    pass
+
+            try:
+                with tracer.span('failed', 'execute'):
+                    raise ValueError
+            except ValueError:
+                pass
+
+            tracer.close()
+
+            with open(filename) as f:
+                events = json.load(f)
+
+        self.assertEqual(
+            [(e['name'], e['ph']) for e in events],
+            [('thread_name', 'M'),
+             ('inner', 'X'),
+             ('renamed', 'X'),
+             ('failed', 'X')])
+
+        inner, outer = events[1:3]
+        self.assertEqual(inner['args'], {'cached': True})
+        self.assertLessEqual(outer['ts'], inner['ts'])
+        self.assertEqual(events[3]['args'], {'error': 'ValueError'})
+
+    def testDisabled(self):
+        tracer = Tracer()
+        with tracer.span('nothing', 'task') as span:
+            span.args['x'] = 1
+        tracer.close()
+
+# -----------------------------------------------------------------------------
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(TestTracer)
+
+if __name__ == "__main__":
+    unittest.main()
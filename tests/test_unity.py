@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+import shutil
+import unittest
+import unittest.mock
+
+import fbuild.builders.c.gcc
+import fbuild.builders.c.unity
+from fbuild.path import Path
+
+import support
+
+# -----------------------------------------------------------------------------
+
+@unittest.skipUnless(shutil.which('gcc'), 'gcc is not installed')
+class TestUnity(support.BuildTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.builder = fbuild.builders.c.gcc.static(self.ctx)
+
+        self.write('value.h', '#define VALUE 1\n')
+        self.write('a.c', '#include "value.h"\nint a(void) { return VALUE; }\n')
+        self.write('b.c', 'int b(void) { return 2; }\n')
+        self.write('c.c', 'int c(void) { return 3; }\n')
+        self.write('main.c', 'int a(void); int b(void); int c(void);\n'
+            'int main(void) { return a() + b() + c() == 6 ? 0 : 1; }\n')
+
+    def build(self, unity=2):
+        return self.builder.build_objects(
+            [self.dirname / name for name in ('a.c', 'b.c', 'c.c', 'main.c')],
+            unity=unity)
+
+    def run_exe(self, objs):
+        exe = self.builder.link_exe(self.dirname / 'main', objs)
+        stdout, stderr = self.builder.run([exe], quieter=1)
+
+    def testBuildObjects(self):
+        objs = self.build()
+        self.assertEqual(len(objs), 2)
+        self.run_exe(objs)
+
+        # Nothing is rebuilt if nothing changed.
+        mtimes = [obj.getmtime() for obj in objs]
+        self.assertEqual(self.build(), objs)
+        self.assertEqual([obj.getmtime() for obj in objs], mtimes)
+
+    def testHeaderChanged(self):
+        objs = self.build()
+        mtimes = [obj.getmtime() for obj in objs]
+
+        # The group that includes a.c depends on the headers it includes.
+        self.write('value.h', '#define VALUE 2\n')
+        self.assertEqual(self.build(), objs)
+        self.assertNotEqual(objs[0].getmtime(), mtimes[0])
+        self.assertEqual(objs[1].getmtime(), mtimes[1])
+
+        with self.assertRaises(fbuild.ExecutionError):
+            self.run_exe(objs)
+
+    def testEdited(self):
+        self.build()
+
+        # Sources that keep changing are compiled on their own.
+        for value in range(fbuild.builders.c.unity.EDITS):
+            self.write('b.c', 'int b(void) { return %d; }\n' % (value + 10))
+            objs = self.build()
+        self.assertEqual(len(objs), 3)
+
+    def testEditsExpire(self):
+        self.build()
+        for value in range(fbuild.builders.c.unity.EDITS):
+            self.write('b.c', 'int b(void) { return %d; }\n' % (value + 10))
+            self.build()
+
+        # Once the source stops changing it's compiled in its group again.
+        for i in range(fbuild.builders.c.unity.STABLE):
+            objs = self.build()
+        self.assertEqual(len(objs), 2)
+
+    def testNoopNotHashed(self):
+        history = fbuild.builders.c.unity.History(self.dirname / 'history')
+        history.update([self.dirname / 'b.c'])
+
+        # Sources that didn't change aren't read again.
+        with unittest.mock.patch.object(Path, 'digest',
+                side_effect=AssertionError('b.c was digested')):
+            self.assertEqual(history.update([self.dirname / 'b.c']),
+                ([self.dirname / 'b.c'], []))
+
+    def testSeparateCalls(self):
+        self.write('d.c', 'int d(void) { return 4; }\n')
+        self.write('e.c', 'int e(void) { return 5; }\n')
+
+        objs = self.build()
+        other = self.builder.build_objects(
+            [self.dirname / name for name in ('d.c', 'e.c')], unity=2)
+
+        # Each call compiles its own groups.
+        self.assertEqual(len(other), 1)
+        self.assertFalse(set(objs) & set(other))
+        self.assertEqual(self.build(), objs)
+        self.run_exe(objs)
+
+    def testClashes(self):
+        self.write('b.c', 'static int x = 1;\nint b(void) { return 2; }\n')
+        self.write('c.c', 'static int x = 2;\nint c(void) { return 3; }\n')
+
+        objs = self.build(unity=4)
+        self.assertEqual(len(objs), 3)
+        self.run_exe(objs)
+
+        # The history remembers which sources clash.
+        self.assertEqual(self.build(unity=4), objs)
+
+    def testErrorNotClash(self):
+        self.write('b.c', 'int b(void) { return 2 }\n')
+        with self.assertRaises(fbuild.ExecutionError):
+            self.build()
+
+        # A source that failed on its own goes back into its group once it's
+        # fixed.
+        self.write('b.c', 'int b(void) { return 2; }\n')
+        self.assertEqual(len(self.build()), 2)
+
+# -----------------------------------------------------------------------------
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestUnity))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main()
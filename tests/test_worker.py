@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+import fbuild.builders.c.gcc
+import fbuild.context
+import fbuild.worker
+from fbuild.path import Path
+
+# -----------------------------------------------------------------------------
+
+@unittest.skipUnless(shutil.which('gcc'), 'gcc is not installed')
+class TestWorker(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dirname = Path(self.tmpdir.name)
+
+        self.workers = []
+        self.threads = []
+        for i in range(2):
+            worker = fbuild.worker.Worker(slots=2)
+            thread = threading.Thread(target=worker.serve_forever)
+            thread.start()
+            self.workers.append(worker)
+            self.threads.append(thread)
+
+        self.srcs = []
+        for i in range(4):
+            src = self.dirname / 'src%d.c' % i
+            with open(src, 'w') as f:
+                print('int f%d(void) { return %d; }' % (i, i), file=f)
+            self.srcs.append(src)
+
+    def tearDown(self):
+        self.ctx.distributor.close()
+        self.ctx.db.shutdown()
+        self.ctx.scheduler.shutdown()
+
+        for worker, thread in zip(self.workers, self.threads):
+            worker.shutdown()
+            thread.join()
+            worker.server_close()
+
+        self.tmpdir.cleanup()
+
+    def build_objects(self, addresses):
+        self.ctx = fbuild.context.make_default_context([
+            '--database-engine=cache',
+            '--buildroot', self.dirname / 'build',
+            '--workers', ','.join(addresses),
+            '-j4'])
+        self.ctx.create_buildroot()
+        self.ctx.db.connect()
+
+        builder = fbuild.builders.c.gcc.static(self.ctx)
+        objs = builder.build_objects(self.srcs)
+
+        for obj in objs:
+            self.assertTrue(obj.exists())
+
+        return objs
+
+    def testDistribute(self):
+        self.build_objects([worker.address for worker in self.workers])
+        self.assertEqual(self.ctx.distributor.remote, 4)
+        self.assertEqual(self.ctx.distributor.local, 0)
+
+    def testThreadcount(self):
+        # -j is raised to the number of slots the workers have.
+        self.ctx = fbuild.context.make_default_context([
+            '--database-engine=cache',
+            '--buildroot', self.dirname / 'build',
+            '--workers', ','.join(w.address for w in self.workers),
+            '-j1'])
+        self.assertEqual(self.ctx.scheduler.threadcount, 4)
+
+    def testFallback(self):
+        # Find a port that nothing is listening on.
+        sock = socket.socket()
+        sock.bind(('localhost', 0))
+        address = '%s:%d' % sock.getsockname()
+        sock.close()
+
+        self.build_objects([address])
+        self.assertEqual(self.ctx.distributor.remote, 0)
+        self.assertEqual(self.ctx.distributor.local, 4)
+
+# -----------------------------------------------------------------------------
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestWorker))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main()